@@ -0,0 +1,98 @@
+'''Measures database throughput under each storage profile, against a copy of database/db.sqlite; run directly with Python, i.e. python benchmark.py --touches 2000'''
+
+# Allows for other .py files to be found in /modules folder
+from sys import path as syspath
+syspath.append(syspath[0] + "\\modules")
+
+from typing import Any, Dict, List
+from argparse import ArgumentParser
+from datetime import datetime
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from statistics import median, quantiles
+
+from sqlalchemy import update
+from sqlalchemy.orm import sessionmaker
+
+from bot import SQLBase, storage_profiles, create_database_engine
+from dbmodels import User, LedgerEntry
+from usercache import write_users
+from migrations import copy_database
+
+def benchmark(path: str, profile: Dict[str, Any], users: int, touches: int, gifts: int) -> Dict[str, float]:
+    '''
+    Runs the write paths of the bot against a database, each event in its own transaction, as session_scope() does
+
+    ### Parameters
+    path: str
+        Database file to run against; is modified
+
+    profile: Dict[str, Any]
+        Storage profile, as in bot.storage_profiles
+
+    users: int
+        Number of benchmark users to spread events over
+
+    touches: int
+        Number of beacon touches to save, each as a write of a single user with a ledger entry, as the user cache does
+
+    gifts: int
+        Number of gifts to make between benchmark users, each with User.transfer()
+
+    ### Returns
+    "touches_per_second", and "gift_p50_ms" and "gift_p99_ms" latencies
+    '''
+
+    engine = create_database_engine(path, profile)
+    connector = sessionmaker(engine, autocommit = False, autoflush = False)
+    SQLBase.metadata.create_all(engine)
+
+    # Benchmark users have negative IDs, so they never collide with real ones
+    ids = [-1 - i for i in range(users)]
+    with connector() as session:
+        User.create_missing(session, ids)
+        session.execute(update(User).where(User.id.in_(ids)).values(electrum = 1000000))
+        session.commit()
+
+    start = perf_counter()
+    for i in range(touches):
+        id = ids[i % users]
+        with connector() as session:
+            row = {"id": id, "electrum": 1000000 + i, "beacon_touches": i, "dawnbreaker_progess": 0, "beacon_cd": None}
+            write_users(session, [row], [LedgerEntry.entry(id, 1, "beacon", row["electrum"], datetime.utcnow())])
+            session.commit()
+    touch_time = perf_counter() - start
+
+    latencies: List[float] = []
+    for i in range(gifts):
+        start = perf_counter()
+        with connector() as session:
+            User.transfer(session, ids[i % users], {ids[(i + 1) % users]: 1})
+            session.commit()
+        latencies.append((perf_counter() - start) * 1000)
+
+    engine.dispose()
+    return {
+        "touches_per_second": touches / touch_time if touch_time else 0,
+        "gift_p50_ms": median(latencies) if latencies else 0,
+        "gift_p99_ms": quantiles(latencies, n = 100)[-1] if len(latencies) > 1 else (latencies[0] if latencies else 0)
+    }
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Measures database throughput under each storage profile, against a copy of the database")
+    parser.add_argument("--source", default = "database/db.sqlite", help = "database to copy; an empty one is used if it does not exist")
+    parser.add_argument("--profiles", nargs = "*", default = list(storage_profiles), help = "storage profiles to compare")
+    parser.add_argument("--users", type = int, default = 100, help = "number of benchmark users")
+    parser.add_argument("--touches", type = int, default = 1000, help = "number of beacon touches to save")
+    parser.add_argument("--gifts", type = int, default = 500, help = "number of gifts to make")
+    args = parser.parse_args()
+
+    print("Benchmarking " + ("a copy of " + args.source if exists(args.source) else "an empty database") + "\n")
+    print(f"{'profile':<12}{'touches/s':>12}{'gift p50 ms':>14}{'gift p99 ms':>14}")
+    for name in args.profiles:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "db.sqlite")
+            copy_database(args.source, path)
+            results = benchmark(path, storage_profiles[name], args.users, args.touches, args.gifts)
+        print(f"{name:<12}{results['touches_per_second']:>12.0f}{results['gift_p50_ms']:>14.3f}{results['gift_p99_ms']:>14.3f}")
@@ -1,9 +1,35 @@
-'''Directly runs database-related commands; use for structure changes and data migration'''
+'''Directly runs database-related commands; use for structure changes and data migration, i.e. python db.py --dry-run'''
 
 from sys import path as syspath
 syspath.append(syspath[0] + "\\modules")
 
+from argparse import ArgumentParser
+
 import bot
 import dbmodels
+import migrations
+
+parser = ArgumentParser(description = "Migrates the database to the current schema, keeping all data")
+parser.add_argument("--dry-run", action = "store_true", help = "migrate a temporary copy of the database instead, to see how long it takes")
+parser.add_argument("--status", action = "store_true", help = "only list applied and pending migrations")
+parser.add_argument("--batch-size", type = int, default = migrations.rebuild_batch_size, help = "rows copied per transaction when rebuilding a table")
+parser.add_argument("--pause", type = float, default = migrations.rebuild_pause, help = "seconds to wait between batches when rebuilding a table")
+parser.add_argument("--reset", action = "store_true", help = "delete every table and recreate the schema; loses all data!")
+args = parser.parse_args()
 
-bot.db_init()
\ No newline at end of file
+if args.reset:
+    if input("This deletes all data in the database. Type RESET to continue: ") == "RESET":
+        migrations.reset()
+        print("Database reset to schema version " + str(migrations.migrations[-1].version))
+elif args.status:
+    print("Applied: " + ", ".join(str(version) for version in migrations.applied_versions(bot.database_engine)))
+    for migration in migrations.pending_migrations():
+        print("Pending: " + str(migration.version) + " - " + migration.name)
+else:
+    applied = migrations.dry_run(batch_size = args.batch_size, pause = args.pause) if args.dry_run else migrations.migrate(batch_size = args.batch_size, pause = args.pause)
+    for migration, seconds, rows in applied:
+        print(f"{'Would apply' if args.dry_run else 'Applied'} {migration.version} - {migration.name}: {seconds:.2f}s, {rows} rows copied")
+    if not applied:
+        print("Database is up to date")
+    elif args.dry_run:
+        print(f"Estimated total: {sum(seconds for _, seconds, _ in applied):.2f}s")
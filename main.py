@@ -31,7 +31,7 @@ else:
 if exists("database/db.sqlite"):
     print("Database found!")
 else:
-    print("Database not found!\nPlease run bot.db_init() in a separate script.")
+    print("Database not found!\nPlease run db.py in a separate script.")
     quit()
 
 if exists("logs"):
@@ -50,10 +50,23 @@ else:
 from bot import bot_client
 from auxiliary import log, get_time
 import dbmodels
+import usercache
+import leaderboard
+import cooldowns
 import admin
 import electrum
 import beacon
+import dice
+import gacha
+import triggers
+import voice
+import deletions
 import callandresponse
+import migrations
+
+# Apply any schema changes since the database was last migrated; run db.py beforehand to do slow ones while the bot is still up
+for migration, seconds, rows in migrations.migrate():
+    print("Applied database migration " + str(migration.version) + ": " + migration.name)
 
 print("\nAll bot modules successfully loaded!\nNow initiating connection to Discord servers...")
 
@@ -1,11 +1,15 @@
 '''Contains several bot commands for admining or debugging'''
 
+from datetime import datetime, timedelta
+
 from discord import ApplicationContext, Option
 from discord import User as DiscordUser
 
-from bot import bot_client, database_connector
-from auxiliary import perms, log, get_time
-from dbmodels import User
+from bot import bot_client, run_db
+from auxiliary import perms, log_event, INFO, WARNING, flush_logs
+from usercache import user_cache
+from dbmodels import LedgerEntry, DailyRollup
+from voice import queue_depth
 
 admin_cmds = bot_client.create_group("admin", "Commands to affect behind the scenes stuff for Meridia")
 
@@ -17,12 +21,14 @@ async def admin_pineapple(context: ApplicationContext):
 
     if context.author.id in perms["admin"]:
         await context.respond("change da world\nmy final message. Goodb ye.")
-        log(get_time() + " >> Admin " + str(context.author) + " externally shut down Meridia from GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
+        log_event(INFO, "admin.pineapple", "Admin {user} externally shut down Meridia from GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok")
+        await user_cache.flush()
         await bot_client.close()
+        flush_logs()
         quit()
     else:
         await context.respond("I don't know you, and I don't care to know you.")
-        log(get_time() + " >> " + str(context.author) + " permission denied in GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
 
 @admin_cmds.command(name = "setdbprog", description = "Set a user's Dawnbreaker quest progress", guild_only = True)
 async def admin_setdbprog(
@@ -35,17 +41,15 @@ async def admin_setdbprog(
     '''
 
     if context.author.id in perms["admin"]:
-        log(get_time() + " >> Admin " + str(context.author) + " at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "] is setting Dawnbreaker progress of " + str(user) + " to " + str(progress))
+        log_event(INFO, "admin.setdbprog", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] is setting Dawnbreaker progress of {target} to {progress}", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", target = user, target_id = user.id, progress = progress)
         
-        session = database_connector()
-        user_data = User.find_user(session, user.id)
-        user_data.dawnbreaker(session, progress)
-        session.close()
+        user_data = await user_cache.get(user.id)
+        user_data.dawnbreaker(progress)
 
         await context.respond("Operation successful.")
     else:
         await context.respond("I don't know you, and I don't care to know you.")
-        log(get_time() + " >> " + str(context.author) + " permission denied in GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
 
 @admin_cmds.command(name = "resetcd", description = "Reset a user's beacon touching cooldown", guild_only = True)
 async def admin_resetcd(
@@ -57,17 +61,15 @@ async def admin_resetcd(
     '''
 
     if context.author.id in perms["admin"]:
-        log(get_time() + " >> Admin " + str(context.author) + " at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "] is disabling beacon touch cooldown of " + str(user))
+        log_event(INFO, "admin.resetcd", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] is disabling beacon touch cooldown of {target}", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", target = user, target_id = user.id)
         
-        session = database_connector()
-        user_data = User.find_user(session, user.id)
-        user_data.reset_cd(session)
-        session.close()
+        user_data = await user_cache.get(user.id)
+        user_data.reset_cd()
 
         await context.respond("Operation successful.")
     else:
         await context.respond("I don't know you, and I don't care to know you.")
-        log(get_time() + " >> " + str(context.author) + " permission denied in GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
 
 @admin_cmds.command(name = "setcurrency", description = "Set a user's balance of electrum", guild_only = True)
 async def admin_setcurrency(
@@ -80,17 +82,15 @@ async def admin_setcurrency(
     '''
 
     if context.author.id in perms["admin"]:
-        log(get_time() + " >> Admin " + str(context.author) + " at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "] set balance of " + str(user) + " to " + str(electrum))
+        log_event(INFO, "admin.setcurrency", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] set balance of {target} to {electrum}", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", target = user, target_id = user.id, electrum = electrum)
         
-        session = database_connector()
-        user_data = User.find_user(session, user.id)
-        user_data.add_electrum(session, electrum - user_data.electrum)
-        session.close()
+        user_data = await user_cache.get(user.id)
+        user_data.add_electrum(electrum - user_data.electrum, "admin")
 
         await context.respond("Operation successful.")
     else:
         await context.respond("I don't know you, and I don't care to know you.")
-        log(get_time() + " >> " + str(context.author) + " permission denied in GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
 
 @admin_cmds.command(name = "getcurrency", description = "Get a user's balance of electrum", guild_only = True)
 async def admin_getcurrency(
@@ -102,12 +102,73 @@ async def admin_getcurrency(
     '''
 
     if context.author.id in perms["admin"]:
-        log(get_time() + " >> Admin " + str(context.author) + " at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "] queried balance of " + str(user))
+        log_event(INFO, "admin.getcurrency", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] queried balance of {target}", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", target = user, target_id = user.id)
         
-        session = database_connector()
-        user_data = User.find_user(session, user.id)
+        user_data = await user_cache.get(user.id)
         await context.respond("Current Electrum: " + str(user_data.electrum))
-        session.close()
     else:
         await context.respond("I don't know you, and I don't care to know you.")
-        log(get_time() + " >> " + str(context.author) + " permission denied in GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
\ No newline at end of file
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
+
+@admin_cmds.command(name = "ledger", description = "See the most recent changes to a user's balance of electrum", guild_only = True)
+async def admin_ledger(
+    context: ApplicationContext,
+    user: Option(DiscordUser, description = "Discord user to audit", required = True),
+    count: Option(int, description = "Number of entries to show", required = False, default = 10, min_value = 1, max_value = 50)
+):
+    '''
+    Adds the command /admin ledger
+    '''
+
+    if context.author.id in perms["admin"]:
+        log_event(INFO, "admin.ledger", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] audited ledger of {target}", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", target = user, target_id = user.id)
+
+        history = await user_cache.run_sql([user.id], LedgerEntry.history, user.id, count)
+        if not history:
+            await context.respond("No electrum has changed hands.")
+            return
+
+        lines = [time.strftime("%Y-%m-%d %H:%M") + " UTC | " + ("+" if amount >= 0 else "") + str(amount) + " (" + reason + ") -> " + str(balance) for time, amount, reason, balance in history]
+        await context.respond("```" + "\n".join(lines) + "```")
+    else:
+        await context.respond("I don't know you, and I don't care to know you.")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
+
+@admin_cmds.command(name = "economy", description = "See how much electrum was minted and spent recently, by reason")
+async def admin_economy(
+    context: ApplicationContext,
+    days: Option(int, description = "Number of days to look back, including today", required = False, default = 7, min_value = 1)
+):
+    '''
+    Adds the command /admin economy
+    '''
+
+    if context.author.id in perms["admin"]:
+        log_event(INFO, "admin.economy", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] queried economy stats for {days} days", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", days = days)
+
+        # Rollups are answered from the database, so pending ledger entries have to be written first
+        await user_cache.flush()
+        totals = await run_db(DailyRollup.totals, datetime.utcnow() - timedelta(days = days - 1))
+        if not totals:
+            await context.respond("No electrum has changed hands.")
+            return
+
+        lines = [reason + ": +" + str(credited) + " / -" + str(debited) for reason, (credited, debited) in sorted(totals.items())]
+        await context.respond("```Last " + str(days) + " days (UTC):\n" + "\n".join(lines) + "```")
+    else:
+        await context.respond("I don't know you, and I don't care to know you.")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
+
+@admin_cmds.command(name = "voicequeue", description = "See how many audio clips are waiting to play in this server", guild_only = True)
+async def admin_voicequeue(context: ApplicationContext):
+    '''
+    Adds the command /admin voicequeue
+    '''
+
+    if context.author.id in perms["admin"]:
+        depth = queue_depth(context.guild)
+        log_event(INFO, "admin.voicequeue", "Admin {user} at GUILD[{guild}], CHANNEL[{channel}] queried voice queue depth", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", depth = depth)
+        await context.respond("Clips waiting to play: " + str(depth))
+    else:
+        await context.respond("I don't know you, and I don't care to know you.")
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
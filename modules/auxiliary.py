@@ -1,12 +1,15 @@
 '''Contains miscellaneous functions used in most cases'''
 
 from datetime import datetime
-from random import randint
-from json import load
-from typing import Dict, List, Any
-
-from discord import VoiceChannel, VoiceClient, FFmpegOpusAudio
-from discord import ClientException
+from random import randint, choices
+from json import load, dumps
+from os import makedirs
+from os.path import exists
+from typing import Dict, List, Optional, TextIO, Any
+from queue import SimpleQueue
+from threading import Thread, Event
+from sys import stdout, stderr
+from atexit import register as register_exit
 
 
 class InvalidArgumentError(Exception):
@@ -24,79 +27,277 @@ def get_time() -> str:
     return datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
 
 
-def log(out: str) -> None:
+def load_settings(name: str, defaults: Dict[str, Any]) -> Dict[str, Any]:
     '''
-    Both prints the input string to the console and writes the input string to a dated log.
-
-    This log is found in the logs/ folder (the logs folder has to be created first).
+    Loads optional settings from settings/<name>.json, falling back to defaults for anything the file leaves out.
 
     ### Parameters
-    out: str
-        String to print to file and console
+    name: str
+        Name of the settings file (excluding .json)
+
+    defaults: Dict[str, Any]
+        Default value of every setting
+
+    ### Returns
+    The defaults, overridden by anything in the file
+    '''
+
+    settings = dict(defaults)
+    if exists("settings/" + name + ".json"):
+        with open("settings/" + name + ".json", "r") as settings_file:
+            settings.update(load(settings_file))
+    return settings
+
+
+DEBUG = 10
+'''Log level for verbose details of an event'''
+INFO = 20
+'''Log level for events themselves'''
+WARNING = 30
+'''Log level for events that were refused or went wrong because of the user'''
+ERROR = 40
+'''Log level for events that went wrong because of Meridia'''
+
+level_names = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+log_settings = load_settings("logging", {"level": "INFO"})
+log_level: int = {name: level for level, name in level_names.items()}[log_settings["level"].upper()]
+'''Events below this level are dropped before anything is formatted'''
+
+
+class EventRecord:
     '''
+    A structured log event, captured as-is on the hot path and only formatted by the log writer thread
+
+    ### Attributes
+    time: datetime
+        When the event happened
+
+    level: int
+        One of DEBUG, INFO, WARNING, or ERROR
+
+    event: str
+        Type of event, i.e. "beacon.touch"
+
+    message: str
+        str.format() template of the human-readable line; filled in with user, guild, channel, outcome, and fields
 
-    print(out)
+    user, guild, channel: Any
+        Discord objects involved, if any
 
-    with open("logs/" + datetime.now().strftime("%Y-%m-%d") + ".txt", "a") as log_file:
-        log_file.write(out + "\n")
+    outcome: str | None
+        How the event ended, i.e. "ok" or "denied"
 
+    fields: Dict[str, Any]
+        Any other values of the event
 
-async def play_audio(vc: VoiceChannel, file: str) -> None:
+    ### Methods
+    text() -> str
+        Renders the human-readable log line
+
+    json() -> str
+        Renders the JSON Lines record
+    '''
+
+    __slots__ = ("time", "level", "event", "message", "user", "guild", "channel", "outcome", "fields")
+
+    def __init__(self, level: int, event: str, message: str, user: Any, guild: Any, channel: Any, outcome: Optional[str], fields: Dict[str, Any]) -> None:
+        self.time = datetime.now()
+        self.level = level
+        self.event = event
+        self.message = message
+        self.user = user
+        self.guild = guild
+        self.channel = channel
+        self.outcome = outcome
+        self.fields = fields
+
+    def text(self) -> str:
+        '''
+        Renders the human-readable log line
+        '''
+
+        line = self.message.format(user = self.user, guild = self.guild, channel = self.channel, outcome = self.outcome, **self.fields)
+        if self.level >= ERROR:
+            return "ERROR HAS OCCURRED   >> " + line
+        if self.level <= DEBUG:
+            return "                     >> " + line
+        return self.time.strftime("%Y-%m-%d, %H:%M:%S") + " >> " + line
+
+    def json(self) -> str:
+        '''
+        Renders the JSON Lines record
+        '''
+
+        record = {
+            "time": self.time.isoformat(),
+            "level": level_names[self.level],
+            "event": self.event,
+            "user_id": getattr(self.user, "id", None),
+            "guild_id": getattr(self.guild, "id", None),
+            "channel_id": getattr(self.channel, "id", None),
+            "outcome": self.outcome
+        }
+        record.update(self.fields)
+        return dumps(record, default = str)
+
+def log_event(level: int, event: str, message: str, user: Any = None, guild: Any = None, channel: Any = None, outcome: Optional[str] = None, **fields: Any) -> None:
     '''
-    Has the bot join a voice channel, and play an audio clip from ./audio/<file>.ogg
+    Logs a structured event, both as a line in the dated log (like log()) and as a record in the dated JSON Lines log.
 
-    Bot automatically leaves after audio stops playing.
+    Nothing is formatted unless the level is enabled, and even then, formatting happens on the log writer thread;
+    so pass objects and values as-is rather than building strings.
 
     ### Parameters
-    vc: VoiceChannel
-        Voice channel to join
-    
-    file: str
-        Name of audio file to play (excluding .ogg)
+    level: int
+        One of DEBUG, INFO, WARNING, or ERROR
+
+    event: str
+        Type of event, i.e. "beacon.touch"
+
+    message: str
+        str.format() template of the human-readable line; filled in with user, guild, channel, outcome, and fields
+
+    user, guild, channel: Any
+        Discord objects involved, if any; their IDs are recorded
+
+    outcome: str | None
+        How the event ended, i.e. "ok" or "denied"
+
+    **fields: Any
+        Any other values of the event
     '''
 
-    if vc is None:
+    if level < log_level:
         return
 
-    log(get_time() + " >> Playing " + file + ".ogg in GUILD[" + str(vc.guild) + "], CHANNEL[" + str(vc) + "]")
+    log_queue.put(EventRecord(level, event, message, user, guild, channel, outcome, fields))
 
-    # Get bot voice client, if it exists, or create one
-    voice_client: VoiceClient
-    try:
-        voice_client = await vc.connect()
-    except ClientException:
-        voice_client = vc.guild.voice_client
-        if voice_client.channel is not vc:
-            await voice_client.move_to(vc)
 
-    # Detect failure to obtain voice client
-    if voice_client is None:
-        log("ERROR HAS OCCURRED   >> Audio commands have intersected!")
-        return
+log_queue: "SimpleQueue[str | EventRecord | Event]" = SimpleQueue()
+'''Lines and events waiting to be written by the log writer thread; an Event is set once everything queued before it is written'''
+
+def log(out: str) -> None:
+    '''
+    Both prints the input string to the console and writes the input string to a dated log.
+
+    This log is found in the logs/ folder, which is created if missing.
+    Only queues the string; the log writer thread does the actual printing and writing.
+    Prefer log_event() for anything related to an event.
+
+    ### Parameters
+    out: str
+        String to print to file and console
+    '''
+
+    log_queue.put(out)
+
+def log_writer() -> None:
+    '''
+    Runs on its own thread, formatting and writing queued log lines and events in batches.
+
+    Keeps one buffered handle each to the current day's text and JSON Lines logs open, reopening them when the date changes.
+    If the log files cannot be written, the error is reported to stderr and lines are only printed until writing works again;
+    the thread itself never dies, so flush_logs() never waits on lost lines.
+    '''
+
+    log_date = ""
+    log_file: Optional[TextIO] = None
+    event_file: Optional[TextIO] = None
+    failing = False
+
+    while True:
+        # Block for the first item, then take everything else already queued
+        batch = [log_queue.get()]
+        while not log_queue.empty():
+            batch.append(log_queue.get())
 
-    # Load audio
-    try:
-        audio: FFmpegOpusAudio = FFmpegOpusAudio("audio/" + file + ".ogg", codec = "copy")
-    except ClientException:
-        log("ERROR HAS OCCURRED   >> Audio file not found!")
-        return
-    
-    # Play audio
-    if not voice_client.is_playing():
         try:
-            await voice_client.play(audio, wait_finish = True)
-            if not voice_client.is_playing():
-                log(get_time() + " >> Disconnecting voice client in GUILD[" + str(voice_client.guild) + "]")
-                await voice_client.disconnect()
-        except ClientException:
-            log("ERROR HAS OCCURRED   >> Audio commands have collided!")
-    else:
-        voice_client.source = audio
+            lines: List[str] = []
+            records: List[str] = []
+            for item in batch:
+                if isinstance(item, str):
+                    lines.append(item)
+                elif isinstance(item, EventRecord):
+                    try:
+                        lines.append(item.text())
+                        records.append(item.json())
+                    except Exception as error:
+                        lines.append("ERROR HAS OCCURRED   >> Could not format " + item.event + " event! " + repr(error))
+
+            if lines:
+                text = "\n".join(lines) + "\n"
+                stdout.write(text)
+                stdout.flush()
+
+            try:
+                if lines:
+                    # Rotate at midnight
+                    today = datetime.now().strftime("%Y-%m-%d")
+                    if today != log_date or log_file is None:
+                        if log_file is not None:
+                            log_file.close()
+                            log_file = None
+                        if event_file is not None:
+                            event_file.close()
+                            event_file = None
+                        log_date = today
+                        makedirs("logs", exist_ok = True)
+                        log_file = open("logs/" + log_date + ".txt", "a")
+
+                    log_file.write(text)
+                    log_file.flush()
+
+                if records:
+                    if event_file is None:
+                        event_file = open("logs/" + log_date + ".jsonl", "a")
+                    event_file.write("\n".join(records) + "\n")
+                    event_file.flush()
+
+                failing = False
+            except Exception as error:
+                # Reopened on the next batch; only reported once until writing works again
+                for file in (log_file, event_file):
+                    try:
+                        if file is not None:
+                            file.close()
+                    except Exception:
+                        pass
+                log_file = None
+                event_file = None
+                if not failing:
+                    stderr.write("ERROR HAS OCCURRED   >> Could not write to the log files; logging to console only! " + repr(error) + "\n")
+                    stderr.flush()
+                failing = True
+        except Exception as error:
+            stderr.write("ERROR HAS OCCURRED   >> Could not log a batch of " + str(len(batch)) + " lines! " + repr(error) + "\n")
+            stderr.flush()
+        finally:
+            for item in batch:
+                if isinstance(item, Event):
+                    item.set()
+
+def flush_logs(timeout: float = 5) -> None:
+    '''
+    Blocks until every line logged so far has been written; use before shutting down.
+
+    ### Parameters
+    timeout: float
+        Maximum seconds to wait
+    '''
+
+    written = Event()
+    log_queue.put(written)
+    written.wait(timeout)
+
+Thread(target = log_writer, name = "log writer", daemon = True).start()
+register_exit(flush_logs)
 
 
 def d(n: int, x: int) -> int:
     '''
     Rolls a given a number of dice in the form NdX, and returns the sum.
+    For anything more than a plain sum, see dice.parse_dice().
 
     ### Parameters
     n: int
@@ -120,10 +321,8 @@ def d(n: int, x: int) -> int:
     if n == 1:
         return randint(1, x)
 
-    result = 0
-    for i in range(n):
-        result += randint(1, x)
-    return result
+    # Draws every die in one call rather than one call per die
+    return sum(choices(range(1, x + 1), k = n))
 
 
 def ordinal(num: int) -> str:
@@ -1,13 +1,25 @@
 '''Contains event listeners and event logic related to touching the beacon'''
 
 from typing import List
-from datetime import datetime, timedelta
+from datetime import datetime
 
-from discord import Message, TextChannel, Member, RawReactionActionEvent, ApplicationContext
+from discord import Message, TextChannel, Member, RawReactionActionEvent, ApplicationContext, Interaction
 
-from bot import bot_client, database_connector
-from auxiliary import play_audio, log, get_time, d, ordinal
-from dbmodels import User
+from bot import bot_client
+from auxiliary import log_event, load_settings, DEBUG, INFO, WARNING, d, ordinal
+from usercache import user_cache, CachedUser
+from cooldowns import beacon_cooldowns
+from ratelimit import TokenBuckets
+from triggers import message_trigger
+from voice import play_audio
+from outbox import Response
+from deletions import message_deletions
+from beaconrules import touch_dice, touch_sides, search_sides, search_succeeds, touch_outcome, progress_after, outcome_electrum, found_progress, lost_progress, dawnbreaker_progress, touch_cooldown, search_cooldown, NOTHING, PROGRESS, DAWNBREAKER, COOLDOWN, LOSE
+
+beacon_settings = load_settings("beacon", {"touch_rate": 0.2, "touch_burst": 3, "tracked_touchers": 10000})
+
+touch_limits = TokenBuckets(beacon_settings["touch_rate"], beacon_settings["touch_burst"], beacon_settings["tracked_touchers"])
+'''Beacon touches admitted per user and channel, so that storms of reactions and messages only touch the beacon a few times'''
 
 quest_dialogue = [
     "*A new supplicant approaches. Listen, hear me and obey.*",
@@ -40,10 +52,108 @@ def beacon_roll() -> List[int]:
     results of 3 d20s, sorted from highest to lowest
     '''
 
-    results = [d(1, 20), d(1, 20), d(1, 20)]
+    results = [d(1, touch_sides) for i in range(touch_dice)]
     results.sort(reverse = True)
     return results
 
+class TouchResult:
+    '''
+    Plain summary of the outcome of a single beacon touch
+
+    ### Attributes
+    kind: str
+        What happened; one of "bearer", "tired", "search", "peeved", or "touch"
+
+    touches: int
+        Beacon touches of the user after this touch
+
+    rolls: List[int]
+        The 3d20 rolled for a touch, sorted from highest to lowest; or the single d20 rolled for a search
+
+    outcome: int
+        Outcome of the rolls of a touch; see beaconrules
+
+    progress: int
+        Dawnbreaker progress of the user after this touch
+
+    progressed: bool
+        Whether Dawnbreaker progress was increased by this touch
+
+    electrum: int
+        Electrum rewarded by this touch
+    '''
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self.touches = 0
+        self.rolls: List[int] = []
+        self.outcome = NOTHING
+        self.progress = 0
+        self.progressed = False
+        self.electrum = 0
+
+def beacon_update(user: CachedUser) -> TouchResult:
+    '''
+    Applies the rules of a beacon touch to the cached state of a user; the rules themselves are in beaconrules.
+
+    ### Parameters
+    user: CachedUser
+        Cached state of the user touching the beacon
+
+    ### Returns
+    TouchResult describing what happened, for beacon_touch to respond with
+    '''
+
+    # Dawnbreaker has already been found
+    if user.dawnbreaker_progess == dawnbreaker_progress:
+        return TouchResult("bearer")
+
+    # Reset cooldown if any, if it has passed
+    if user.beacon_cd is not None and datetime.utcnow() > user.beacon_cd:
+        user.reset_cd()
+
+    # When beacon has already been lost and user tries to touch the beacon
+    if user.dawnbreaker_progess == lost_progress:
+        if user.beacon_cd is not None:
+            # user has a cooldown active
+            return TouchResult("tired")
+
+        # attempt to find the beacon; cooldown 1 day upon fail
+        result = TouchResult("search")
+        result.rolls = [d(1, search_sides)]
+        if search_succeeds(result.rolls[0]):
+            # successfully found the beacon again; reset progress
+            user.dawnbreaker(found_progress)
+        else:
+            user.set_cd(search_cooldown)
+        result.progress = user.dawnbreaker_progess
+        return result
+
+    if user.beacon_cd is not None:
+        # cooldown active for pissing off meridia
+        return TouchResult("peeved")
+
+    user.touch_beacon()
+    result = TouchResult("touch")
+    result.touches = user.beacon_touches
+    result.rolls = beacon_roll()
+    result.outcome = touch_outcome(result.rolls)
+
+    if result.outcome == COOLDOWN:
+        user.set_cd(touch_cooldown)
+
+    progress = progress_after(user.dawnbreaker_progess, result.outcome)
+    if progress != user.dawnbreaker_progess:
+        result.progressed = result.outcome == PROGRESS
+        user.dawnbreaker(progress)
+
+    result.electrum = outcome_electrum[result.outcome]
+    if result.electrum:
+        user.add_electrum(result.electrum, "dawnbreaker" if result.outcome == DAWNBREAKER else "beacon")
+
+    result.progress = user.dawnbreaker_progess
+    return result
+
 async def beacon_touch(channel: TextChannel, toucher: Member) -> None:
     '''
     Handles all beacon touching logic (since multiple events trigger the same code)
@@ -61,6 +171,10 @@ async def beacon_touch(channel: TextChannel, toucher: Member) -> None:
 
     If author was is in a voice channel, will also join the same voice channel and play the quote.
 
+    The rules themselves are applied by beacon_update, and the reply put together by beacon_respond; this only sends it.
+
+    Touches beyond the per-user, per-channel limits of touch_limits are dropped before any other work.
+
     ### Parameters
     channel: TextChannel
         The text channel where the beacon was touched
@@ -69,162 +183,149 @@ async def beacon_touch(channel: TextChannel, toucher: Member) -> None:
         The Discord user who touched the beacon
     '''
 
+    if not touch_limits.admit((toucher.id, channel.id)):
+        log_event(DEBUG, "beacon.touch", "{user} touched the beacon too often in GUILD[{guild}], CHANNEL[{channel}]; ignored", user = toucher, guild = channel.guild, channel = channel, outcome = "limited")
+        return
+
     if not channel.can_send(Message):
-        log(get_time() + " >> " + str(toucher) + " tried to touch the beacon in GUILD[" + str(channel.guild) + "], CHANNEL[" + str(channel) + "]\nERROR HAS OCCURRED   >> Meridia's influence does not reach there!")
+        log_event(WARNING, "beacon.touch", "{user} tried to touch the beacon in GUILD[{guild}], CHANNEL[{channel}], but Meridia's influence does not reach there!", user = toucher, guild = channel.guild, channel = channel, outcome = "unreachable")
         return
 
-    session = database_connector()
+    # Users on cooldown are turned away without loading them
+    cooldown = beacon_cooldowns.active(toucher.id)
+    if cooldown is not None:
+        result = TouchResult("tired" if cooldown[1] == lost_progress else "peeved")
+    else:
+        result = beacon_update(await user_cache.get(toucher.id))
 
-    user = User.find_user(session, toucher.id)
+    response = Response(channel)
+    beacon_respond(response, channel, toucher, result)
+    await response.send()
 
-    # Dawnbreaker has already been found
-    if user.dawnbreaker_progess == 20:
-        log(get_time() + " >> Dawnbreaker-bearer " + str(toucher) + " tried to touch the beacon in GUILD[" + str(channel.guild) + "], CHANNEL[" + str(channel) + "]")
+    # If connected to a voice channel, play meridia.ogg
+    if result.kind == "touch" and toucher.voice:
+        await play_audio(toucher.voice.channel, "meridia")
 
-        # Coin flip between 2 dialogue possibilities
-        if d(1, 2) == 1:
-            await channel.send("*" + toucher.mention + ", may the light of certitude guide your efforts.*", delete_after = 60)
-        else:
-            await channel.send("*" + toucher.mention + ", as you carry Dawnbreaker, so will my light touch the world.*", delete_after = 60)
+def beacon_respond(response: Response, channel: TextChannel, toucher: Member, result: TouchResult) -> None:
+    '''
+    Adds everything Meridia says about a beacon touch to a response, so that it is sent as a single message
 
-        session.close()
-        return
+    ### Parameters
+    response: Response
+        Response to add to
 
-    # Reset cooldown if any, if it has passed
-    if user.beacon_cd is not None and datetime.utcnow() > user.beacon_cd:
-        user.reset_cd(session)
+    channel: TextChannel
+        The text channel where the beacon was touched
 
-    # When beacon has already been lost and user tries to touch the beacon
-    if user.dawnbreaker_progess == -1:
-        if user.beacon_cd is not None:
-            # user has a cooldown active
-            log(get_time() + " >> " + str(toucher) + " was too tired to find the beacon in GUILD[" + str(channel.guild) + "], CHANNEL[" + str(channel) + "]")
+    toucher: Member
+        The Discord user who touched the beacon
 
-            await channel.send("Unfortunately, " + toucher.mention + ", you are much too tired to continue your search for the beacon today.", delete_after = 60)
+    result: TouchResult
+        What happened, as decided by beacon_update
+    '''
 
+    # Dawnbreaker has already been found
+    if result.kind == "bearer":
+        log_event(INFO, "beacon.touch", "Dawnbreaker-bearer {user} tried to touch the beacon in GUILD[{guild}], CHANNEL[{channel}]", user = toucher, guild = channel.guild, channel = channel, outcome = result.kind)
+
+        # Coin flip between 2 dialogue possibilities
+        if d(1, 2) == 1:
+            response.add("*" + toucher.mention + ", may the light of certitude guide your efforts.*", delete_after = 60)
         else:
-            # attempt to find the beacon; cooldown 1 day upon fail
-            log(get_time() + " >> " + str(toucher) + " tried to find the beacon in GUILD[" + str(channel.guild) + "], CHANNEL[" + str(channel) + "]")
+            response.add("*" + toucher.mention + ", as you carry Dawnbreaker, so will my light touch the world.*", delete_after = 60)
+        return
 
-            message = toucher.mention + ", you set out to search for the beacon once again today.\n`| "
-            beacon_search = d(1, 20)
-            message += str(beacon_search) + " |`"
+    if result.kind == "tired":
+        # user has a cooldown active
+        log_event(INFO, "beacon.touch", "{user} was too tired to find the beacon in GUILD[{guild}], CHANNEL[{channel}]", user = toucher, guild = channel.guild, channel = channel, outcome = result.kind)
 
-            log("                     >> Result: " + str(beacon_search))
+        response.add("Unfortunately, " + toucher.mention + ", you are much too tired to continue your search for the beacon today.", delete_after = 60)
+        return
 
-            if beacon_search == 20:
-                # successfully found the beacon again; reset progress
-                user.dawnbreaker(session, 0)
+    if result.kind == "search":
+        # attempt to find the beacon; cooldown 1 day upon fail
+        log_event(INFO, "beacon.touch", "{user} tried to find the beacon in GUILD[{guild}], CHANNEL[{channel}], rolling {roll}", user = toucher, guild = channel.guild, channel = channel, outcome = result.kind, roll = result.rolls[0], found = search_succeeds(result.rolls[0]))
 
-                log("                     >> " + str(toucher) + " Dawnbreaker progress reset to 0")
-                message += "\nAmazingly, you finally find the :touchesthebeacon:, right in the last place you look: your back pocket! Don't misplace it next time!"
+        message = toucher.mention + ", you set out to search for the beacon once again today.\n`| "
+        message += str(result.rolls[0]) + " |`"
 
-            else:
-                # failed to find the beacon
-                message += "\nDespite all your efforts, wardrobes opened, chests unlocked, and display cases upturned, you still haven't found the beacon!"
-                user.set_cd(session, timedelta(days = 1))
-                log("                     >> " + str(toucher) + " cooldown set to 1 day")
+        if search_succeeds(result.rolls[0]):
+            # successfully found the beacon again; reset progress
+            log_event(DEBUG, "beacon.progress", "{user} Dawnbreaker progress reset to 0", user = toucher, progress = 0)
+            message += "\nAmazingly, you finally find the :touchesthebeacon:, right in the last place you look: your back pocket! Don't misplace it next time!"
 
-            await channel.send(message)
+        else:
+            # failed to find the beacon
+            message += "\nDespite all your efforts, wardrobes opened, chests unlocked, and display cases upturned, you still haven't found the beacon!"
+            log_event(DEBUG, "beacon.cooldown", "{user} cooldown set to 1 day", user = toucher, cooldown = "1 day")
 
-        session.close()
+        response.add(message)
         return
     
-    if user.beacon_cd is not None:
+    if result.kind == "peeved":
         # cooldown active for pissing off meridia
-        log(get_time() + " >> " + str(toucher) + " tried to touch the beacon in GUILD[" + str(channel.guild) + "], CHANNEL[" + str(channel) + "]")
+        log_event(INFO, "beacon.touch", "{user} tried to touch the beacon in GUILD[{guild}], CHANNEL[{channel}]", user = toucher, guild = channel.guild, channel = channel, outcome = result.kind)
 
-        await channel.send("*Meridia's voice does not grace you. It seems that she is still a little peeved by your mistreatment of the beacon.*", delete_after = 60)
-
-        session.close()
+        response.add("*Meridia's voice does not grace you. It seems that she is still a little peeved by your mistreatment of the beacon.*", delete_after = 60)
         return
 
 
-    log(get_time() + " >> " + str(toucher) + " has touched the beacon in GUILD[" + str(channel.guild) + "], CHANNEL[" + str(channel) + "]")
-
-    user.touch_beacon(session)
-    beacon_result = beacon_roll()
+    beacon_result = result.rolls
 
-    log("                        Touch #" + str(user.beacon_touches) + ", Rolls: " + str(beacon_result[0]) + "|" + str(beacon_result[1]) + "|" + str(beacon_result[2]))
+    log_event(INFO, "beacon.touch", "{user} has touched the beacon in GUILD[{guild}], CHANNEL[{channel}] (touch #{touches}, rolls {rolls})", user = toucher, guild = channel.guild, channel = channel, outcome = result.kind, touches = result.touches, rolls = beacon_result, electrum = result.electrum)
 
     # Decide the message used for touching the beacon
-    if user.beacon_touches == 1:
+    if result.touches == 1:
         message = "**A NEW HAND TOUCHES THE BEACON!**"
-    elif user.beacon_touches == 2:
+    elif result.touches == 2:
         message = "**A NEW HAND TOUCHES THE BEACON.**"
-    elif user.beacon_touches == 3:
+    elif result.touches == 3:
         message = "**" + toucher.mention + " TOUCHES THE BEACON.**"
-    elif user.beacon_touches == 4:
+    elif result.touches == 4:
         message = "**" + toucher.mention + " TOUCHES THE BEACON AGAIN.**"
-    elif user.beacon_touches == 5:
+    elif result.touches == 5:
         message = "**" + toucher.mention + " TOUCHES THE BEACON. AGAIN.**"
-    elif user.beacon_touches == 6:
+    elif result.touches == 6:
         message = "**" + toucher.mention + " TOUCHES THE BEACON. AGAIN...**"
     else:
-        message = "**" + toucher.mention + " TOUCHES THE BEACON. AGAIN. FOR THE " + ordinal(user.beacon_touches) + " TIME.**"
-    message += "\n`| " + str(beacon_result[0]) + " | " + str(beacon_result[1]) + " | " + str(beacon_result[2]) + " |`"
-    await channel.send(message, delete_after = 60)
+        message = "**" + toucher.mention + " TOUCHES THE BEACON. AGAIN. FOR THE " + ordinal(result.touches) + " TIME.**"
+    message += "\n`| " + " | ".join(str(roll) for roll in beacon_result) + " |`"
+    response.add(message, delete_after = 60)
 
-    # If connected to a voice channel, play meridia.ogg
-    if toucher.voice:
-        await play_audio(toucher.voice.channel, "meridia")
-    
-    if beacon_result[0] == 1:
-        # Sorted descending; if first is 1, then all are 1
+    if result.outcome == LOSE:
         # Lose the beacon; progress -1
-        await channel.send("**THAT IS ENOUGH, " + toucher.mention + ". I AM--WAIT. WHERE DID YOU PUT THE BEACON?**\nYou search your inventory; it was right there just a moment ago!\n***HOW DID YOU EVEN MANAGE TO LOSE MY BEACON?!*** **FIND IT, AND I MAY FORGIVE YOU YET.**")
-        user.dawnbreaker(session, -1)
-        log("                     >> " + str(toucher) + " Dawnbreaker progress set to -1")
-
-        session.close()
+        response.add("**THAT IS ENOUGH, " + toucher.mention + ". I AM--WAIT. WHERE DID YOU PUT THE BEACON?**\nYou search your inventory; it was right there just a moment ago!\n***HOW DID YOU EVEN MANAGE TO LOSE MY BEACON?!*** **FIND IT, AND I MAY FORGIVE YOU YET.**")
+        log_event(DEBUG, "beacon.progress", "{user} Dawnbreaker progress set to -1", user = toucher, progress = -1)
         return
 
-    if beacon_result[0] < 10:
-        # Sorted descending; if first is 1 digit, then all are 1 digit
+    if result.outcome == COOLDOWN:
         # 10 min cooldown
-        await channel.send("**THAT IS ENOUGH, " + toucher.mention + ". I AM DISHEARTENED BY YOUR MISTREATMENT OF MY BEACON.**")
-        user.set_cd(session, timedelta(minutes = 10))
-        log("                     >> " + str(toucher) + " cooldown set to 10 minutes")
-
-        session.close()
+        response.add("**THAT IS ENOUGH, " + toucher.mention + ". I AM DISHEARTENED BY YOUR MISTREATMENT OF MY BEACON.**")
+        log_event(DEBUG, "beacon.cooldown", "{user} cooldown set to 10 minutes", user = toucher, cooldown = "10 minutes")
         return
         
-    if beacon_result[1] == 20:
-        # Sorted descending; first num guaranteed to be 20
-        if beacon_result[2] == 20:
+    if result.outcome in (PROGRESS, DAWNBREAKER):
+        if result.outcome == DAWNBREAKER:
             # PULL THE DAWNBREAKER
-            user.dawnbreaker(session, 20)
-            log("                     >> " + str(toucher) + " Dawnbreaker progress set to 20")
-            user.add_electrum(session, 50)
-            log("                     >> 50 electrum imbursed to " + str(toucher))
+            log_event(DEBUG, "beacon.progress", "{user} Dawnbreaker progress set to 20, and 50 electrum imbursed", user = toucher, progress = 20, electrum = 50)
 
-            await channel.send(toucher.mention + "\n*Malkoran is vanquished. Skyrim's dead shall remain at rest. This is as it should be. This is because of you. A new day is dawning. And you shall be its herald. Take the mighty Dawnbreaker and with it purge corruption from the dark corners of the world. Wield it in my name, that my influence may grow.*\n__+50 Electrum__")
-            session.close()
+            response.add(toucher.mention + "\n*Malkoran is vanquished. Skyrim's dead shall remain at rest. This is as it should be. This is because of you. A new day is dawning. And you shall be its herald. Take the mighty Dawnbreaker and with it purge corruption from the dark corners of the world. Wield it in my name, that my influence may grow.*\n__+50 Electrum__")
             return
 
         # Increase Dawnbreaker progress
-        if user.dawnbreaker_progess < 19:
-            user.dawnbreaker(session, user.dawnbreaker_progess + 1)
-            log("                     >> " + str(toucher) + " Dawnbreaker progress set to " + str(user.dawnbreaker_progess))
+        if result.progressed:
+            log_event(DEBUG, "beacon.progress", "{user} Dawnbreaker progress set to {progress}, and 1 electrum imbursed", user = toucher, progress = result.progress, electrum = 1)
         else:
-            log("                     >> " + str(toucher) + " Dawnbreaker progress is already max at 19")
-        user.add_electrum(session, 1)
-        log("                     >> 1 electrum imbursed to " + str(toucher))
-        await channel.send(toucher.mention + "\n" + quest_dialogue[user.dawnbreaker_progess] + "\n__+1 Electrum__")
-
-    session.close()
+            log_event(DEBUG, "beacon.progress", "{user} Dawnbreaker progress is already max at 19, but 1 electrum imbursed", user = toucher, progress = result.progress, electrum = 1)
+        response.add(toucher.mention + "\n" + quest_dialogue[result.progress] + "\n__+1 Electrum__")
 
-@bot_client.listen("on_message")
+@message_trigger(":touchesthebeacon:")
 async def beacon_touch_message(message: Message):
     '''
     Detects when a beacon is touched from a user message.
     '''
 
-    if message.author.bot:
-        return
-    
-    if ":touchesthebeacon:" in message.content:
-        await beacon_touch(message.channel, message.author)
+    await beacon_touch(message.channel, message.author)
 
 @bot_client.listen("on_raw_reaction_add")
 async def beacon_touch_reaction(payload: RawReactionActionEvent):
@@ -244,5 +345,8 @@ async def beacon_touch_command(context: ApplicationContext):
     Adds the command /touchthebeacon
     '''
 
-    await context.respond("You touch the beacon.", delete_after = 60)
+    response = await context.respond("You touch the beacon.")
+    # Deleted by the scheduler like every other beacon reply, so that it is still deleted after a restart
+    message = await response.original_response() if isinstance(response, Interaction) else response
+    await message_deletions.schedule(message, 60)
     await beacon_touch(context.channel, context.author)
\ No newline at end of file
@@ -0,0 +1,109 @@
+'''Contains the rules of touching the beacon as plain constants and functions, shared by beacon.py and the offline simulator (simulate.py)'''
+
+from typing import List, Sequence
+from datetime import timedelta
+from itertools import product
+
+touch_dice = 3
+'''Number of dice rolled on every beacon touch'''
+touch_sides = 20
+'''Number of sides per die rolled on a beacon touch'''
+search_sides = 20
+'''Number of sides of the die rolled to search for a lost beacon; found only on the highest roll'''
+
+lost_progress = -1
+'''Dawnbreaker progress of a user who lost the beacon'''
+found_progress = 0
+'''Dawnbreaker progress of a user who found the beacon again'''
+max_quest_progress = 19
+'''Highest Dawnbreaker progress reachable by progressing the quest; only the Dawnbreaker itself goes beyond'''
+dawnbreaker_progress = 20
+'''Dawnbreaker progress of a user who obtained the Dawnbreaker'''
+
+touch_cooldown = timedelta(minutes = 10)
+'''Cooldown after rolling only single digits'''
+search_cooldown = timedelta(days = 1)
+'''Cooldown after failing to find the beacon'''
+
+NOTHING = 0
+'''Outcome of a touch with no effect'''
+PROGRESS = 1
+'''Outcome of a touch that progresses the quest; two or more of the highest roll'''
+DAWNBREAKER = 2
+'''Outcome of a touch that obtains the Dawnbreaker; all dice the highest roll'''
+COOLDOWN = 3
+'''Outcome of a touch that angers Meridia; all dice single digits'''
+LOSE = 4
+'''Outcome of a touch that loses the beacon; all dice 1'''
+
+outcome_electrum = {NOTHING: 0, PROGRESS: 1, DAWNBREAKER: 50, COOLDOWN: 0, LOSE: 0}
+'''Electrum rewarded for each outcome'''
+
+
+def touch_outcome(rolls: Sequence[int]) -> int:
+    '''
+    Decides the outcome of a single beacon touch
+
+    ### Parameters
+    rolls: Sequence[int]
+        Results of the touch_dice dice, sorted from highest to lowest
+
+    ### Returns
+    One of NOTHING, PROGRESS, DAWNBREAKER, COOLDOWN, or LOSE
+    '''
+
+    if rolls[0] == 1:
+        # Sorted descending; if first is 1, then all are 1
+        return LOSE
+    if rolls[0] < 10:
+        # Sorted descending; if first is 1 digit, then all are 1 digit
+        return COOLDOWN
+    if rolls[1] == touch_sides:
+        # Sorted descending; first num guaranteed to be the highest roll
+        return DAWNBREAKER if rolls[-1] == touch_sides else PROGRESS
+    return NOTHING
+
+def search_succeeds(roll: int) -> bool:
+    '''
+    Decides whether a search for a lost beacon finds it
+
+    ### Parameters
+    roll: int
+        Result of the single search_sides die
+    '''
+
+    return roll == search_sides
+
+def progress_after(progress: int, outcome: int) -> int:
+    '''
+    Decides the Dawnbreaker progress of a user after a touch with the beacon in hand
+
+    ### Parameters
+    progress: int
+        Dawnbreaker progress before the touch; found_progress through max_quest_progress
+
+    outcome: int
+        Outcome of the touch, as given by touch_outcome()
+    '''
+
+    if outcome == LOSE:
+        return lost_progress
+    if outcome == DAWNBREAKER:
+        return dawnbreaker_progress
+    if outcome == PROGRESS:
+        return min(progress + 1, max_quest_progress)
+    return progress
+
+def outcome_table() -> List[int]:
+    '''
+    Tabulates touch_outcome() for every possible combination of unsorted rolls, so that many touches can be decided at once by indexing, without restating the rules
+
+    ### Returns
+    Outcome of each combination, at index sum((roll - 1) * touch_sides ** i) over the i-th die
+    '''
+
+    table = [NOTHING] * touch_sides ** touch_dice
+    for rolls in product(range(1, touch_sides + 1), repeat = touch_dice):
+        index = sum((roll - 1) * touch_sides ** i for i, roll in enumerate(rolls))
+        table[index] = touch_outcome(sorted(rolls, reverse = True))
+    return table
@@ -1,9 +1,16 @@
 '''Contains global bot object & Database connection manager'''
 
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, TypeVar, Any, Iterator
+
 import discord
 import discord.ext.commands as discomm
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from sqlalchemy import create_engine, event, Engine
+from sqlalchemy.orm import DeclarativeBase, sessionmaker, Session
+
+from auxiliary import load_settings
 
 # Global bot object
 intents = discord.Intents.default()
@@ -15,20 +22,98 @@ bot_client = discomm.Bot(intents = intents)
 
 
 # Database stuff (SQLite and SQLAlchemy)
-database_engine = create_engine("sqlite:///database/db.sqlite")
+storage_profiles: Dict[str, Dict[str, Any]] = {
+    # What SQLite does when told nothing
+    "default": {"journal_mode": "DELETE", "synchronous": "FULL", "mmap_size": 0, "cache_size": -2000, "busy_timeout": 0, "cached_statements": 128},
+    # Write-ahead log, only synced at checkpoints; a power loss can lose the last few commits, but never corrupts the database
+    "tuned": {"journal_mode": "WAL", "synchronous": "NORMAL", "mmap_size": 256 * 1024 * 1024, "cache_size": -64 * 1024, "busy_timeout": 5000, "cached_statements": 512}
+}
+'''Named sets of SQLite settings; cache_size is in pages if positive, or KiB if negative'''
+storage_pragmas = ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout")
+'''Settings of a storage profile that are applied as PRAGMAs'''
+
+storage_settings = load_settings("storage", {"profile": "tuned"})
+storage_profile: Dict[str, Any] = {**storage_profiles[storage_settings["profile"]], **{name: value for name, value in storage_settings.items() if name != "profile"}}
+'''Storage profile of the database: the named profile, with any setting overridden by settings/storage.json'''
+
+def create_database_engine(path: str, profile: Dict[str, Any]) -> Engine:
+    '''
+    Creates an engine for an SQLite database, applying a storage profile to every connection it opens
+
+    ### Parameters
+    path: str
+        Path of the database file
+
+    profile: Dict[str, Any]
+        Storage profile, as in storage_profiles
+
+    ### Returns
+    The new engine
+    '''
+
+    engine = create_engine("sqlite:///" + path, connect_args = {"cached_statements": int(profile["cached_statements"])})
+
+    @event.listens_for(engine, "connect")
+    def apply_storage_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in storage_pragmas:
+            cursor.execute("PRAGMA " + pragma + " = " + str(profile[pragma]))
+        cursor.close()
+
+    return engine
+
+database_engine = create_database_engine("database/db.sqlite", storage_profile)
 database_connector = sessionmaker(database_engine, autocommit = False, autoflush = False)
-'''To use, do "with database_connector() as session:"'''
+'''Prefer session_scope(), which also commits; to use directly, do "with database_connector() as session:"'''
 
-class SQLBase(DeclarativeBase):
+@contextmanager
+def session_scope() -> Iterator[Session]:
     '''
-    Used for all SQLAlchemy ORM classes
+    Unit of work around a single event: all changes staged on the session are committed exactly once on exit, or rolled back if an exception is raised.
+
+    ORM methods in dbmodels only stage changes; this is what commits them.
+    To use, do "with session_scope() as session:"
     '''
-    pass
 
-def db_init() -> None:
+    with database_connector() as session:
+        try:
+            yield session
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+
+database_executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "database")
+'''Single thread that all database work from event handlers runs on, so that queries and commits never block the event loop'''
+
+T = TypeVar("T")
+
+async def run_db(work: Callable[..., T], *args: Any) -> T:
     '''
-    Resets the database. Call this only once per structure change.
+    Runs a blocking database function on the database thread, and waits for its result without blocking the event loop.
+
+    Since there is only one database thread, jobs run one at a time, in the order they were submitted.
+
+    ### Parameters
+    work: Callable[..., T]
+        Function to run; called as work(session, *args) inside its own session_scope, so its changes are committed once when it returns, or rolled back if it raises.
+        Should return plain values rather than ORM objects, as those are expired and detached once the session closes.
+
+    *args: Any
+        Extra arguments passed on to work
+
+    ### Returns
+    Whatever work returns; exceptions raised by work are raised here instead
     '''
 
-    SQLBase.metadata.drop_all(database_engine)
-    SQLBase.metadata.create_all(database_engine)
\ No newline at end of file
+    def job() -> T:
+        with session_scope() as session:
+            return work(session, *args)
+
+    return await get_running_loop().run_in_executor(database_executor, job)
+
+class SQLBase(DeclarativeBase):
+    '''
+    Used for all SQLAlchemy ORM classes
+    '''
+    pass
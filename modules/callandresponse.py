@@ -2,69 +2,59 @@
 
 from discord import Message, Forbidden, HTTPException
 
-from bot import bot_client
-from auxiliary import log, get_time, play_audio
+from triggers import message_trigger
+from auxiliary import log_event, INFO, WARNING, ERROR
+from voice import play_audio
 
-@bot_client.listen("on_message")
+# Bots and people not in vc are filtered out by the trigger dispatcher
+
+@message_trigger("die", "kill yourself", voice_only = True)
 async def no_u(message: Message):
     '''If either 'die' or 'kill yourself' are messaged, disconnect user and play suicide.ogg'''
 
-    # Disable for bots and people not in vc
-    if message.author.bot or message.author.voice is None or message.author.voice.channel is None:
-        return
-    
-    if "die" in message.content.lower() or "kill yourself" in message.content.lower():
-        log(get_time() + " >> " + str(message.author) + " is being NO U'ed in GUILD[" + str(message.guild) + "], CHANNEL[" + str(message.channel) + "]")
-        try:
-            # Disconnect user by setting voice channel to none
-            vc = message.author.voice.channel
-            await message.author.edit(voice_channel = None)
-        except Forbidden:
-            log("ERROR HAS OCCURRED   >> Meridia couldn't disconnect " + str(message.author) + "!")
-        except HTTPException:
-            log("ERROR HAS OCCURRED   >> " + str(message.author) + " was not in vc!")
-        else:
-            await message.channel.send("no u", reference = message)
-            await play_audio(vc, "suicide")
-
-
-@bot_client.listen("on_message")
+    log_event(INFO, "response.no_u", "{user} is being NO U'ed in GUILD[{guild}], CHANNEL[{channel}]", user = message.author, guild = message.guild, channel = message.channel)
+    try:
+        # Disconnect user by setting voice channel to none
+        vc = message.author.voice.channel
+        await message.author.edit(voice_channel = None)
+    except Forbidden:
+        log_event(ERROR, "response.no_u", "Meridia couldn't disconnect {user}!", user = message.author, guild = message.guild, channel = message.channel, outcome = "forbidden")
+    except HTTPException:
+        log_event(WARNING, "response.no_u", "{user} was not in vc!", user = message.author, guild = message.guild, channel = message.channel, outcome = "not in vc")
+    else:
+        await message.channel.send("no u", reference = message)
+        # Follows a channel change, so should not wait behind other clips
+        await play_audio(vc, "suicide", priority = 1)
+
+
+@message_trigger("rise", voice_only = True)
 async def rise(message: Message):
     '''If 'rise' is messaged, raise user by one voice call and play rise.ogg'''
 
-    # Disable for bots and people not in vc
-    if message.author.bot or message.author.voice is None or message.author.voice.channel is None:
-        return
-    
-    if "rise" in message.content.lower():
-        log(get_time() + " >> Tarnished " + str(message.author) + " is being risen in GUILD[" + str(message.guild) + "], CHANNEL[" + str(message.channel) + "]")
-        try:
-            # test if user is in the top voice channel
-            vc_list = message.author.guild.voice_channels
-            current_index = vc_list.index(message.author.voice.channel)
-            if current_index == 0:
-                log("ERROR HAS OCCURRED   >> " + str(message.author) + " is already in the top channel!")
-                return
-            
-            # get vc right above it and set user's vc to that
-            await message.author.edit(voice_channel = vc_list[current_index - 1])
-        except Forbidden:
-            log("ERROR HAS OCCURRED   >> Meridia couldn't move " + str(message.author) + "!")
-        except HTTPException:
-            log("ERROR HAS OCCURRED   >> " + str(message.author) + " was not in vc!")
-        else:
-            await message.channel.send("OHHhh, RISE NOW, YE TARNISHED. Ye *DEAD*, who yet *LIVE*.\nThe call of long-lost grace *speaks to us all*.", reference = message)
-            await play_audio(vc_list[current_index], "rise")
-
-@bot_client.listen("on_message")
+    log_event(INFO, "response.rise", "Tarnished {user} is being risen in GUILD[{guild}], CHANNEL[{channel}]", user = message.author, guild = message.guild, channel = message.channel)
+    try:
+        # test if user is in the top voice channel
+        vc_list = message.author.guild.voice_channels
+        current_index = vc_list.index(message.author.voice.channel)
+        if current_index == 0:
+            log_event(WARNING, "response.rise", "{user} is already in the top channel!", user = message.author, guild = message.guild, channel = message.channel, outcome = "top channel")
+            return
+
+        # get vc right above it and set user's vc to that
+        await message.author.edit(voice_channel = vc_list[current_index - 1])
+    except Forbidden:
+        log_event(ERROR, "response.rise", "Meridia couldn't move {user}!", user = message.author, guild = message.guild, channel = message.channel, outcome = "forbidden")
+    except HTTPException:
+        log_event(WARNING, "response.rise", "{user} was not in vc!", user = message.author, guild = message.guild, channel = message.channel, outcome = "not in vc")
+    else:
+        await message.channel.send("OHHhh, RISE NOW, YE TARNISHED. Ye *DEAD*, who yet *LIVE*.\nThe call of long-lost grace *speaks to us all*.", reference = message)
+        # Follows a channel change, so should not wait behind other clips
+        await play_audio(vc_list[current_index], "rise", priority = 1)
+
+@message_trigger("sandstorm", voice_only = True)
 async def sandstorm(message: Message):
     '''If 'sandstorm' is messaged, play sandstorm.ogg'''
 
-    # Disable for bots and people not in vc
-    if message.author.bot or message.author.voice is None or message.author.voice.channel is None:
-        return
-    
-    if "sandstorm" in message.content.lower():
-        log(get_time() + " >> " + str(message.author) + " is being surprise daruded in GUILD[" + str(message.guild) + "], CHANNEL[" + str(message.channel) + "]")
+    log_event(INFO, "response.sandstorm", "{user} is being surprise daruded in GUILD[{guild}], CHANNEL[{channel}]", user = message.author, guild = message.guild, channel = message.channel)
 
-        await play_audio(message.author.voice.channel, "sandstorm")
\ No newline at end of file
+    await play_audio(message.author.voice.channel, "sandstorm")
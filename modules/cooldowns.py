@@ -0,0 +1,147 @@
+'''Contains the beacon cooldowns of every user, kept in memory so that users on cooldown are turned away without reading the database'''
+
+from typing import Dict, List, Optional, Tuple, Any
+from datetime import datetime
+from heapq import heappush, heappop
+
+from bot import bot_client, run_db
+from auxiliary import log_event, INFO
+from usercache import user_cache, user_listeners
+from dbmodels import User
+from beaconrules import dawnbreaker_progress
+
+
+class Cooldowns:
+    '''
+    Beacon cooldowns still running, of users still on the quest; mirrored from the user cache as users change,
+    which also saves every change to the database.
+
+    Each end is kept by user, to answer in O(1), and in a heap by time, so that ended cooldowns are dropped in batches.
+    Heap entries of a user whose cooldown has since changed are skipped as they come up.
+
+    ### Attributes
+    ends: Dict[int, Tuple[datetime, int]]
+        End of the cooldown, and Dawnbreaker progress, of each user on cooldown
+
+    expiry: List[Tuple[datetime, int]]
+        Heap of (end of cooldown, Discord ID)
+
+    loaded: bool
+        Whether the cooldowns have been read from the database yet
+
+    pending: List[Dict[str, Any]] | None
+        Changes to replay once a read of the database finishes; None when not reading
+
+    ### Methods
+    set(id: int, end: datetime | None, progress: int) -> None
+        Tracks the cooldown of a user
+
+    changed(row: Dict[str, Any]) -> None
+        Applies the new state of a user
+
+    expire(now: datetime) -> None
+        Drops every cooldown that has ended
+
+    active(id: int) -> Tuple[datetime, int] | None
+        Returns the cooldown of a user, if they are known to be on one
+
+    async load() -> None
+        Reads every running cooldown from the database
+    '''
+
+    def __init__(self) -> None:
+        self.ends: Dict[int, Tuple[datetime, int]] = {}
+        self.expiry: List[Tuple[datetime, int]] = []
+        self.loaded = False
+        self.pending: Optional[List[Dict[str, Any]]] = None
+
+    def set(self, id: int, end: Optional[datetime], progress: int) -> None:
+        '''
+        Tracks the cooldown of a user, or stops tracking it if there is none or the user has the Dawnbreaker
+        '''
+
+        if end is None or progress == dawnbreaker_progress:
+            self.ends.pop(id, None)
+            return
+
+        current = self.ends.get(id)
+        if current is None or current[0] != end:
+            heappush(self.expiry, (end, id))
+        self.ends[id] = (end, progress)
+
+    def changed(self, row: Dict[str, Any]) -> None:
+        '''
+        Applies the new state of a user; registered as a user listener
+
+        ### Parameters
+        row: Dict[str, Any]
+            Column values of the user, as given by usercache.CachedUser.row()
+        '''
+
+        if self.pending is not None:
+            self.pending.append(row)
+        if self.loaded:
+            self.set(row["id"], row["beacon_cd"], row["dawnbreaker_progess"])
+
+    def expire(self, now: datetime) -> None:
+        '''
+        Drops every cooldown that has ended, in one pass over the front of the heap
+        '''
+
+        while self.expiry and self.expiry[0][0] < now:
+            end, id = heappop(self.expiry)
+            current = self.ends.get(id)
+            if current is not None and current[0] == end:
+                del self.ends[id]
+
+    def active(self, id: int) -> Optional[Tuple[datetime, int]]:
+        '''
+        Returns the cooldown of a user, if they are known to be on one; never reads the database
+
+        ### Parameters
+        id: int
+            Discord user ID
+
+        ### Returns
+        (end of cooldown, Dawnbreaker progress) of the user; None if they are not on cooldown, or cooldowns are not loaded yet
+        '''
+
+        if not self.loaded:
+            return None
+        self.expire(datetime.utcnow())
+        return self.ends.get(id)
+
+    async def load(self) -> None:
+        '''
+        Reads every running cooldown from the database
+
+        The database lags behind the user cache, so changes not yet written, and any made during the read, are applied on top.
+        '''
+
+        self.pending = user_cache.changed_rows()
+        try:
+            found = await run_db(User.cooldowns, datetime.utcnow())
+        finally:
+            pending, self.pending = self.pending, None
+
+        self.ends = {}
+        self.expiry = []
+        for id, end, progress in found:
+            self.set(id, end, progress)
+        for row in pending:
+            self.set(row["id"], row["beacon_cd"], row["dawnbreaker_progess"])
+        self.loaded = True
+        log_event(INFO, "beacon.cooldowns", "Loaded {count} beacon cooldowns", count = len(self.ends))
+
+beacon_cooldowns = Cooldowns()
+'''Beacon cooldowns of every user'''
+user_listeners.append(beacon_cooldowns.changed)
+
+@bot_client.listen("on_ready")
+async def load_cooldowns():
+    '''
+    Reads the running cooldowns once connected
+    '''
+
+    if not beacon_cooldowns.loaded:
+        await beacon_cooldowns.load()
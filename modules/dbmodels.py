@@ -1,9 +1,10 @@
 '''Contains all SQLAlchemy ORM models'''
 
-from typing import List, Optional, Tuple, Dict
+from typing import List, Optional, Tuple, Dict, Any, ClassVar
 from datetime import datetime, timedelta
 
-from sqlalchemy import ForeignKey, select, insert, update, delete
+from sqlalchemy import ForeignKey, Index, func, select, insert, update, delete, bindparam, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Mapped, mapped_column, relationship, Session
 
 from bot import SQLBase
@@ -14,12 +15,15 @@ class User(SQLBase):
     '''
     Represents the saved data corresponding to a single discord user.
 
+    Methods only stage changes on the given session; they are committed once by the bot.session_scope() around the event.
+    Outside of the database thread, use usercache.user_cache instead, which owns the state of these columns.
+
     ### Attributes
     [PRIMARY] id: str
         Corresponds to Discord user ID
 
     electrum: int
-        Currency for this bot, per user
+        Currency for this bot, per user; materialized balance of this user's entries in the electrum ledger
 
     beacon_touches: int
         How many times this user has touched the beacon
@@ -31,14 +35,35 @@ class User(SQLBase):
         The end time for a cooldown for various beacon-related things
 
     [BACKREF] char_inv: List[CollectedCharacter]
-        List of characters this User owns
+        List of characters this User owns; raises instead of loading, so only use it on explicitly loaded users
         
     ### Methods
     [STATIC] find_user(session: Session, id: str) -> User
         Returns the User object corresponding to the given Discord ID
 
-    add_electrum(session: Session, electrum: int) -> None
-        Adds a number of electrum pieces to user's currency
+    [STATIC] create_missing(session: Session, ids: List[int]) -> None
+        Creates default user data for every given Discord ID that has none
+
+    [STATIC] transfer(session: Session, sender_id: int, amounts: Dict[int, int]) -> Dict[int, int] | None
+        Moves electrum from one user to any number of others in SQL, only if the sender can afford all of it
+
+    [STATIC] debit(session: Session, user_id: int, amount: int, reason: str) -> int | None
+        Takes electrum from a user in SQL, only if they have enough of it
+
+    [STATIC] credit(session: Session, amounts: Dict[int, int], reason: str) -> Dict[int, int]
+        Adds electrum to any number of users in SQL, creating any that do not exist yet
+
+    [STATIC] top(session: Session, column: str, limit: int) -> List[Tuple[int, int]]
+        Returns the users with the highest positive values of a column
+
+    [STATIC] dawnbreaker_holders(session: Session) -> List[int]
+        Returns the Discord IDs of every user who has obtained the Dawnbreaker
+
+    [STATIC] cooldowns(session: Session, now: datetime) -> List[Tuple[int, datetime, int]]
+        Returns every cooldown still running of users on the quest
+
+    add_electrum(session: Session, electrum: int, reason: str) -> None
+        Adds a number of electrum pieces to user's currency, recording it in the ledger
 
     touch_beacon(session: Session) -> None
         Increments beacons touched by 1 for this user
@@ -54,11 +79,13 @@ class User(SQLBase):
     '''
 
     __tablename__ = "user"
+    # For leaderboards, rebuilt by scanning these in order
+    __table_args__ = (Index("ix_user_electrum", "electrum"), Index("ix_user_beacon_touches", "beacon_touches"), Index("ix_user_dawnbreaker_progess", "dawnbreaker_progess"))
 
     id: Mapped[int] = mapped_column(primary_key = True)
     '''Corresponds to Discord user ID'''
     electrum: Mapped[int] = mapped_column(default = 0)
-    '''Currency for this bot, per user'''
+    '''Currency for this bot, per user; materialized balance of this user's entries in the electrum ledger'''
 
     beacon_touches: Mapped[int] = mapped_column(default = 0)
     '''How many times this user has touched the beacon'''
@@ -67,7 +94,8 @@ class User(SQLBase):
     beacon_cd: Mapped[Optional[datetime]]
     '''The end time for a cooldown for various beacon-related things'''
 
-    char_inv: Mapped[List["CollectedCharacter"]] = relationship(back_populates = "owner", cascade = "all, delete-orphan", passive_deletes = True)
+    # Never loaded implicitly, as an inventory can have thousands of rows; page through it with CollectedCharacter.page() instead
+    char_inv: Mapped[List["CollectedCharacter"]] = relationship(back_populates = "owner", cascade = "all, delete-orphan", passive_deletes = True, lazy = "raise_on_sql")
     '''List of characters this User owns'''
 
     @staticmethod
@@ -95,14 +123,210 @@ class User(SQLBase):
             # Create new default user data if no matching user data found
             new_user = User(id = id)
             session.add(new_user)
-            session.commit()
+            # Flush (not commit) so that later queries in the same unit of work can find it
+            session.flush()
             return new_user
         else:
             return found_user
 
-    def add_electrum(self, session: Session, electrum: int) -> None:
+    @staticmethod
+    def create_missing(session: Session, ids: List[int]) -> None:
+        '''
+        Creates default user data for every given Discord ID that has none, in a single statement
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        ids: List[int]
+            Discord user IDs
+        '''
+
+        if ids:
+            session.execute(sqlite_insert(User).on_conflict_do_nothing(index_elements = [User.id]), [{"id": id} for id in ids])
+
+    @staticmethod
+    def transfer(session: Session, sender_id: int, amounts: Dict[int, int]) -> Optional[Dict[int, int]]:
+        '''
+        Moves electrum from one user to any number of others, only if the sender can afford all of it.
+
+        Done with conditional UPDATEs in the database rather than in Python, so it cannot race with other transfers.
+        Bypasses the user cache; call through usercache.user_cache.run_sql().
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        sender_id: int
+            Discord user ID to take electrum from
+
+        amounts: Dict[int, int]
+            Discord user ID of each recipient, and the non-negative amount they receive
+
+        ### Returns
+        New balance of the sender and every recipient by Discord ID, or None if the sender does not have enough electrum (nothing is changed)
+        '''
+
+        balance = User.debit(session, sender_id, sum(amounts.values()), "gift")
+        if balance is None:
+            return None
+
+        balances = User.credit(session, amounts, "gift")
+        # If the sender also received some, credit() already read their final balance
+        balances.setdefault(sender_id, balance)
+        return balances
+
+    @staticmethod
+    def debit(session: Session, user_id: int, amount: int, reason: str) -> Optional[int]:
         '''
-        Adds a number of electrum pieces to user's currency
+        Takes electrum from a user, only if they have enough of it, and records it in the ledger.
+
+        Done with a conditional UPDATE in the database rather than in Python, so it cannot race with other debits.
+        Bypasses the user cache; call through usercache.user_cache.run_sql().
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        user_id: int
+            Discord user ID to take electrum from
+
+        amount: int
+            Non-negative amount to take
+
+        reason: str
+            Why the balance changed; see LedgerEntry.reason
+
+        ### Returns
+        New balance of the user, or None if they do not have enough electrum (nothing is changed)
+        '''
+
+        User.create_missing(session, [user_id])
+
+        # Only takes the electrum if there is enough of it
+        taken = session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .where(User.electrum >= amount)
+            .values(electrum = User.electrum - amount)
+            .returning(User.electrum)
+            .execution_options(synchronize_session = False)
+            ).scalar()
+        if taken is None:
+            return None
+
+        LedgerEntry.record(session, [LedgerEntry.entry(user_id, -amount, reason, taken, datetime.utcnow())])
+        return taken
+
+    @staticmethod
+    def credit(session: Session, amounts: Dict[int, int], reason: str) -> Dict[int, int]:
+        '''
+        Adds electrum to any number of users with a single batched UPDATE, creating any that do not exist yet, and records it in the ledger.
+
+        Bypasses the user cache; call through usercache.user_cache.run_sql().
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        amounts: Dict[int, int]
+            Discord user ID of each user, and the non-negative amount they receive
+
+        reason: str
+            Why the balances changed; see LedgerEntry.reason
+
+        ### Returns
+        New balance of every user by Discord ID
+        '''
+
+        if not amounts:
+            return {}
+
+        User.create_missing(session, list(amounts))
+        session.execute(
+            update(User.__table__)
+            .where(User.__table__.c.id == bindparam("recipient"))
+            .values(electrum = User.__table__.c.electrum + bindparam("amount")),
+            [{"recipient": id, "amount": amount} for id, amount in amounts.items()]
+            )
+
+        balances = {id: electrum for id, electrum in session.execute(
+            select(User.id, User.electrum)
+            .where(User.id.in_(list(amounts)))
+            ).all()}
+
+        now = datetime.utcnow()
+        LedgerEntry.record(session, [LedgerEntry.entry(id, amount, reason, balances[id], now) for id, amount in amounts.items()])
+
+        return balances
+
+    @staticmethod
+    def top(session: Session, column: str, limit: int) -> List[Tuple[int, int]]:
+        '''
+        Returns the users with the highest positive values of a column; reads only as far down its index as needed
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        column: str
+            Name of the column to rank by, i.e. "electrum" or "beacon_touches"
+
+        limit: int
+            Maximum number of users to return
+
+        ### Returns
+        (Discord ID, value) of each user, from highest to lowest value
+        '''
+
+        ranked = getattr(User, column)
+        return [tuple(row) for row in session.execute(
+            select(User.id, ranked)
+            .where(ranked > 0)
+            .order_by(ranked.desc())
+            .limit(limit)
+            ).all()]
+
+    @staticmethod
+    def dawnbreaker_holders(session: Session) -> List[int]:
+        '''
+        Returns the Discord IDs of every user who has obtained the Dawnbreaker (progress 20)
+
+        ### Parameters
+        session: Session
+            Database session scope
+        '''
+
+        return list(session.execute(
+            select(User.id)
+            .where(User.dawnbreaker_progess == 20)
+            ).scalars().all())
+
+    @staticmethod
+    def cooldowns(session: Session, now: datetime) -> List[Tuple[int, datetime, int]]:
+        '''
+        Returns every cooldown still running of users on the quest; cooldowns that have passed but were never reset are left out
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        now: datetime
+            Current time
+
+        ### Returns
+        (Discord ID, end of cooldown, Dawnbreaker progress) of each user on cooldown
+        '''
+
+        return [tuple(row) for row in session.execute(
+            select(User.id, User.beacon_cd, User.dawnbreaker_progess)
+            .where(User.beacon_cd >= now)
+            .where(User.dawnbreaker_progess != 20)
+            ).all()]
+
+    def add_electrum(self, session: Session, electrum: int, reason: str) -> None:
+        '''
+        Adds a number of electrum pieces to user's currency, recording it in the ledger
 
         ### Parameters
         session: Session
@@ -111,6 +335,9 @@ class User(SQLBase):
         electrum: int
             Amount of electrum to add or remove (if negative) from account
 
+        reason: str
+            Why the balance changed; see LedgerEntry.reason
+
         ### Throws
         InvalidArgumentError
             Electrum to remove is larger than amount of electrum available
@@ -120,7 +347,7 @@ class User(SQLBase):
             raise InvalidArgumentError
         
         self.electrum += electrum
-        session.commit()
+        LedgerEntry.record(session, [LedgerEntry.entry(self.id, electrum, reason, self.electrum, datetime.utcnow())])
 
 
     def touch_beacon(self, session: Session) -> None:
@@ -133,7 +360,6 @@ class User(SQLBase):
         '''
 
         self.beacon_touches += 1
-        session.commit()
 
     def dawnbreaker(self, session: Session, progress: int) -> None:
         '''
@@ -155,7 +381,6 @@ class User(SQLBase):
             raise InvalidArgumentError
 
         self.dawnbreaker_progess = progress
-        session.commit()
 
     def set_cd(self, session: Session, time: timedelta) -> None:
         '''
@@ -170,7 +395,6 @@ class User(SQLBase):
         '''
 
         self.beacon_cd = datetime.utcnow() + time
-        session.commit()
 
     def reset_cd(self, session: Session) -> None:
         '''
@@ -182,12 +406,13 @@ class User(SQLBase):
         '''
 
         self.beacon_cd = None
-        session.commit()
 
 
 class CollectedCharacter(SQLBase):
     '''
     Represents a single collected character in a User's inventory 
+
+    Methods only stage changes on the given session; they are committed once by the bot.session_scope() around the event.
     
     ### Attributes
     [PRIMARY, FOREIGN] owner_id: int
@@ -215,6 +440,15 @@ class CollectedCharacter(SQLBase):
     [STATIC] obtain(session: Session, user_id: int, char_id: int, banner_id: int) -> None
         Create a new CollectedCharacter instance
 
+    [STATIC] collect(session: Session, banner_id: int, pulled: Dict[Tuple[int, int], int]) -> List[Tuple[int, int]]
+        Adds any number of characters to any number of inventories in a single upsert
+
+    [STATIC] sell_duplicates(session: Session, user_id: int) -> Dict[int, int]
+        Sells every duplicate in a user's inventory with a single UPDATE
+
+    [STATIC] page(session: Session, user_id: int, by_obtained: bool, after: Tuple[datetime, int] | None, limit: int) -> List[Tuple[int, datetime, int, int]]
+        Returns a page of a user's inventory, starting after a given character
+
     gain(session: Session) -> None
         Adds 1 duplicate to this character
 
@@ -223,10 +457,12 @@ class CollectedCharacter(SQLBase):
     '''
 
     __tablename__ = "collected_char"
+    # For paging through an inventory by when characters were obtained; the primary key already pages by character
+    __table_args__ = (Index("ix_collected_char_owner_obtained", "owner_id", "obtained", "char_id"),)
 
     owner_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete = "CASCADE"), primary_key = True)
     '''ID of User who owns this character'''
-    owner: Mapped["User"] = relationship(back_populates = "char_inv")
+    owner: Mapped["User"] = relationship(back_populates = "char_inv", lazy = "raise_on_sql")
     '''Direct reference to User who owns this character'''
     char_id: Mapped[int] = mapped_column(primary_key = True)
     '''ID of the character owned'''
@@ -238,7 +474,7 @@ class CollectedCharacter(SQLBase):
     '''How many duplicates of this character the User owns'''
 
     @staticmethod
-    def find(session: Session, user_id: int, char_id: int) -> "CollectedCharacter" | None:
+    def find(session: Session, user_id: int, char_id: int) -> Optional["CollectedCharacter"]:
         '''
         Find the CollectedCharacter instance that corresponds to this user and character, if it exists
 
@@ -283,13 +519,126 @@ class CollectedCharacter(SQLBase):
             Internal ID of the banner
         '''
 
-        # If already exists, then don't proceed
-        if CollectedCharacter.find(session, user_id, char_id) is not None:
-            return
+        # If already exists, then don't proceed; one statement rather than a lookup first
+        session.execute(
+            sqlite_insert(CollectedCharacter)
+            .values(owner_id = user_id, char_id = char_id, banner_id = banner_id, obtained = datetime.utcnow())
+            .on_conflict_do_nothing(index_elements = [CollectedCharacter.owner_id, CollectedCharacter.char_id])
+            )
+
+    @staticmethod
+    def collect(session: Session, banner_id: int, pulled: Dict[Tuple[int, int], int]) -> List[Tuple[int, int]]:
+        '''
+        Adds any number of characters to any number of inventories in a single upsert, obtaining new ones and adding duplicates of the rest
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        banner_id: int
+            Internal ID of the banner they were pulled from; only recorded for new characters
+
+        pulled: Dict[Tuple[int, int], int]
+            (Discord user ID, internal character ID) of each character gained, and how many copies
+
+        ### Returns
+        (Discord user ID, internal character ID) of every character that was not owned before
+        '''
+
+        if not pulled:
+            return []
+
+        now = datetime.utcnow()
+        statement = sqlite_insert(CollectedCharacter).values([
+            {"owner_id": owner_id, "char_id": char_id, "banner_id": banner_id, "obtained": now, "dupes": count}
+            for (owner_id, char_id), count in pulled.items()
+            ])
+        statement = statement.on_conflict_do_update(
+            index_elements = [CollectedCharacter.owner_id, CollectedCharacter.char_id],
+            set_ = {"dupes": CollectedCharacter.dupes + statement.excluded.dupes}
+            )
+        counts = session.execute(statement.returning(CollectedCharacter.owner_id, CollectedCharacter.char_id, CollectedCharacter.dupes)).all()
+
+        # An owned character already had at least 1 copy, so only new ones end up with exactly the copies gained
+        return [(owner_id, char_id) for owner_id, char_id, dupes in counts if dupes == pulled[(owner_id, char_id)]]
+
+    @staticmethod
+    def sell_duplicates(session: Session, user_id: int) -> Dict[int, int]:
+        '''
+        Sells every duplicate in a user's inventory, keeping one copy of each character, with a single UPDATE
+
+        Does not pay for them; see gacha.sell_duplicates().
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        user_id: int
+            Discord user ID
+
+        ### Returns
+        Number of duplicates sold of each character, by internal character ID
+        '''
+
+        # RETURNING only gives the counts after the update, so read them first; nothing else can run on the database thread in between
+        sold = {char_id: dupes - 1 for char_id, dupes in session.execute(
+            select(CollectedCharacter.char_id, CollectedCharacter.dupes)
+            .where(CollectedCharacter.owner_id == user_id)
+            .where(CollectedCharacter.dupes > 1)
+            ).all()}
+
+        if sold:
+            session.execute(
+                update(CollectedCharacter)
+                .where(CollectedCharacter.owner_id == user_id)
+                .where(CollectedCharacter.dupes > 1)
+                .values(dupes = 1)
+                .execution_options(synchronize_session = False)
+                )
+        return sold
+
+    @staticmethod
+    def page(session: Session, user_id: int, by_obtained: bool, after: Optional[Tuple[datetime, int]], limit: int) -> List[Tuple[int, datetime, int, int]]:
+        '''
+        Returns a page of a user's inventory, starting after a given character.
+
+        Uses keyset pagination: each page seeks straight to its first row in an index, so reading any page costs the same, no matter how far in.
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        user_id: int
+            Discord user ID
+
+        by_obtained: bool
+            Whether to order by when characters were obtained (oldest first), rather than by character ID
+
+        after: Tuple[datetime, int] | None
+            (obtained, internal character ID) of the last character of the previous page, or None for the first page
+
+        limit: int
+            Maximum number of characters to return
+
+        ### Returns
+        (internal character ID, obtained, banner_id, dupes) of each character, in order
+        '''
 
-        new_char = CollectedCharacter(owner_id = user_id, char_id = char_id, banner_id = banner_id, obtained = datetime.utcnow())
-        session.add(new_char)
-        session.commit()
+        statement = (
+            select(CollectedCharacter.char_id, CollectedCharacter.obtained, CollectedCharacter.banner_id, CollectedCharacter.dupes)
+            .where(CollectedCharacter.owner_id == user_id)
+            )
+
+        if by_obtained:
+            if after is not None:
+                statement = statement.where(tuple_(CollectedCharacter.obtained, CollectedCharacter.char_id) > tuple_(*after))
+            statement = statement.order_by(CollectedCharacter.obtained, CollectedCharacter.char_id)
+        else:
+            if after is not None:
+                statement = statement.where(CollectedCharacter.char_id > after[1])
+            statement = statement.order_by(CollectedCharacter.char_id)
+
+        return [tuple(row) for row in session.execute(statement.limit(limit)).all()]
 
     def gain(self, session: Session) -> None:
         '''
@@ -301,7 +650,6 @@ class CollectedCharacter(SQLBase):
         '''
 
         self.dupes += 1
-        session.commit()
 
     def sell(self, session: Session, amount: int) -> None:
         '''
@@ -324,6 +672,550 @@ class CollectedCharacter(SQLBase):
             raise InvalidArgumentError
         
         self.dupes -= amount
-        session.commit()
 
 
+class PityCounter(SQLBase):
+    '''
+    Number of pulls a user has made on a banner since they last pulled a character of at least some rarity; see gacha.py
+
+    Methods only stage changes on the given session; they are committed once by the bot.session_scope() around the event.
+
+    ### Attributes
+    [PRIMARY, FOREIGN] user_id: int
+        ID of User who pulled
+
+    [PRIMARY] banner_id: int
+        ID of the banner pulled from
+
+    [PRIMARY] rarity: int
+        Rarity counted towards
+
+    pulls: int
+        Pulls since the last character of this rarity or higher
+
+    ### Methods
+    [STATIC] load(session: Session, user_id: int, banner_id: int) -> Dict[int, int]
+        Returns every counter of a user on a banner
+
+    [STATIC] save(session: Session, user_id: int, banner_id: int, counters: Dict[int, int]) -> None
+        Stores every counter of a user on a banner
+    '''
+
+    __tablename__ = "gacha_pity"
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete = "CASCADE"), primary_key = True)
+    '''ID of User who pulled'''
+    banner_id: Mapped[int] = mapped_column(primary_key = True)
+    '''ID of the banner pulled from'''
+    rarity: Mapped[int] = mapped_column(primary_key = True)
+    '''Rarity counted towards'''
+    pulls: Mapped[int] = mapped_column(default = 0)
+    '''Pulls since the last character of this rarity or higher'''
+
+    @staticmethod
+    def load(session: Session, user_id: int, banner_id: int) -> Dict[int, int]:
+        '''
+        Returns every counter of a user on a banner
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        user_id: int
+            Discord user ID
+
+        banner_id: int
+            Internal ID of the banner
+
+        ### Returns
+        Pulls since the last character of each rarity or higher, by rarity; rarities never counted are left out
+        '''
+
+        return {rarity: pulls for rarity, pulls in session.execute(
+            select(PityCounter.rarity, PityCounter.pulls)
+            .where(PityCounter.user_id == user_id)
+            .where(PityCounter.banner_id == banner_id)
+            ).all()}
+
+    @staticmethod
+    def save(session: Session, user_id: int, banner_id: int, counters: Dict[int, int]) -> None:
+        '''
+        Stores every counter of a user on a banner, in a single upsert
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        user_id: int
+            Discord user ID
+
+        banner_id: int
+            Internal ID of the banner
+
+        counters: Dict[int, int]
+            Pulls since the last character of each rarity or higher, by rarity
+        '''
+
+        if not counters:
+            return
+
+        statement = sqlite_insert(PityCounter)
+        statement = statement.on_conflict_do_update(
+            index_elements = [PityCounter.user_id, PityCounter.banner_id, PityCounter.rarity],
+            set_ = {"pulls": statement.excluded.pulls}
+        )
+        session.execute(statement, [{"user_id": user_id, "banner_id": banner_id, "rarity": rarity, "pulls": pulls} for rarity, pulls in counters.items()])
+
+
+class LedgerEntry(SQLBase):
+    '''
+    A single credit or debit of electrum; the ledger is append-only, and User.electrum is kept as the materialized balance
+
+    ### Attributes
+    [PRIMARY] id: int
+        Order this entry was recorded in
+
+    user_id: int
+        ID of User whose balance changed
+
+    time: datetime
+        When the balance changed
+
+    amount: int
+        Electrum added, or removed if negative
+
+    reason: str
+        Why the balance changed; one of "beacon", "dawnbreaker", "rollcall", "gift", "gacha", "sell", or "admin"
+
+    balance: int
+        Balance of the user right after this change
+
+    ### Methods
+    [STATIC] entry(user_id: int, amount: int, reason: str, balance: int, time: datetime) -> Dict[str, Any]
+        Builds the column values of a ledger entry
+
+    [STATIC] record(session: Session, entries: List[Dict[str, Any]]) -> None
+        Appends entries to the ledger, and adds them to the hourly and daily rollups
+
+    [STATIC] history(session: Session, user_id: int, limit: int) -> List[Tuple[datetime, int, str, int]]
+        Returns the most recent entries of a user
+    '''
+
+    __tablename__ = "electrum_ledger"
+    __table_args__ = (Index("ix_electrum_ledger_user_time", "user_id", "time"), Index("ix_electrum_ledger_time", "time"))
+
+    id: Mapped[int] = mapped_column(primary_key = True)
+    '''Order this entry was recorded in'''
+    user_id: Mapped[int]
+    '''ID of User whose balance changed'''
+    time: Mapped[datetime]
+    '''When the balance changed'''
+    amount: Mapped[int]
+    '''Electrum added, or removed if negative'''
+    reason: Mapped[str]
+    '''Why the balance changed; one of "beacon", "dawnbreaker", "rollcall", "gift", "gacha", "sell", or "admin"'''
+    balance: Mapped[int]
+    '''Balance of the user right after this change'''
+
+    @staticmethod
+    def entry(user_id: int, amount: int, reason: str, balance: int, time: datetime) -> Dict[str, Any]:
+        '''
+        Builds the column values of a ledger entry, for record()
+
+        ### Parameters
+        user_id: int
+            Discord user ID
+
+        amount: int
+            Electrum added, or removed if negative
+
+        reason: str
+            Why the balance changed
+
+        balance: int
+            Balance of the user right after this change
+
+        time: datetime
+            When the balance changed
+
+        ### Returns
+        Column values of the entry
+        '''
+
+        return {"user_id": user_id, "time": time, "amount": amount, "reason": reason, "balance": balance}
+
+    @staticmethod
+    def record(session: Session, entries: List[Dict[str, Any]]) -> None:
+        '''
+        Appends entries to the ledger, and adds them to the hourly and daily rollups, in the same unit of work
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        entries: List[Dict[str, Any]]
+            Column values of each entry, as built by entry()
+        '''
+
+        if not entries:
+            return
+
+        session.execute(insert(LedgerEntry.__table__), entries)
+        HourlyRollup.add(session, entries)
+        DailyRollup.add(session, entries)
+
+    @staticmethod
+    def history(session: Session, user_id: int, limit: int) -> List[Tuple[datetime, int, str, int]]:
+        '''
+        Returns the most recent entries of a user, using the (user_id, time) index
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        user_id: int
+            Discord user ID
+
+        limit: int
+            Maximum number of entries to return
+
+        ### Returns
+        (time, amount, reason, balance) of each entry, from newest to oldest
+        '''
+
+        found = session.execute(
+            select(LedgerEntry.time, LedgerEntry.amount, LedgerEntry.reason, LedgerEntry.balance)
+            .where(LedgerEntry.user_id == user_id)
+            .order_by(LedgerEntry.time.desc(), LedgerEntry.id.desc())
+            .limit(limit)
+            ).all()
+
+        return [tuple(row) for row in found]
+
+
+class RollupColumns:
+    '''
+    Columns and upkeep shared by the electrum rollup tables; each row sums the ledger entries of one reason over one period
+
+    ### Attributes
+    [PRIMARY] start: datetime
+        Start of the period
+
+    [PRIMARY] reason: str
+        Reason of the summed entries; see LedgerEntry.reason
+
+    credited: int
+        Total electrum added
+
+    debited: int
+        Total electrum removed, as a positive number
+
+    entries: int
+        Number of ledger entries summed
+
+    [CLASS] truncate: Dict[str, int]
+        Fields of a time to reset to get the start of its period, as passed to datetime.replace(); declared by each table
+
+    ### Methods
+    [CLASS] add(session: Session, entries: List[Dict[str, Any]]) -> None
+        Adds ledger entries to their periods' totals, with one upsert
+    '''
+
+    start: Mapped[datetime] = mapped_column(primary_key = True)
+    '''Start of the period'''
+    reason: Mapped[str] = mapped_column(primary_key = True)
+    '''Reason of the summed entries; see LedgerEntry.reason'''
+    credited: Mapped[int] = mapped_column(default = 0)
+    '''Total electrum added'''
+    debited: Mapped[int] = mapped_column(default = 0)
+    '''Total electrum removed, as a positive number'''
+    entries: Mapped[int] = mapped_column(default = 0)
+    '''Number of ledger entries summed'''
+    truncate: ClassVar[Dict[str, int]]
+    '''Fields of a time to reset to get the start of its period, as passed to datetime.replace()'''
+
+    @classmethod
+    def add(cls, session: Session, entries: List[Dict[str, Any]]) -> None:
+        '''
+        Adds ledger entries to their periods' totals, with one upsert
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        entries: List[Dict[str, Any]]
+            Column values of each ledger entry
+        '''
+
+        totals: Dict[Tuple[datetime, str], Dict[str, Any]] = {}
+        for entry in entries:
+            key = (entry["time"].replace(**cls.truncate), entry["reason"])
+            total = totals.setdefault(key, {"start": key[0], "reason": key[1], "credited": 0, "debited": 0, "entries": 0})
+            if entry["amount"] >= 0:
+                total["credited"] += entry["amount"]
+            else:
+                total["debited"] -= entry["amount"]
+            total["entries"] += 1
+
+        statement = sqlite_insert(cls.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements = ["start", "reason"],
+            set_ = {
+                "credited": cls.__table__.c.credited + statement.excluded.credited,
+                "debited": cls.__table__.c.debited + statement.excluded.debited,
+                "entries": cls.__table__.c.entries + statement.excluded.entries
+            }
+        )
+        session.execute(statement, list(totals.values()))
+
+class HourlyRollup(RollupColumns, SQLBase):
+    '''
+    Electrum credited and debited per reason, per hour; see RollupColumns
+    '''
+
+    __tablename__ = "electrum_rollup_hourly"
+
+    truncate = {"minute": 0, "second": 0, "microsecond": 0}
+
+class DailyRollup(RollupColumns, SQLBase):
+    '''
+    Electrum credited and debited per reason, per day; see RollupColumns
+    '''
+
+    __tablename__ = "electrum_rollup_daily"
+
+    truncate = {"hour": 0, "minute": 0, "second": 0, "microsecond": 0}
+
+    @staticmethod
+    def totals(session: Session, since: datetime) -> Dict[str, Tuple[int, int]]:
+        '''
+        Sums the daily rollups from a given day onwards, per reason
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        since: datetime
+            First day to include
+
+        ### Returns
+        (credited, debited) by reason
+        '''
+
+        found = session.execute(
+            select(DailyRollup.reason, func.sum(DailyRollup.credited), func.sum(DailyRollup.debited))
+            .where(DailyRollup.start >= since.replace(**DailyRollup.truncate))
+            .group_by(DailyRollup.reason)
+            ).all()
+
+        return {reason: (credited, debited) for reason, credited, debited in found}
+
+
+class PendingDeletion(SQLBase):
+    '''
+    A message of the bot waiting to be deleted, so that deletions survive a restart; see deletions.py
+
+    ### Attributes
+    [PRIMARY] message_id: int
+        Discord ID of the message
+
+    channel_id: int
+        Discord ID of the channel the message is in
+
+    delete_at: datetime
+        When to delete the message
+
+    ### Methods
+    [STATIC] add(session: Session, rows: List[Tuple[int, int, datetime]]) -> None
+        Records messages to delete
+
+    [STATIC] remove(session: Session, message_ids: List[int]) -> None
+        Forgets messages that were deleted
+
+    [STATIC] load(session: Session) -> List[Tuple[int, int, datetime]]
+        Returns every message waiting to be deleted
+    '''
+
+    __tablename__ = "pending_deletion"
+
+    message_id: Mapped[int] = mapped_column(primary_key = True)
+    '''Discord ID of the message'''
+    channel_id: Mapped[int]
+    '''Discord ID of the channel the message is in'''
+    delete_at: Mapped[datetime]
+    '''When to delete the message'''
+
+    @staticmethod
+    def add(session: Session, rows: List[Tuple[int, int, datetime]]) -> None:
+        '''
+        Records messages to delete, in a single statement
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        rows: List[Tuple[int, int, datetime]]
+            (message ID, channel ID, when to delete) of each message
+        '''
+
+        if not rows:
+            return
+
+        session.execute(
+            sqlite_insert(PendingDeletion).on_conflict_do_nothing(),
+            [{"message_id": message_id, "channel_id": channel_id, "delete_at": delete_at} for message_id, channel_id, delete_at in rows]
+            )
+
+    @staticmethod
+    def remove(session: Session, message_ids: List[int]) -> None:
+        '''
+        Forgets messages that were deleted, in a single statement
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        message_ids: List[int]
+            Discord IDs of the messages
+        '''
+
+        if not message_ids:
+            return
+
+        session.execute(delete(PendingDeletion).where(PendingDeletion.message_id.in_(message_ids)))
+
+    @staticmethod
+    def load(session: Session) -> List[Tuple[int, int, datetime]]:
+        '''
+        Returns every message waiting to be deleted
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        ### Returns
+        (message ID, channel ID, when to delete) of each message
+        '''
+
+        return [tuple(row) for row in session.execute(
+            select(PendingDeletion.message_id, PendingDeletion.channel_id, PendingDeletion.delete_at)
+            ).all()]
+
+class PendingEdit(SQLBase):
+    '''
+    A message of the bot waiting to have part of its text removed, so that edits survive a restart; see deletions.py
+
+    ### Attributes
+    [PRIMARY] message_id: int
+        Discord ID of the message
+
+    [PRIMARY] edit_at: datetime
+        When to edit the message
+
+    channel_id: int
+        Discord ID of the channel the message is in
+
+    content: str
+        Text to leave in the message
+
+    ### Methods
+    [STATIC] add(session: Session, rows: List[Tuple[int, int, datetime, str]]) -> None
+        Records edits to make
+
+    [STATIC] remove(session: Session, keys: List[Tuple[int, datetime]]) -> None
+        Forgets edits that were made
+
+    [STATIC] load(session: Session) -> List[Tuple[int, int, datetime, str]]
+        Returns every edit waiting to be made
+    '''
+
+    __tablename__ = "pending_edit"
+
+    message_id: Mapped[int] = mapped_column(primary_key = True)
+    '''Discord ID of the message'''
+    edit_at: Mapped[datetime] = mapped_column(primary_key = True)
+    '''When to edit the message'''
+    channel_id: Mapped[int]
+    '''Discord ID of the channel the message is in'''
+    content: Mapped[str]
+    '''Text to leave in the message'''
+
+    @staticmethod
+    def add(session: Session, rows: List[Tuple[int, int, datetime, str]]) -> None:
+        '''
+        Records edits to make, in a single statement
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        rows: List[Tuple[int, int, datetime, str]]
+            (message ID, channel ID, when to edit, text to leave) of each edit
+        '''
+
+        if not rows:
+            return
+
+        session.execute(
+            sqlite_insert(PendingEdit).on_conflict_do_nothing(),
+            [{"message_id": message_id, "channel_id": channel_id, "edit_at": edit_at, "content": content} for message_id, channel_id, edit_at, content in rows]
+            )
+
+    @staticmethod
+    def remove(session: Session, keys: List[Tuple[int, datetime]]) -> None:
+        '''
+        Forgets edits that were made, in a single statement
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        keys: List[Tuple[int, datetime]]
+            (message ID, when to edit) of each edit
+        '''
+
+        if not keys:
+            return
+
+        session.execute(delete(PendingEdit).where(tuple_(PendingEdit.message_id, PendingEdit.edit_at).in_(keys)))
+
+    @staticmethod
+    def load(session: Session) -> List[Tuple[int, int, datetime, str]]:
+        '''
+        Returns every edit waiting to be made
+
+        ### Parameters
+        session: Session
+            Database session scope
+
+        ### Returns
+        (message ID, channel ID, when to edit, text to leave) of each edit
+        '''
+
+        return [tuple(row) for row in session.execute(
+            select(PendingEdit.message_id, PendingEdit.channel_id, PendingEdit.edit_at, PendingEdit.content)
+            ).all()]
+
+class SchemaVersion(SQLBase):
+    '''
+    A migration applied to the database; see migrations.py
+
+    ### Attributes
+    [PRIMARY] version: int
+        Version number of the migration
+
+    name: str
+        What the migration changed
+
+    applied: datetime
+        When the migration finished
+    '''
+
+    __tablename__ = "schema_version"
+
+    version: Mapped[int] = mapped_column(primary_key = True)
+    '''Version number of the migration'''
+    name: Mapped[str]
+    '''What the migration changed'''
+    applied: Mapped[datetime]
+    '''When the migration finished'''
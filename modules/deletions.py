@@ -0,0 +1,279 @@
+'''Contains the scheduler that deletes the bot's messages after a delay, in bulk per channel, or edits text out of them, remembering both across restarts'''
+
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from asyncio import Event, Task, TimeoutError, ensure_future, sleep, wait_for
+
+from discord import Message, Object, NotFound, HTTPException
+from discord.utils import snowflake_time, utcnow
+
+from bot import bot_client, run_db
+from auxiliary import log_event, load_settings, INFO, WARNING, ERROR
+from sqlalchemy.orm import Session
+
+from dbmodels import PendingDeletion, PendingEdit
+
+deletion_settings = load_settings("deletions", {"batch_window": 2})
+
+batch_window: float = deletion_settings["batch_window"]
+'''Seconds that a deletion may wait past its time for others in the same channel, so that they are deleted together'''
+bulk_limit = 100
+'''Maximum messages per bulk deletion'''
+bulk_max_age = timedelta(days = 13, hours = 23)
+'''Oldest message that can be bulk deleted; Discord refuses anything over 14 days old'''
+
+
+class DeletionScheduler:
+    '''
+    Deletes messages once their time comes, using a single heap and a single task for all of them,
+    and deleting everything due in the same channel at once with bulk deletion where allowed.
+
+    Messages can also be scheduled to be edited, i.e. to remove text that expires before the rest of the message; edits share the heap.
+    Every pending deletion and edit is also saved to the database, so that the bot still makes it after a restart.
+
+    ### Attributes
+    pending: List[Tuple[datetime, int, int]]
+        Heap of (when to delete or edit, channel ID, message ID)
+
+    edits: Dict[Tuple[int, datetime], str]
+        Text to leave in a message, by (message ID, when to edit); heap entries not in here are deletions
+
+    wake: Event
+        Set when a deletion is scheduled earlier than every other
+
+    task: Task | None
+        Task deleting messages as they come due; started by the first deletion scheduled or loaded
+
+    ### Methods
+    async schedule(message: Message, delay: float) -> None
+        Deletes a message after a delay
+
+    async schedule_edits(message: Message, edits: List[Tuple[float, str]]) -> None
+        Edits a message after each of several delays
+
+    async load() -> None
+        Schedules every deletion and edit saved in the database
+
+    async edit(channel_id: int, message_id: int, content: str) -> None
+        Replaces the text of a message
+
+    async delete(channel_id: int, message_ids: List[int]) -> None
+        Deletes messages of a single channel, in as few requests as allowed
+    '''
+
+    def __init__(self) -> None:
+        self.pending: List[Tuple[datetime, int, int]] = []
+        self.edits: Dict[Tuple[int, datetime], str] = {}
+        self.wake = Event()
+        self.task: Optional[Task] = None
+
+    def push(self, delete_at: datetime, channel_id: int, message_id: int) -> None:
+        '''
+        Adds a deletion, or an edit already in edits, to the heap, waking the task if it is now the first due
+        '''
+
+        heappush(self.pending, (delete_at, channel_id, message_id))
+        if self.pending[0][2] == message_id:
+            self.wake.set()
+        if self.task is None or self.task.done():
+            self.task = ensure_future(self.run())
+
+    async def schedule(self, message: Message, delay: float) -> None:
+        '''
+        Deletes a message after a delay; the message is saved, so it is deleted even after a restart
+
+        ### Parameters
+        message: Message
+            Message to delete
+
+        delay: float
+            Seconds to wait before deleting
+        '''
+
+        delete_at = datetime.utcnow() + timedelta(seconds = delay)
+        self.push(delete_at, message.channel.id, message.id)
+        try:
+            await run_db(PendingDeletion.add, [(message.id, message.channel.id, delete_at)])
+        except Exception as error:
+            # Still deleted on time, unless the bot restarts first
+            log_event(ERROR, "deletions.schedule", "Failed to save a pending deletion in CHANNEL[{channel}]! {error!r}", channel = message.channel, outcome = "failed", error = error, message_id = message.id)
+
+    async def schedule_edits(self, message: Message, edits: List[Tuple[float, str]]) -> None:
+        '''
+        Edits a message after each of several delays; the edits are saved, so they are made even after a restart
+
+        ### Parameters
+        message: Message
+            Message to edit
+
+        edits: List[Tuple[float, str]]
+            (seconds to wait, text to leave in the message) of each edit
+        '''
+
+        now = datetime.utcnow()
+        rows: List[Tuple[int, int, datetime, str]] = []
+        for delay, content in edits:
+            edit_at = now + timedelta(seconds = delay)
+            self.edits[(message.id, edit_at)] = content
+            self.push(edit_at, message.channel.id, message.id)
+            rows.append((message.id, message.channel.id, edit_at, content))
+        try:
+            await run_db(PendingEdit.add, rows)
+        except Exception as error:
+            # Still edited on time, unless the bot restarts first
+            log_event(ERROR, "deletions.schedule", "Failed to save pending edits in CHANNEL[{channel}]! {error!r}", channel = message.channel, outcome = "failed", error = error, message_id = message.id)
+
+    async def load(self) -> None:
+        '''
+        Schedules every deletion and edit saved in the database; any already overdue are made straight away
+        '''
+
+        def read(session: Session) -> Tuple[List[Tuple[int, int, datetime]], List[Tuple[int, int, datetime, str]]]:
+            return PendingDeletion.load(session), PendingEdit.load(session)
+
+        found, found_edits = await run_db(read)
+        scheduled = {message_id for _, _, message_id in self.pending}
+        for message_id, channel_id, delete_at in found:
+            if message_id not in scheduled:
+                self.push(delete_at, channel_id, message_id)
+        for message_id, channel_id, edit_at, content in found_edits:
+            if (message_id, edit_at) not in self.edits:
+                self.edits[(message_id, edit_at)] = content
+                self.push(edit_at, channel_id, message_id)
+        log_event(INFO, "deletions.load", "Loaded {count} pending message deletions and {edits} edits", count = len(found), edits = len(found_edits))
+
+    async def run(self) -> None:
+        '''
+        Deletes and edits messages as they come due, until none are left
+        '''
+
+        while self.pending:
+            try:
+                await self.run_due()
+            except Exception as error:
+                # Never let one bad batch stop every later deletion; wait a little so that a persistent error does not spin
+                log_event(ERROR, "deletions.delete", "Failed to delete or edit due messages! {error!r}", outcome = "failed", error = error)
+                await sleep(batch_window)
+
+    async def run_due(self) -> None:
+        '''
+        Waits for the first deletion or edit to come due, then makes every one due by then
+        '''
+
+        self.wake.clear()
+        wait = (self.pending[0][0] - datetime.utcnow()).total_seconds()
+        if wait > 0:
+            try:
+                # Deletions that come due meanwhile in the same channel go along with it
+                await wait_for(self.wake.wait(), wait + batch_window)
+                return
+            except TimeoutError:
+                pass
+
+        now = datetime.utcnow()
+        due: Dict[int, List[int]] = {}
+        edits: List[Tuple[datetime, int, int, str]] = []
+        while self.pending and self.pending[0][0] <= now:
+            due_at, channel_id, message_id = heappop(self.pending)
+            content = self.edits.pop((message_id, due_at), None)
+            if content is None:
+                due.setdefault(channel_id, []).append(message_id)
+            else:
+                edits.append((due_at, channel_id, message_id, content))
+
+        # Everything due is popped before any request, so a failure cannot leave some of it neither made nor forgotten
+        for _, channel_id, message_id, content in edits:
+            # In time order, so later edits of the same message win
+            try:
+                await self.edit(channel_id, message_id, content)
+            except Exception as error:
+                log_event(ERROR, "deletions.edit", "Failed to edit a message in CHANNEL[{channel}]! {error!r}", channel = Object(channel_id), outcome = "failed", error = error, message_id = message_id)
+        for channel_id, message_ids in due.items():
+            try:
+                await self.delete(channel_id, message_ids)
+            except Exception as error:
+                log_event(ERROR, "deletions.delete", "Failed to delete messages in CHANNEL[{channel}]! {error!r}", channel = Object(channel_id), outcome = "failed", error = error, count = len(message_ids))
+
+        def forget(session: Session) -> None:
+            PendingDeletion.remove(session, [message_id for message_ids in due.values() for message_id in message_ids])
+            PendingEdit.remove(session, [(message_id, due_at) for due_at, _, message_id, _ in edits])
+
+        try:
+            await run_db(forget)
+        except Exception as error:
+            log_event(ERROR, "deletions.delete", "Failed to forget deleted and edited messages! {error!r}", outcome = "failed", error = error)
+
+    async def edit(self, channel_id: int, message_id: int, content: str) -> None:
+        '''
+        Replaces the text of a message; a message that is already gone is skipped
+
+        ### Parameters
+        channel_id: int
+            Discord ID of the channel
+
+        message_id: int
+            Discord ID of the message
+
+        content: str
+            Text to leave in the message
+        '''
+
+        channel = bot_client.get_channel(channel_id) or bot_client.get_partial_messageable(channel_id)
+        try:
+            await channel.get_partial_message(message_id).edit(content = content)
+        except NotFound:
+            pass
+        except HTTPException as error:
+            log_event(WARNING, "deletions.edit", "Failed to edit a message in CHANNEL[{channel}]: {error!r}", channel = channel, outcome = "failed", error = error, message_id = message_id)
+
+    async def delete(self, channel_id: int, message_ids: List[int]) -> None:
+        '''
+        Deletes messages of a single channel; recent messages are bulk deleted 100 at a time where the bot may manage messages,
+        and any others one by one. Messages that are already gone are skipped.
+
+        ### Parameters
+        channel_id: int
+            Discord ID of the channel
+
+        message_ids: List[int]
+            Discord IDs of the messages
+        '''
+
+        channel = bot_client.get_channel(channel_id) or bot_client.get_partial_messageable(channel_id)
+
+        single = message_ids
+        guild = getattr(channel, "guild", None)
+        if hasattr(channel, "delete_messages") and guild is not None and channel.permissions_for(guild.me).manage_messages:
+            cutoff = utcnow() - bulk_max_age
+            recent = [message_id for message_id in message_ids if snowflake_time(message_id) > cutoff]
+            single = [message_id for message_id in message_ids if snowflake_time(message_id) <= cutoff]
+            for start in range(0, len(recent), bulk_limit):
+                chunk = recent[start:start + bulk_limit]
+                if len(chunk) == 1:
+                    single.extend(chunk)
+                    continue
+                try:
+                    await channel.delete_messages([Object(message_id) for message_id in chunk])
+                except HTTPException:
+                    # i.e. one of them was already deleted; fall back to deleting each
+                    single.extend(chunk)
+
+        for message_id in single:
+            try:
+                await channel.get_partial_message(message_id).delete()
+            except NotFound:
+                pass
+            except HTTPException as error:
+                log_event(WARNING, "deletions.delete", "Failed to delete a message in CHANNEL[{channel}]: {error!r}", channel = channel, outcome = "failed", error = error, message_id = message_id)
+
+message_deletions = DeletionScheduler()
+'''Scheduler of every delayed deletion'''
+
+@bot_client.listen("on_ready")
+async def load_deletions():
+    '''
+    Schedules the deletions and edits left over from before the last restart once connected
+    '''
+
+    await message_deletions.load()
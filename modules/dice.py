@@ -0,0 +1,335 @@
+'''Contains the dice expression engine and the /roll command'''
+
+from typing import Callable, Dict, List, Optional, Tuple
+from functools import lru_cache
+from random import choices
+from re import compile as compile_regex
+from operator import lt, le, gt, ge, eq
+from itertools import accumulate
+from asyncio import get_running_loop
+
+from discord import ApplicationContext, Option
+
+from bot import bot_client
+from auxiliary import InvalidArgumentError, log_event, INFO, WARNING
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+max_dice = 1000000
+'''Maximum number of dice in a single expression, over all terms'''
+max_sides = 100000
+'''Maximum number of sides per die'''
+max_terms = 20
+'''Maximum number of terms (dice and numbers) in a single expression'''
+max_explosions = 100
+'''Maximum rounds of exploding dice, so that every roll ends'''
+shown_dice = 20
+'''Individual results are only shown for terms with at most this many dice'''
+histogram_dice = 1000
+'''Terms with more dice than this are rolled as a count of each face, rather than die by die; needs numpy'''
+
+dice_rng = numpy.random.default_rng() if numpy is not None else None
+'''Random generator for rolling counts of faces'''
+
+comparisons: Dict[str, Callable[[int, int], bool]] = {"<": lt, "<=": le, ">": gt, ">=": ge, "=": eq, "": eq}
+'''Comparisons allowed in reroll modifiers, i.e. r<3'''
+
+term_regex = compile_regex(r"([+-]?)(?:(\d*)d(\d+|%)([a-z!<>=\d]*)|(\d+))")
+'''A single signed term: either dice with any modifiers, or a number'''
+modifier_regex = compile_regex(r"(!)|(ro?)(<=|>=|<|>|=)?(\d+)|(kh|kl|k|dh|dl)(\d+)")
+'''A single dice modifier: exploding, reroll, or keep/drop'''
+
+
+class DiceTerm:
+    '''
+    A single group of identical dice in an expression, i.e. 4d6kh3
+
+    ### Attributes
+    text: str
+        The term as written, without its sign
+
+    sign: int
+        1 if added, -1 if subtracted
+
+    count: int
+        Number of dice
+
+    sides: int
+        Number of sides per die
+
+    explode: bool
+        Whether a die showing its highest face is rolled again and added, repeatedly
+
+    weights: List[int] | None
+        Relative chance of each face after rerolls, lowest face first; None if every face is equally likely
+
+    keep: int
+        Number of dice kept
+
+    keep_highest: bool
+        Whether the highest dice are kept, rather than the lowest
+
+    ### Methods
+    roll() -> Tuple[int, str]
+        Rolls every die of this term
+    '''
+
+    def __init__(self, text: str, sign: int, count: int, sides: int, modifiers: str) -> None:
+        self.text = text
+        self.sign = sign
+        self.count = count
+        self.sides = sides
+        self.explode = False
+        self.weights: Optional[List[int]] = None
+        self.keep = count
+        self.keep_highest = True
+
+        if count < 1 or sides < 1 or sides > max_sides:
+            raise InvalidArgumentError("Dice need at least 1 die, and between 1 and " + str(max_sides) + " sides.")
+
+        position = 0
+        while position < len(modifiers):
+            modifier = modifier_regex.match(modifiers, position)
+            if modifier is None:
+                raise InvalidArgumentError("Unknown modifier `" + modifiers[position:] + "`.")
+            position = modifier.end()
+
+            if modifier.group(1):
+                if sides == 1:
+                    raise InvalidArgumentError("A 1-sided die would explode forever.")
+                self.explode = True
+            elif modifier.group(2):
+                compare = comparisons[modifier.group(3) or ""]
+                rerolled = [compare(face, int(modifier.group(4))) for face in range(1, sides + 1)]
+                if modifier.group(2) == "r":
+                    # Rerolled until it is not one of the faces; the same as never rolling them
+                    if all(rerolled):
+                        raise InvalidArgumentError("Every face would be rerolled forever.")
+                    self.weights = [0 if reroll else 1 for reroll in rerolled]
+                else:
+                    # Rerolled once; the second roll stands, so every face gets a share of the rerolled chance
+                    self.weights = [sum(rerolled) + (0 if reroll else sides) for reroll in rerolled]
+            else:
+                amount = int(modifier.group(6))
+                kind = modifier.group(5)
+                if kind in ("dh", "dl"):
+                    self.keep = max(count - amount, 0)
+                    self.keep_highest = kind == "dl"
+                else:
+                    self.keep = min(amount, count)
+                    self.keep_highest = kind != "kl"
+
+        # Uniform weights roll faster without them
+        if self.weights is not None and len(set(self.weights)) == 1:
+            self.weights = None
+        self.cumulative = None if self.weights is None else list(accumulate(self.weights))
+
+    def sample(self, count: int) -> List[int]:
+        '''
+        Rolls a number of single dice, without exploding
+        '''
+
+        return choices(range(1, self.sides + 1), cum_weights = self.cumulative, k = count)
+
+    def roll_each(self) -> List[int]:
+        '''
+        Rolls every die individually, exploding them as needed
+
+        ### Returns
+        Total of each die
+        '''
+
+        values = self.sample(self.count)
+        if self.explode:
+            exploding = [i for i, value in enumerate(values) if value == self.sides]
+            for _ in range(max_explosions):
+                if not exploding:
+                    break
+                extra = self.sample(len(exploding))
+                for i, value in zip(exploding, extra):
+                    values[i] += value
+                exploding = [i for i, value in zip(exploding, extra) if value == self.sides]
+        return values
+
+    def roll_counts(self) -> int:
+        '''
+        Rolls every die at once as a count of each face, so that the work does not grow with the number of dice; needs numpy.
+        Cannot keep or drop exploded dice, as their totals are not faces.
+
+        ### Returns
+        Total of the kept dice
+        '''
+
+        weights = numpy.ones(self.sides) if self.weights is None else numpy.array(self.weights, dtype = numpy.float64)
+        chances = weights / weights.sum()
+        faces = numpy.arange(1, self.sides + 1, dtype = numpy.int64)
+
+        counts = dice_rng.multinomial(self.count, chances)
+        if self.keep < self.count:
+            # Remove dropped dice from the low (or high) faces up
+            ordered = counts if self.keep_highest else counts[::-1]
+            below = numpy.cumsum(ordered) - ordered
+            ordered -= numpy.clip(self.count - self.keep - below, 0, ordered)
+        total = int(counts @ faces)
+
+        if self.explode:
+            exploding = int(counts[-1])
+            for _ in range(max_explosions):
+                if not exploding:
+                    break
+                counts = dice_rng.multinomial(exploding, chances)
+                total += int(counts @ faces)
+                exploding = int(counts[-1])
+        return total
+
+    def roll(self) -> Tuple[int, str]:
+        '''
+        Rolls every die of this term
+
+        ### Returns
+        Signed total of the kept dice, and a description of the roll; individual dice are only listed for small terms
+        '''
+
+        if numpy is not None and self.count > histogram_dice and not (self.explode and self.keep < self.count):
+            total = self.roll_counts()
+            return self.sign * total, self.text + " = " + str(total)
+
+        values = self.roll_each()
+        order = sorted(range(self.count), key = values.__getitem__, reverse = self.keep_highest)
+        kept = order[:self.keep]
+        total = sum(values[i] for i in kept)
+        if self.count > shown_dice:
+            return self.sign * total, self.text + " = " + str(total)
+
+        kept = set(kept)
+        shown = ", ".join(str(value) if i in kept else "~~" + str(value) + "~~" for i, value in enumerate(values))
+        return self.sign * total, self.text + " [" + shown + "] = " + str(total)
+
+class DiceExpression:
+    '''
+    A parsed dice expression, i.e. 4d6kh3 + 1d8! - 2; can be rolled any number of times
+
+    ### Attributes
+    text: str
+        The expression as written, normalized
+
+    terms: List[DiceTerm]
+        Every group of dice
+
+    constant: int
+        Sum of every plain number
+
+    dice: int
+        Number of dice over all terms
+
+    ### Methods
+    roll() -> Tuple[int, List[str]]
+        Rolls the whole expression
+    '''
+
+    def __init__(self, text: str, terms: List[DiceTerm], constant: int) -> None:
+        self.text = text
+        self.terms = terms
+        self.constant = constant
+        self.dice = sum(term.count for term in terms)
+
+    def roll(self) -> Tuple[int, List[str]]:
+        '''
+        Rolls the whole expression
+
+        ### Returns
+        Total, and a description of each group of dice
+        '''
+
+        total = self.constant
+        lines: List[str] = []
+        for term in self.terms:
+            result, line = term.roll()
+            total += result
+            lines.append(("-" if term.sign < 0 else "") + line)
+        return total, lines
+
+@lru_cache(maxsize = 256)
+def parse_dice(expression: str) -> DiceExpression:
+    '''
+    Parses a dice expression; results are cached, so repeated expressions are only parsed once.
+
+    Terms are NdX (N defaults to 1, d% is d100) or numbers, joined by + or -. Dice take any of these modifiers:
+    ! (exploding), rN / r<N / r>=N... (reroll matching faces until they stop matching), roN... (reroll once),
+    khN / kN / klN (keep highest/lowest N), dhN / dlN (drop highest/lowest N).
+
+    ### Parameters
+    expression: str
+        Expression to parse; case and spaces are ignored
+
+    ### Returns
+    Parsed expression
+
+    ### Throws
+    InvalidArgumentError
+        Expression is malformed or too large; the message says why
+    '''
+
+    text = "".join(expression.lower().split())
+    if not text:
+        raise InvalidArgumentError("There's nothing to roll.")
+
+    terms: List[DiceTerm] = []
+    constant = 0
+    count = 0
+    position = 0
+    while position < len(text):
+        term = term_regex.match(text, position)
+        # Every term but the first needs a sign
+        if term is None or term.end() == position or (position > 0 and not term.group(1)):
+            raise InvalidArgumentError("I don't understand `" + text[position:] + "`.")
+        position = term.end()
+        count += 1
+        if count > max_terms:
+            raise InvalidArgumentError("That's too many terms; at most " + str(max_terms) + ".")
+
+        sign = -1 if term.group(1) == "-" else 1
+        if term.group(5) is not None:
+            constant += sign * int(term.group(5))
+        else:
+            sides = 100 if term.group(3) == "%" else int(term.group(3))
+            terms.append(DiceTerm(term.group(0).lstrip("+-"), sign, int(term.group(2) or 1), sides, term.group(4)))
+
+    parsed = DiceExpression(text, terms, constant)
+    if parsed.dice > max_dice:
+        raise InvalidArgumentError("That's too many dice; at most " + str(max_dice) + ".")
+    return parsed
+
+
+@bot_client.slash_command(name = "roll", description = "Roll dice, i.e. 4d6kh3 + 2")
+async def roll(
+    context: ApplicationContext,
+    expression: Option(str, description = "Dice to roll, i.e. 1000d6, 4d6kh3, 2d20kl1 + 5, 3d6!, 4d6r1", required = True)
+):
+    '''
+    Adds the command /roll
+    '''
+
+    try:
+        parsed = parse_dice(expression)
+    except InvalidArgumentError as error:
+        log_event(WARNING, "dice.roll", "{user} tried to roll {expression} at GUILD[{guild}], CHANNEL[{channel}], but it was invalid", user = context.author, guild = context.guild, channel = context.channel, outcome = "invalid", expression = expression, error = str(error))
+        await context.respond("I can't roll that! " + str(error), ephemeral = True)
+        return
+
+    if parsed.dice > histogram_dice:
+        # Large rolls may take a moment, so keep them off the event loop
+        total, lines = await get_running_loop().run_in_executor(None, parsed.roll)
+    else:
+        total, lines = parsed.roll()
+    log_event(INFO, "dice.roll", "{user} rolled {expression} for {total} at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", expression = parsed.text, total = total)
+
+    message = context.author.mention + " rolled `" + parsed.text + "`: **" + str(total) + "**"
+    details = "\n".join(lines)
+    if len(parsed.terms) > 1 or parsed.constant or (parsed.terms and parsed.terms[0].count > 1):
+        if len(message) + len(details) + 1 <= 2000:
+            message += "\n" + details
+    await context.respond(message)
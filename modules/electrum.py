@@ -1,10 +1,14 @@
 '''Module containing various functions related solely to electrum (per-user currency) management'''
 
-from discord import ApplicationContext, Option
+from typing import Dict, List
+from re import findall
+
+from discord import ApplicationContext, Option, VoiceChannel, Member, Guild
 from discord import User as DiscordUser
 
-from bot import bot_client, database_connector
-from auxiliary import perms, log, get_time
+from bot import bot_client
+from auxiliary import perms, log_event, DEBUG, INFO, WARNING
+from usercache import user_cache
 from dbmodels import User
 
 @bot_client.slash_command(name = "balance", description = "See how much electrum you currently own")
@@ -13,15 +17,10 @@ async def balance(context: ApplicationContext):
     Adds the command /balance
     '''
 
-    log(get_time() + " >> " + str(context.author) + " queried their balance at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
-
-    session = database_connector()
-
-    user = User.find_user(session, context.author.id)
+    user = await user_cache.get(context.author.id)
+    log_event(INFO, "electrum.balance", "{user} queried their balance at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", balance = user.electrum)
     await context.respond("You currently have **" + str(user.electrum) + "** electrum pieces.")
 
-    session.close()
-
 @bot_client.slash_command(name = "gift", description = "Send electrum to another user", guild_only = True)
 async def gift(
     context: ApplicationContext,
@@ -32,49 +31,136 @@ async def gift(
     Adds the command /gift
     '''
 
-    log(get_time() + " >> " + str(context.author) + " sent " + str(electrum) + " electrum to " + str(user) + " at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
-
-    session = database_connector()
+    balances = await user_cache.run_sql([context.author.id, user.id], User.transfer, context.author.id, {user.id: electrum})
 
-    sender = User.find_user(session, context.author.id)
-    
-    if electrum > sender.electrum:
+    if balances is None:
         # If trying to send more money than user owns
-        log("ERROR HAS OCCURRED   >> Not enough money!")
+        log_event(WARNING, "electrum.gift", "{user} tried to send {electrum} electrum to {recipient} at GUILD[{guild}], CHANNEL[{channel}], but didn't have enough money", user = context.author, guild = context.guild, channel = context.channel, outcome = "insufficient", recipient = user, recipient_id = user.id, electrum = electrum)
         await context.respond("You don't have that much money!")
     else:
-        recipient = User.find_user(session, user.id)
+        log_event(INFO, "electrum.gift", "{user} sent {electrum} electrum to {recipient} at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", recipient = user, recipient_id = user.id, electrum = electrum)
+        log_event(DEBUG, "electrum.balance", "New balances are {balances}", user = context.author, balances = balances)
+        await context.respond("Operation successful.")
+
+def split_amount(total: int, count: int) -> List[int]:
+    '''
+    Splits an amount of electrum as evenly as possible between a number of recipients
 
-        # Remove money from sender
-        sender.add_electrum(session, -electrum)
-        # Add money to recipient
-        recipient.add_electrum(session, electrum)
+    ### Parameters
+    total: int
+        Amount of electrum to split
 
-        log("                     >> New balance of " + str(context.author) + " is " + str(sender.electrum))
-        log("                     >> New balance of " + str(user) + " is " + str(recipient.electrum))
-        await context.respond("Operation successful.")
+    count: int
+        Number of recipients
+
+    ### Returns
+    Amount for each recipient; the first few get 1 more if it does not divide evenly
+    '''
+
+    share, remainder = divmod(total, count)
+    return [share + 1 if i < remainder else share for i in range(count)]
+
+def gather_members(guild: Guild, recipients: str, channel: VoiceChannel | None) -> Dict[int, Member]:
+    '''
+    Collects every member mentioned, in a mentioned role, or in a voice channel, without duplicates or bots
+
+    ### Parameters
+    guild: Guild
+        Server the mentions are in
+
+    recipients: str
+        Text containing mentions of users and roles
+
+    channel: VoiceChannel | None
+        Voice channel whose members to include, if any
 
-    session.close()
+    ### Returns
+    Each member by Discord ID
+    '''
+
+    members: Dict[int, Member] = {}
+    for member_id in findall(r"<@!?(\d+)>", recipients):
+        member = guild.get_member(int(member_id))
+        if member is not None:
+            members[member.id] = member
+    for role_id in findall(r"<@&(\d+)>", recipients):
+        role = guild.get_role(int(role_id))
+        if role is not None:
+            members.update((member.id, member) for member in role.members)
+    if channel is not None:
+        members.update((member.id, member) for member in channel.members)
+    return {id: member for id, member in members.items() if not member.bot}
+
+@bot_client.slash_command(name = "giftmany", description = "Send electrum to several users, a role, or a voice channel at once", guild_only = True)
+async def gift_many(
+    context: ApplicationContext,
+    electrum: Option(int, description = "Amount to send to each recipient, or in total if split", required = True, min_value = 0),
+    recipients: Option(str, description = "Mentions of users and roles to send electrum to", required = False, default = ""),
+    channel: Option(VoiceChannel, description = "Voice channel whose members to send electrum to", required = False, default = None),
+    split: Option(bool, description = "Split the amount between all recipients instead of sending it to each", required = False, default = False)
+):
+    '''
+    Adds the command /giftmany
+
+    All recipients are paid in a single transaction.
+    '''
+
+    # Gather recipients from mentions and channel, without the sender
+    members = gather_members(context.guild, recipients, channel)
+    members.pop(context.author.id, None)
+
+    if not members:
+        log_event(WARNING, "electrum.giftmany", "{user} tried to send electrum at GUILD[{guild}], CHANNEL[{channel}], but there were no recipients", user = context.author, guild = context.guild, channel = context.channel, outcome = "no recipients")
+        await context.respond("There's nobody to send electrum to!")
+        return
 
-@bot_client.slash_command(name = "rollcall", description = "Reward a user with 1 electrum for showing up at a session!", guild_only = True)
+    if split:
+        amounts = dict(zip(members, split_amount(electrum, len(members))))
+    else:
+        amounts = {id: electrum for id in members}
+
+    balances = await user_cache.run_sql([context.author.id, *amounts], User.transfer, context.author.id, amounts)
+
+    if balances is None:
+        # If trying to send more money than user owns
+        log_event(WARNING, "electrum.giftmany", "{user} tried to send {total} electrum to {count} users at GUILD[{guild}], CHANNEL[{channel}], but didn't have enough money", user = context.author, guild = context.guild, channel = context.channel, outcome = "insufficient", total = sum(amounts.values()), count = len(amounts), split = split)
+        await context.respond("You don't have that much money!")
+    else:
+        log_event(INFO, "electrum.giftmany", "{user} sent {total} electrum to {count} users at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", total = sum(amounts.values()), count = len(amounts), split = split, amounts = amounts)
+        log_event(DEBUG, "electrum.balance", "New balances are {balances}", user = context.author, balances = balances)
+        await context.respond("Sent " + ", ".join("**" + str(amount) + "** to " + members[id].mention for id, amount in amounts.items()) + ".")
+
+@bot_client.slash_command(name = "rollcall", description = "Reward users with 1 electrum for showing up at a session!", guild_only = True)
 async def rollcall(
     context: ApplicationContext,
-    user: Option(DiscordUser, description = "Discord user to reward", required = True)
+    user: Option(DiscordUser, description = "Discord user to reward", required = False, default = None),
+    recipients: Option(str, description = "Mentions of users and roles to reward", required = False, default = ""),
+    channel: Option(VoiceChannel, description = "Voice channel whose members to reward, except yourself", required = False, default = None)
 ):
     '''
     Adds the command /rollcall
+
+    Everyone is rewarded in a single transaction.
     '''
 
     if context.author.id in perms["dm"]:
-        log(get_time() + " >> DM " + str(context.author) + " at GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "] rollcalled " + str(user))
-        
-        session = database_connector()
-        user_data = User.find_user(session, user.id)
-        user_data.add_electrum(session, 1)
-        log("                     >> New balance of " + str(user) + " is " + str(user_data.electrum))
-        session.close()
-
-        await context.respond(user.mention + " has been rewarded **1** electrum!")
+        members = gather_members(context.guild, recipients, None)
+        if channel is not None:
+            # The DM running the session is usually in the channel too
+            members.update((id, member) for id, member in gather_members(context.guild, "", channel).items() if id != context.author.id)
+        mentions = {id: member.mention for id, member in members.items()}
+        if user is not None:
+            mentions[user.id] = user.mention
+
+        if not mentions:
+            log_event(WARNING, "electrum.rollcall", "DM {user} tried to rollcall at GUILD[{guild}], CHANNEL[{channel}], but there was nobody to reward", user = context.author, guild = context.guild, channel = context.channel, outcome = "no recipients")
+            await context.respond("There's nobody to reward!")
+            return
+
+        balances = await user_cache.run_sql(mentions, User.credit, {id: 1 for id in mentions}, "rollcall")
+        log_event(INFO, "electrum.rollcall", "DM {user} at GUILD[{guild}], CHANNEL[{channel}] rollcalled {count} users", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", count = len(mentions), recipient_ids = list(mentions), balances = balances)
+
+        await context.respond(", ".join(mentions.values()) + (" has" if len(mentions) == 1 else " have") + " been rewarded **1** electrum!")
     else:
         await context.respond("I don't know you, and I don't care to know you.")
-        log(get_time() + " >> " + str(context.author) + " permission denied in GUILD[" + str(context.guild) + "], CHANNEL[" + str(context.channel) + "]")
\ No newline at end of file
+        log_event(WARNING, "permission.denied", "{user} permission denied in GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "denied", command = context.command.qualified_name)
\ No newline at end of file
@@ -0,0 +1,412 @@
+'''Contains gacha banners, pulling characters from them, and the commands to do so'''
+
+from typing import Dict, List, Optional, Tuple, Any
+from random import random, randrange
+from collections import Counter
+from datetime import datetime
+
+from discord import ApplicationContext, Option, ButtonStyle, Interaction, AllowedMentions
+from discord import User as DiscordUser
+from discord.ui import View, Button, button
+from sqlalchemy.orm import Session
+
+from bot import bot_client, run_db
+from auxiliary import InvalidArgumentError, load_settings, log_event, DEBUG, INFO, WARNING, ERROR
+from usercache import user_cache
+from dbmodels import User, CollectedCharacter, PityCounter
+
+inventory_page_size = 10
+'''Characters shown per page of /gacha inventory'''
+
+gacha_settings = load_settings("gacha", {"characters": {}, "banners": [], "sell_values": {}})
+'''Character names by ID, the definition of every banner, and electrum paid per duplicate sold by rarity; see README.md'''
+
+
+class AliasTable:
+    '''
+    Precomputed table for picking from weighted choices in constant time, no matter how many choices (Vose's alias method)
+
+    ### Attributes
+    chances: List[float]
+        Chance of keeping each column's own choice, rather than its alias
+
+    aliases: List[int]
+        Choice each column falls back to
+
+    ### Methods
+    sample() -> int
+        Picks the index of a choice, with chance proportional to its weight
+    '''
+
+    def __init__(self, weights: List[float]) -> None:
+        total = sum(weights)
+        if not weights or total <= 0 or min(weights) < 0:
+            raise InvalidArgumentError("Weights must be non-negative, and not all zero")
+
+        # Scale so the average column is exactly full, then top up each underfull column from an overfull one
+        scaled = [weight * len(weights) / total for weight in weights]
+        self.chances = [1.0] * len(weights)
+        self.aliases = list(range(len(weights)))
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            under = small.pop()
+            over = large.pop()
+            self.chances[under] = scaled[under]
+            self.aliases[under] = over
+            scaled[over] -= 1 - scaled[under]
+            (small if scaled[over] < 1 else large).append(over)
+        # Anything left over is full, save for rounding error
+
+    def sample(self) -> int:
+        '''
+        Picks the index of a choice, with chance proportional to its weight
+        '''
+
+        column = randrange(len(self.chances))
+        return column if random() < self.chances[column] else self.aliases[column]
+
+class Banner:
+    '''
+    A gacha banner, with every table needed to pull from it precomputed
+
+    ### Attributes
+    id: int
+        Internal ID of the banner
+
+    name: str
+        Name shown to users
+
+    cost: int
+        Electrum per pull
+
+    rarities: List[int]
+        Every rarity on the banner, from lowest to highest
+
+    rarity_table: AliasTable
+        Picks an index of rarities by their weights
+
+    characters: Dict[int, List[int]]
+        Internal IDs of the characters of each rarity
+
+    character_tables: Dict[int, AliasTable]
+        Picks an index of characters within each rarity by their weights
+
+    pity: Dict[int, int]
+        For some rarities, the number of pulls that guarantees a character of at least that rarity
+
+    ### Methods
+    pull(counters: Dict[int, int]) -> Tuple[int, int]
+        Pulls a single character, counting it towards pity
+    '''
+
+    def __init__(self, definition: Dict[str, Any]) -> None:
+        self.id = int(definition["id"])
+        self.name = str(definition["name"])
+        self.cost = int(definition.get("cost", 10))
+
+        rarities = {int(rarity): value for rarity, value in definition["rarities"].items()}
+        self.rarities = sorted(rarities)
+        self.rarity_table = AliasTable([float(rarities[rarity]["weight"]) for rarity in self.rarities])
+
+        self.characters: Dict[int, List[int]] = {}
+        self.character_tables: Dict[int, AliasTable] = {}
+        for rarity in self.rarities:
+            # Either a list of equally likely IDs, or weights by ID
+            characters = rarities[rarity]["characters"]
+            if not isinstance(characters, dict):
+                characters = {id: 1 for id in characters}
+            self.characters[rarity] = [int(id) for id in characters]
+            self.character_tables[rarity] = AliasTable([float(weight) for weight in characters.values()])
+
+        self.pity = {int(rarity): int(pulls) for rarity, pulls in definition.get("pity", {}).items()}
+        if any(rarity not in rarities or pulls < 1 for rarity, pulls in self.pity.items()):
+            raise InvalidArgumentError("Pity must be at least 1 pull, for a rarity on the banner")
+
+    def pull(self, counters: Dict[int, int]) -> Tuple[int, int]:
+        '''
+        Pulls a single character, counting it towards pity; O(number of pity rarities)
+
+        ### Parameters
+        counters: Dict[int, int]
+            Pulls since the last character of each pity rarity or higher, as given by PityCounter.load(); updated in place
+
+        ### Returns
+        (rarity, internal character ID) pulled
+        '''
+
+        for rarity in self.pity:
+            counters[rarity] = counters.get(rarity, 0) + 1
+
+        rarity = self.rarities[self.rarity_table.sample()]
+        # Pity raises the result to the highest rarity that is due
+        due = [pity_rarity for pity_rarity, pulls in self.pity.items() if counters[pity_rarity] >= pulls]
+        if due:
+            rarity = max(rarity, max(due))
+
+        for pity_rarity in self.pity:
+            if pity_rarity <= rarity:
+                counters[pity_rarity] = 0
+
+        return rarity, self.characters[rarity][self.character_tables[rarity].sample()]
+
+def load_banners() -> Dict[int, Banner]:
+    '''
+    Builds every banner defined in settings/gacha.json; invalid banners are logged and left out
+
+    ### Returns
+    Every banner by internal ID
+    '''
+
+    banners: Dict[int, Banner] = {}
+    for definition in gacha_settings["banners"]:
+        try:
+            banner = Banner(definition)
+        except (KeyError, TypeError, ValueError, InvalidArgumentError) as error:
+            log_event(ERROR, "gacha.banner", "Banner {banner} is invalid! {error!r}", outcome = "invalid", banner = definition.get("name", definition.get("id")), error = error)
+        else:
+            banners[banner.id] = banner
+    return banners
+
+banners = load_banners()
+'''Every banner that can be pulled from, by internal ID'''
+character_rarities = {char_id: rarity for rarity, char_id in sorted((rarity, char_id) for banner in banners.values() for rarity, characters in banner.characters.items() for char_id in characters)}
+'''Rarity of every character on a banner, by internal ID; the highest, if on several (sorted so that it is set last)'''
+sell_values = {int(rarity): int(value) for rarity, value in gacha_settings["sell_values"].items()}
+'''Electrum paid per duplicate sold, by rarity'''
+
+def character_name(char_id: int) -> str:
+    '''
+    Returns the name of a character, as set in settings/gacha.json
+    '''
+
+    return gacha_settings["characters"].get(str(char_id), "Character #" + str(char_id))
+
+def pull_characters(session: Session, user_id: int, banner: Banner, count: int) -> Optional[Tuple[List[Tuple[int, int]], List[int], int]]:
+    '''
+    Charges a user for a number of pulls on a banner, pulls them, and adds the characters to their inventory, all in the same transaction; runs on the database thread.
+
+    Bypasses the user cache; call through usercache.user_cache.run_sql().
+
+    ### Parameters
+    session: Session
+        Database session scope
+
+    user_id: int
+        Discord user ID of the puller
+
+    banner: Banner
+        Banner to pull from
+
+    count: int
+        Number of pulls
+
+    ### Returns
+    (rarity, internal character ID) of each pull, internal IDs of characters that are new to the user, and the user's new balance;
+    or None if the user does not have enough electrum (nothing is changed)
+    '''
+
+    balance = User.debit(session, user_id, banner.cost * count, "gacha")
+    if balance is None:
+        return None
+
+    counters = PityCounter.load(session, user_id, banner.id)
+    pulls = [banner.pull(counters) for _ in range(count)]
+    PityCounter.save(session, user_id, banner.id, counters)
+
+    new = CollectedCharacter.collect(session, banner.id, dict(Counter((user_id, char_id) for _, char_id in pulls)))
+    return pulls, [char_id for _, char_id in new], balance
+
+def sell_value(char_id: int) -> int:
+    '''
+    Returns the electrum paid for selling one duplicate of a character, by its highest rarity on any banner; 1 if not set
+    '''
+
+    return sell_values.get(character_rarities.get(char_id), 1)
+
+def sell_duplicates(session: Session, user_id: int) -> Tuple[Dict[int, int], int, int]:
+    '''
+    Sells every duplicate a user owns and pays them for it, in the same transaction; runs on the database thread.
+
+    Bypasses the user cache; call through usercache.user_cache.run_sql().
+
+    ### Parameters
+    session: Session
+        Database session scope
+
+    user_id: int
+        Discord user ID of the seller
+
+    ### Returns
+    Number of duplicates sold of each character by internal ID, the electrum paid, and the user's new balance
+    '''
+
+    sold = CollectedCharacter.sell_duplicates(session, user_id)
+    payout = sum(count * sell_value(char_id) for char_id, count in sold.items())
+    balance = User.credit(session, {user_id: payout}, "sell")[user_id] if payout else 0
+    return sold, payout, balance
+
+
+gacha_cmds = bot_client.create_group("gacha", "Pull characters from banners with electrum")
+
+@gacha_cmds.command(name = "banners", description = "See every banner you can pull from")
+async def gacha_banners(context: ApplicationContext):
+    '''
+    Adds the command /gacha banners
+    '''
+
+    log_event(INFO, "gacha.banners", "{user} queried banners at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok")
+    if not banners:
+        await context.respond("No banners are running right now.")
+        return
+
+    lines = []
+    for banner in banners.values():
+        line = "**" + str(banner.id) + ". " + banner.name + "** - " + str(banner.cost) + " electrum per pull"
+        if banner.pity:
+            line += " (guaranteed " + ", ".join(str(rarity) + "★ within " + str(pulls) for rarity, pulls in sorted(banner.pity.items(), reverse = True)) + ")"
+        lines.append(line)
+    await context.respond("\n".join(lines))
+
+@gacha_cmds.command(name = "pull", description = "Spend electrum to pull characters from a banner")
+async def gacha_pull(
+    context: ApplicationContext,
+    banner: Option(int, description = "ID of the banner to pull from; see /gacha banners", required = True),
+    count: Option(int, description = "Number of pulls", required = False, default = 1, choices = [1, 10])
+):
+    '''
+    Adds the command /gacha pull
+
+    The electrum, pity, and every character pulled are written in a single transaction.
+    '''
+
+    pulled_banner = banners.get(banner)
+    if pulled_banner is None:
+        log_event(WARNING, "gacha.pull", "{user} tried to pull from unknown banner {banner} at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "unknown banner", banner = banner)
+        await context.respond("There's no banner with that ID!", ephemeral = True)
+        return
+
+    result = await user_cache.run_sql([context.author.id], pull_characters, context.author.id, pulled_banner, count)
+    if result is None:
+        log_event(WARNING, "gacha.pull", "{user} tried to pull {count} times from banner {banner} at GUILD[{guild}], CHANNEL[{channel}], but didn't have enough money", user = context.author, guild = context.guild, channel = context.channel, outcome = "insufficient", banner = banner, count = count)
+        await context.respond("You need **" + str(pulled_banner.cost * count) + "** electrum for that!")
+        return
+
+    pulls, new, balance = result
+    log_event(INFO, "gacha.pull", "{user} pulled {count} times from banner {banner} at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", banner = banner, count = count, pulls = pulls, new = new)
+    log_event(DEBUG, "electrum.balance", "New balance is {balance}", user = context.author, balance = balance)
+
+    lines = []
+    shown_new = set(new)
+    for rarity, char_id in pulls:
+        line = "★" * rarity + " **" + character_name(char_id) + "**"
+        # Only the first copy of a new character is new
+        if char_id in shown_new:
+            shown_new.discard(char_id)
+            line += " *(new!)*"
+        lines.append(line)
+    await context.respond(context.author.mention + " pulled from **" + pulled_banner.name + "**:\n" + "\n".join(lines) + "\n__-" + str(pulled_banner.cost * count) + " Electrum__")
+
+@gacha_cmds.command(name = "sellduplicates", description = "Sell every duplicate character you own for electrum, keeping one of each")
+async def gacha_sellduplicates(context: ApplicationContext):
+    '''
+    Adds the command /gacha sellduplicates
+
+    Every duplicate is removed and paid for in a single transaction.
+    '''
+
+    sold, payout, balance = await user_cache.run_sql([context.author.id], sell_duplicates, context.author.id)
+    if not sold:
+        log_event(WARNING, "gacha.sell", "{user} tried to sell duplicates at GUILD[{guild}], CHANNEL[{channel}], but had none", user = context.author, guild = context.guild, channel = context.channel, outcome = "none")
+        await context.respond("You don't have any duplicates to sell!")
+        return
+
+    log_event(INFO, "gacha.sell", "{user} sold {count} duplicates for {payout} electrum at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", count = sum(sold.values()), payout = payout, sold = sold)
+    log_event(DEBUG, "electrum.balance", "New balance is {balance}", user = context.author, balance = balance)
+    await context.respond("You sold **" + str(sum(sold.values())) + "** duplicates of " + str(len(sold)) + " characters.\n__+" + str(payout) + " Electrum__")
+
+
+class InventoryView(View):
+    '''
+    Buttons to page through an inventory; each page is read on demand with CollectedCharacter.page(), so no more than a page is ever loaded
+
+    ### Attributes
+    owner: DiscordUser
+        User whose inventory is shown
+
+    viewer_id: int
+        Discord ID of the user who may press the buttons
+
+    by_obtained: bool
+        Whether ordered by when characters were obtained, rather than by character ID
+
+    starts: List[Tuple[datetime, int] | None]
+        Cursor of the start of every page up to the current one, to go back without counting rows
+
+    next_start: Tuple[datetime, int] | None
+        Cursor of the start of the next page, or None if this is the last
+
+    ### Methods
+    [ASYNC] render() -> str
+        Reads the current page and returns it as a message
+    '''
+
+    def __init__(self, owner: DiscordUser, viewer_id: int, by_obtained: bool) -> None:
+        super().__init__(timeout = 300)
+        self.owner = owner
+        self.viewer_id = viewer_id
+        self.by_obtained = by_obtained
+        self.starts: List[Optional[Tuple[datetime, int]]] = [None]
+        self.next_start: Optional[Tuple[datetime, int]] = None
+
+    async def render(self) -> str:
+        '''
+        Reads the current page and returns it as a message, enabling only the buttons that lead somewhere
+        '''
+
+        # One extra row tells whether there is a next page
+        rows = await run_db(CollectedCharacter.page, self.owner.id, self.by_obtained, self.starts[-1], inventory_page_size + 1)
+        page = rows[:inventory_page_size]
+        self.next_start = (page[-1][1], page[-1][0]) if len(rows) > inventory_page_size else None
+        self.previous_page.disabled = len(self.starts) == 1
+        self.next_page.disabled = self.next_start is None
+
+        if not page:
+            return self.owner.mention + " doesn't own any characters yet."
+        lines = [
+            ("★" * character_rarities[char_id] + " " if char_id in character_rarities else "") + "**" + character_name(char_id) + "**"
+            + (" x" + str(dupes) if dupes > 1 else "") + " - obtained " + obtained.strftime("%Y-%m-%d")
+            for char_id, obtained, banner_id, dupes in page
+        ]
+        return "__Inventory of " + self.owner.mention + "__ (page " + str(len(self.starts)) + ")\n" + "\n".join(lines)
+
+    async def interaction_check(self, interaction: Interaction) -> bool:
+        return interaction.user is not None and interaction.user.id == self.viewer_id
+
+    @button(label = "Previous", style = ButtonStyle.secondary)
+    async def previous_page(self, pressed: Button, interaction: Interaction):
+        if len(self.starts) > 1:
+            self.starts.pop()
+        await interaction.response.edit_message(content = await self.render(), view = self, allowed_mentions = AllowedMentions.none())
+
+    @button(label = "Next", style = ButtonStyle.secondary)
+    async def next_page(self, pressed: Button, interaction: Interaction):
+        if self.next_start is not None:
+            self.starts.append(self.next_start)
+        await interaction.response.edit_message(content = await self.render(), view = self, allowed_mentions = AllowedMentions.none())
+
+@gacha_cmds.command(name = "inventory", description = "Page through the characters you (or someone else) own")
+async def gacha_inventory(
+    context: ApplicationContext,
+    user: Option(DiscordUser, description = "Discord user whose inventory to see; yourself if not given", required = False, default = None),
+    sort: Option(str, description = "Order to list characters in", required = False, default = "id", choices = ["id", "obtained"])
+):
+    '''
+    Adds the command /gacha inventory
+    '''
+
+    owner = user or context.author
+    log_event(INFO, "gacha.inventory", "{user} queried the inventory of {owner} at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", owner = owner, owner_id = owner.id, sort = sort)
+
+    view = InventoryView(owner, context.author.id, sort == "obtained")
+    await context.respond(await view.render(), view = view, allowed_mentions = AllowedMentions.none())
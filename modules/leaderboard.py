@@ -0,0 +1,334 @@
+'''Contains the leaderboards of electrum, beacon touches, and Dawnbreaker holders, kept up to date in memory as users change'''
+
+from typing import Dict, List, Optional, Set, Tuple, Any
+from heapq import nlargest
+from asyncio import Task, ensure_future
+
+from discord import ApplicationContext, AllowedMentions, Option
+from sqlalchemy.orm import Session
+
+from bot import bot_client, run_db
+from auxiliary import log_event, INFO, ERROR
+from usercache import user_cache, user_listeners
+from dbmodels import User
+
+board_size = 10
+'''Number of users shown on a leaderboard by default'''
+board_buffer = 50
+'''Number of top users tracked per leaderboard; the extra beyond what is shown absorbs users dropping out, before the database has to be read again'''
+
+ranked_columns = ("electrum", "beacon_touches")
+'''User columns with a leaderboard'''
+
+
+class TopScores:
+    '''
+    The highest values of one User column, maintained incrementally as users change.
+
+    Tracks up to capacity users; every user not tracked is known to have a value of at most floor,
+    so the tracked users are exactly the top of the whole table. Only positive values are ranked.
+
+    ### Attributes
+    capacity: int
+        Maximum number of users tracked
+
+    scores: Dict[int, int]
+        Value of each tracked user, by Discord ID
+
+    floor: int
+        Highest possible value of any user not tracked
+
+    ### Methods
+    load(rows: List[Tuple[int, int]]) -> None
+        Replaces everything tracked with the top rows read from the database
+
+    update(id: int, score: int) -> None
+        Applies the new value of a single user
+
+    top(count: int, partial: bool = False) -> List[Tuple[int, int]] | None
+        Returns the users with the highest values, if enough are tracked
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.scores: Dict[int, int] = {}
+        self.floor = 0
+
+    def load(self, rows: List[Tuple[int, int]]) -> None:
+        '''
+        Replaces everything tracked with the top rows read from the database
+
+        ### Parameters
+        rows: List[Tuple[int, int]]
+            (Discord ID, value) of up to capacity users with the highest positive values, as given by User.top()
+        '''
+
+        self.scores = dict(rows)
+        # If fewer rows than asked for, every user with a positive value is tracked
+        self.floor = rows[-1][1] if len(rows) >= self.capacity else 0
+
+    def update(self, id: int, score: int) -> None:
+        '''
+        Applies the new value of a single user; O(capacity) at worst
+
+        ### Parameters
+        id: int
+            Discord user ID
+
+        score: int
+            New value of the user
+        '''
+
+        if score <= self.floor:
+            # Can be dropped, as untracked users may be anywhere at or below the floor
+            self.scores.pop(id, None)
+            return
+
+        self.scores[id] = score
+        if len(self.scores) > self.capacity:
+            lowest = min(self.scores, key = self.scores.__getitem__)
+            self.floor = self.scores.pop(lowest)
+
+    def top(self, count: int, partial: bool = False) -> Optional[List[Tuple[int, int]]]:
+        '''
+        Returns the users with the highest values, if enough are tracked
+
+        ### Parameters
+        count: int
+            Number of users to return
+
+        partial: bool
+            Whether to return the tracked users anyway if too many dropped out
+
+        ### Returns
+        (Discord ID, value) of each user, from highest to lowest value; or None if too many users dropped out, and the database has to be read again
+        '''
+
+        if len(self.scores) < count and self.floor > 0 and not partial:
+            return None
+        return nlargest(count, self.scores.items(), key = lambda item: item[1])
+
+def read_leaderboards(session: Session, limit: int) -> Tuple[Dict[str, List[Tuple[int, int]]], List[int]]:
+    '''
+    Reads everything needed to rebuild the leaderboards; runs on the database thread.
+
+    ### Parameters
+    session: Session
+        Database session scope
+
+    limit: int
+        Number of top users to read per column
+
+    ### Returns
+    Top (Discord ID, value) rows of each ranked column, and the Discord IDs of every Dawnbreaker holder
+    '''
+
+    return {column: User.top(session, column, limit) for column in ranked_columns}, User.dawnbreaker_holders(session)
+
+
+class Leaderboards:
+    '''
+    Every leaderboard, read from the database once and then kept up to date by listening to changes in the user cache.
+
+    ### Attributes
+    boards: Dict[str, TopScores]
+        Top users of each ranked column
+
+    holders: Set[int]
+        Discord IDs of every user who has obtained the Dawnbreaker
+
+    loaded: bool
+        Whether the leaderboards have been read from the database yet
+
+    loading: Task | None
+        Rebuild in progress, so concurrent requests share one read
+
+    pending: List[Dict[str, Any]] | None
+        Changes of users made while a rebuild reads the database, to apply on top of what it reads
+
+    ### Methods
+    changed(row: Dict[str, Any]) -> None
+        Applies the new state of a user; registered as a user listener
+
+    [ASYNC] top(column: str, count: int) -> List[Tuple[int, int]]
+        Returns the users with the highest values of a column
+
+    [ASYNC] dawnbreaker_holders() -> Set[int]
+        Returns the Discord IDs of every user who has obtained the Dawnbreaker
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.boards = {column: TopScores(capacity) for column in ranked_columns}
+        self.holders: Set[int] = set()
+        self.loaded = False
+        self.loading: Optional[Task] = None
+        self.pending: Optional[List[Dict[str, Any]]] = None
+
+    def changed(self, row: Dict[str, Any]) -> None:
+        '''
+        Applies the new state of a user; registered as a user listener
+
+        ### Parameters
+        row: Dict[str, Any]
+            Column values of the user, as given by usercache.CachedUser.row()
+        '''
+
+        if self.pending is not None:
+            self.pending.append(row)
+        if not self.loaded:
+            return
+
+        for column, board in self.boards.items():
+            board.update(row["id"], row[column])
+        if row["dawnbreaker_progess"] == 20:
+            self.holders.add(row["id"])
+        else:
+            self.holders.discard(row["id"])
+
+    async def rebuild(self) -> None:
+        '''
+        Reads the leaderboards from the database again
+
+        The database lags behind the user cache, so changes not yet written, and any made during the read, are applied on top.
+        '''
+
+        self.pending = user_cache.changed_rows()
+        try:
+            tops, holders = await run_db(read_leaderboards, self.boards[ranked_columns[0]].capacity)
+        finally:
+            pending, self.pending = self.pending, None
+
+        for column, rows in tops.items():
+            self.boards[column].load(rows)
+        self.holders = set(holders)
+        self.loaded = True
+        for row in pending:
+            self.changed(row)
+
+    async def ensure_loaded(self) -> None:
+        '''
+        Rebuilds the leaderboards, sharing a rebuild already in progress
+        '''
+
+        load = self.loading
+        if load is None:
+            load = ensure_future(self.rebuild())
+            self.loading = load
+        try:
+            await load
+        finally:
+            if self.loading is load:
+                self.loading = None
+
+    async def top(self, column: str, count: int) -> List[Tuple[int, int]]:
+        '''
+        Returns the users with the highest values of a column; only reads the database the first time, or once too many users dropped out
+
+        Reads the database at most once per call. Unsaved changes are written first, since changes the read does not see can drop users
+        below the floor again; any changes made meanwhile can still leave fewer than count users known, and then only those are returned.
+
+        ### Parameters
+        column: str
+            One of ranked_columns
+
+        count: int
+            Number of users to return; at most board_buffer
+
+        ### Returns
+        (Discord ID, value) of each user, from highest to lowest value
+        '''
+
+        if self.loaded:
+            top = self.boards[column].top(count)
+            if top is not None:
+                return top
+
+            try:
+                await user_cache.flush()
+            except Exception as error:
+                # Still read; at worst the board comes up short
+                log_event(ERROR, "cache.flush", "Failed to save user data before reading leaderboards! {error!r}", outcome = "failed", error = error)
+
+        await self.ensure_loaded()
+        return self.boards[column].top(count, partial = True)
+
+    async def dawnbreaker_holders(self) -> Set[int]:
+        '''
+        Returns the Discord IDs of every user who has obtained the Dawnbreaker
+        '''
+
+        if not self.loaded:
+            await self.ensure_loaded()
+        return self.holders
+
+leaderboards = Leaderboards(board_buffer)
+'''Global leaderboards'''
+user_listeners.append(leaderboards.changed)
+
+
+leaderboard_cmds = bot_client.create_group("leaderboard", "See who is ahead of everyone else")
+
+def board_lines(top: List[Tuple[int, int]], unit: str) -> str:
+    '''
+    Formats leaderboard entries as numbered lines
+
+    ### Parameters
+    top: List[Tuple[int, int]]
+        (Discord ID, value) of each user, from highest to lowest value
+
+    unit: str
+        What the values count, i.e. "electrum"
+
+    ### Returns
+    One line per user, mentioning them
+    '''
+
+    return "\n".join("**" + str(rank) + ".** <@" + str(id) + "> - " + str(score) + " " + unit for rank, (id, score) in enumerate(top, 1))
+
+@leaderboard_cmds.command(name = "electrum", description = "See who owns the most electrum")
+async def leaderboard_electrum(
+    context: ApplicationContext,
+    count: Option(int, description = "Number of users to show", required = False, default = board_size, min_value = 1, max_value = board_buffer)
+):
+    '''
+    Adds the command /leaderboard electrum
+    '''
+
+    top = await leaderboards.top("electrum", count)
+    log_event(INFO, "leaderboard.electrum", "{user} queried the electrum leaderboard at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", count = count)
+
+    if not top:
+        await context.respond("Nobody owns any electrum yet.")
+        return
+    await context.respond("__Most electrum__\n" + board_lines(top, "electrum"), allowed_mentions = AllowedMentions.none())
+
+@leaderboard_cmds.command(name = "touches", description = "See who has touched the beacon the most")
+async def leaderboard_touches(
+    context: ApplicationContext,
+    count: Option(int, description = "Number of users to show", required = False, default = board_size, min_value = 1, max_value = board_buffer)
+):
+    '''
+    Adds the command /leaderboard touches
+    '''
+
+    top = await leaderboards.top("beacon_touches", count)
+    log_event(INFO, "leaderboard.touches", "{user} queried the beacon touch leaderboard at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", count = count)
+
+    if not top:
+        await context.respond("Nobody has touched the beacon yet.")
+        return
+    await context.respond("__Most beacon touches__\n" + board_lines(top, "touches"), allowed_mentions = AllowedMentions.none())
+
+@leaderboard_cmds.command(name = "dawnbreaker", description = "See everyone who has obtained the Dawnbreaker")
+async def leaderboard_dawnbreaker(context: ApplicationContext):
+    '''
+    Adds the command /leaderboard dawnbreaker
+    '''
+
+    holders = await leaderboards.dawnbreaker_holders()
+    log_event(INFO, "leaderboard.dawnbreaker", "{user} queried the Dawnbreaker holders at GUILD[{guild}], CHANNEL[{channel}]", user = context.author, guild = context.guild, channel = context.channel, outcome = "ok", holders = len(holders))
+
+    if not holders:
+        await context.respond("*None have yet proven worthy of the Dawnbreaker.*")
+        return
+    await context.respond("__Wielders of the Dawnbreaker__ (" + str(len(holders)) + ")\n" + ", ".join("<@" + str(id) + ">" for id in sorted(holders)), allowed_mentions = AllowedMentions.none())
@@ -0,0 +1,359 @@
+'''Contains the versioned schema migrations of the database, and the runner that applies them in place without losing data; run through db.py'''
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+import sqlite3
+
+from sqlalchemy import Column, Connection, Engine, Table, inspect, insert, select
+from sqlalchemy.schema import CreateColumn, CreateTable
+
+from bot import SQLBase, database_engine, storage_profile, create_database_engine
+from auxiliary import log_event, INFO
+from dbmodels import User, CollectedCharacter, PityCounter, LedgerEntry, HourlyRollup, DailyRollup, PendingDeletion, PendingEdit, SchemaVersion
+
+rebuild_batch_size = 5000
+'''Rows copied per transaction when rebuilding a table'''
+rebuild_pause = 0.05
+'''Seconds to wait between batches when rebuilding a table, so that the bot's own writes get a turn'''
+rebuild_prefix = "_rebuild_"
+'''Prefix of the name of a table, and of its triggers, while it is being rebuilt'''
+
+
+class Migrator:
+    '''
+    Schema changes that a migration can make. Every change skips whatever already exists, so an interrupted migration can simply be run again,
+    and a database created from the current models goes through every migration without changes.
+
+    ### Attributes
+    engine: Engine
+        Database to change
+
+    batch_size: int
+        Rows copied per transaction when rebuilding a table
+
+    pause: float
+        Seconds to wait between batches when rebuilding a table
+
+    rows_copied: int
+        Rows copied by table rebuilds so far
+
+    ### Methods
+    create_table(table: Table) -> None
+        Creates a table and its indexes
+
+    create_index(table: Table, name: str) -> None
+        Creates an index of a table
+
+    add_column(table: Table, name: str) -> None
+        Adds a column to an existing table
+
+    rebuild_table(table: Table, expressions: Dict[str, str] | None = None) -> None
+        Recreates a table with its current definition, copying its rows in batches while it stays in use
+    '''
+
+    def __init__(self, engine: Engine, batch_size: int, pause: float) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.pause = pause
+        self.rows_copied = 0
+
+    @contextmanager
+    def transaction(self) -> Iterator[Connection]:
+        '''
+        Runs a transaction that takes the write lock as it starts, so that it waits for other writers (up to the busy timeout)
+        rather than failing when it first writes after reading
+        '''
+
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            yield connection
+            connection.commit()
+
+    def create_table(self, table: Table) -> None:
+        '''
+        Creates a table as currently defined, and any of its indexes that are missing; an existing table is left as it is
+        '''
+
+        with self.transaction() as connection:
+            table.create(connection, checkfirst = True)
+            # create() only creates indexes along with a new table
+            for index in table.indexes:
+                index.create(connection, checkfirst = True)
+
+    def create_index(self, table: Table, name: str) -> None:
+        '''
+        Creates an index of a table, as currently defined on it
+        '''
+
+        index = next(index for index in table.indexes if index.name == name)
+        with self.transaction() as connection:
+            index.create(connection, checkfirst = True)
+
+    def add_column(self, table: Table, name: str) -> None:
+        '''
+        Adds a column, as currently defined, to an existing table. SQLite only allows adding a column that is nullable or has a server default;
+        rebuild the table for any other change.
+        '''
+
+        with self.transaction() as connection:
+            if name in {column["name"] for column in inspect(connection).get_columns(table.name)}:
+                return
+            column: Column = table.c[name]
+            connection.exec_driver_sql("ALTER TABLE " + self.quote(table.name) + " ADD COLUMN " + str(CreateColumn(column).compile(dialect = connection.dialect)))
+
+    def rebuild_table(self, table: Table, expressions: Optional[Dict[str, str]] = None) -> None:
+        '''
+        Recreates a table with its current definition, for changes SQLite cannot make in place (types, constraints, dropped columns).
+
+        The new table is filled in bounded batches, each its own transaction, so that the bot can keep using the old one meanwhile;
+        triggers mirror every write to rows of the old table into the new one as it happens. Once every row is copied, the old table is
+        swapped out for the new one in a single transaction. The primary key must keep the same columns.
+
+        ### Parameters
+        table: Table
+            Table to rebuild, as currently defined
+
+        expressions: Dict[str, str] | None
+            SQL expression over the columns of the old table for each new column that is not simply copied, by column name;
+            new columns with neither are left to their server default
+        '''
+
+        expressions = expressions or {}
+        name = self.quote(table.name)
+        temporary = self.quote(rebuild_prefix + table.name)
+
+        with self.transaction() as connection:
+            if not inspect(connection).has_table(table.name):
+                table.create(connection)
+                return
+            old_columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+
+            # Leftovers of an interrupted rebuild
+            self.drop_triggers(connection, table.name)
+            connection.exec_driver_sql("DROP TABLE IF EXISTS " + temporary)
+
+            # Same definition, including foreign keys, under the temporary name
+            definition = str(CreateTable(table).compile(dialect = connection.dialect))
+            connection.exec_driver_sql(definition.replace("CREATE TABLE " + connection.dialect.identifier_preparer.format_table(table), "CREATE TABLE " + temporary, 1))
+
+            copied = {column.name: expressions.get(column.name, self.quote(column.name)) for column in table.columns if column.name in expressions or column.name in old_columns}
+            columns = ", ".join(self.quote(column) for column in copied)
+            values = ", ".join(copied.values())
+            same_key = " AND ".join(self.quote(column.name) + " = OLD." + self.quote(column.name) for column in table.primary_key.columns)
+            copy_row = "INSERT OR REPLACE INTO " + temporary + " (" + columns + ") SELECT " + values + " FROM " + name + " WHERE rowid = NEW.rowid;"
+            remove_row = "DELETE FROM " + temporary + " WHERE " + same_key + ";"
+
+            triggers = {"insert": "INSERT", "update": "UPDATE", "delete": "DELETE"}
+            actions = {"insert": copy_row, "update": remove_row + " " + copy_row, "delete": remove_row}
+            for suffix, operation in triggers.items():
+                connection.exec_driver_sql(
+                    "CREATE TRIGGER " + self.quote(rebuild_prefix + table.name + "_" + suffix) + " AFTER " + operation + " ON " + name
+                    + " BEGIN " + actions[suffix] + " END"
+                    )
+
+        # Rows written through the triggers are newer than the batch, so they are kept
+        last: Optional[int] = None
+        while True:
+            with self.transaction() as connection:
+                upper = connection.exec_driver_sql(
+                    "SELECT max(rowid) FROM (SELECT rowid FROM " + name + " WHERE ? IS NULL OR rowid > ? ORDER BY rowid LIMIT ?)",
+                    (last, last, self.batch_size)
+                    ).scalar()
+                if upper is None:
+                    break
+                copied_rows = connection.exec_driver_sql(
+                    "INSERT OR IGNORE INTO " + temporary + " (" + columns + ") SELECT " + values + " FROM " + name + " WHERE (? IS NULL OR rowid > ?) AND rowid <= ?",
+                    (last, last, upper)
+                    ).rowcount
+            self.rows_copied += copied_rows
+            last = upper
+            sleep(self.pause)
+
+        with self.transaction() as connection:
+            self.drop_triggers(connection, table.name)
+            connection.exec_driver_sql("DROP TABLE " + name)
+            connection.exec_driver_sql("ALTER TABLE " + temporary + " RENAME TO " + name)
+            for index in table.indexes:
+                index.create(connection)
+
+    def drop_triggers(self, connection: Connection, table_name: str) -> None:
+        '''
+        Drops the triggers of a rebuild of a table, if any
+        '''
+
+        for suffix in ("insert", "update", "delete"):
+            connection.exec_driver_sql("DROP TRIGGER IF EXISTS " + self.quote(rebuild_prefix + table_name + "_" + suffix))
+
+    def quote(self, name: str) -> str:
+        '''
+        Quotes a table, column, or trigger name for SQLite
+        '''
+
+        return '"' + name.replace('"', '""') + '"'
+
+class Migration:
+    '''
+    A single versioned change to the schema
+
+    ### Attributes
+    version: int
+        Order the migration is applied in; never reuse or renumber one that has shipped
+
+    name: str
+        What the migration changes
+
+    apply: Callable[[Migrator], None]
+        Makes the change
+    '''
+
+    def __init__(self, version: int, name: str, apply: Callable[[Migrator], None]) -> None:
+        self.version = version
+        self.name = name
+        self.apply = apply
+
+migrations: List[Migration] = []
+'''Every migration, in order of version'''
+
+def migration(version: int, name: str) -> Callable[[Callable[[Migrator], None]], Callable[[Migrator], None]]:
+    '''
+    Registers a function as the migration to a new version of the schema
+
+    ### Parameters
+    version: int
+        Version number; must be higher than every migration before it
+
+    name: str
+        What the migration changes
+    '''
+
+    def register(apply: Callable[[Migrator], None]) -> Callable[[Migrator], None]:
+        if migrations and version <= migrations[-1].version:
+            raise ValueError("Migration " + str(version) + " must come after migration " + str(migrations[-1].version))
+        migrations.append(Migration(version, name, apply))
+        return apply
+
+    return register
+
+
+@migration(1, "Create users and their characters")
+def create_users(migrator: Migrator) -> None:
+    migrator.create_table(User.__table__)
+    migrator.create_table(CollectedCharacter.__table__)
+
+@migration(2, "Add the electrum ledger and its hourly and daily rollups")
+def create_ledger(migrator: Migrator) -> None:
+    migrator.create_table(LedgerEntry.__table__)
+    migrator.create_table(HourlyRollup.__table__)
+    migrator.create_table(DailyRollup.__table__)
+
+@migration(3, "Index users for leaderboards")
+def index_leaderboards(migrator: Migrator) -> None:
+    for name in ("ix_user_electrum", "ix_user_beacon_touches", "ix_user_dawnbreaker_progess"):
+        migrator.create_index(User.__table__, name)
+
+@migration(4, "Add gacha pity counters")
+def create_pity(migrator: Migrator) -> None:
+    migrator.create_table(PityCounter.__table__)
+
+@migration(5, "Index inventories by when characters were obtained")
+def index_inventories(migrator: Migrator) -> None:
+    migrator.create_index(CollectedCharacter.__table__, "ix_collected_char_owner_obtained")
+
+@migration(6, "Add pending message deletions")
+def create_pending_deletions(migrator: Migrator) -> None:
+    migrator.create_table(PendingDeletion.__table__)
+
+@migration(7, "Add pending message edits")
+def create_pending_edits(migrator: Migrator) -> None:
+    migrator.create_table(PendingEdit.__table__)
+
+
+def applied_versions(engine: Engine) -> List[int]:
+    '''
+    Returns the version of every migration applied to a database, creating the table that records them if needed
+    '''
+
+    SchemaVersion.__table__.create(engine, checkfirst = True)
+    with engine.connect() as connection:
+        return list(connection.execute(select(SchemaVersion.version).order_by(SchemaVersion.version)).scalars())
+
+def pending_migrations(engine: Engine = database_engine) -> List[Migration]:
+    '''
+    Returns every migration not yet applied to a database, in order
+    '''
+
+    applied = set(applied_versions(engine))
+    return [migration for migration in migrations if migration.version not in applied]
+
+def migrate(engine: Engine = database_engine, batch_size: int = rebuild_batch_size, pause: float = rebuild_pause) -> List[Tuple[Migration, float, int]]:
+    '''
+    Applies every pending migration in order, recording each once it finishes; safe to run while the bot is running
+
+    ### Parameters
+    engine: Engine
+        Database to migrate
+
+    batch_size: int
+        Rows copied per transaction when rebuilding a table
+
+    pause: float
+        Seconds to wait between batches when rebuilding a table
+
+    ### Returns
+    Each migration applied, with the seconds it took and the rows it copied
+    '''
+
+    applied: List[Tuple[Migration, float, int]] = []
+    for migration in pending_migrations(engine):
+        start = perf_counter()
+        migrator = Migrator(engine, batch_size, pause)
+        migration.apply(migrator)
+        with engine.begin() as connection:
+            connection.execute(insert(SchemaVersion).values(version = migration.version, name = migration.name, applied = datetime.utcnow()))
+        seconds = perf_counter() - start
+
+        log_event(INFO, "db.migrate", "Applied migration {version} ({name}) to {database} in {seconds:.2f}s, copying {rows} rows", database = engine.url.database, version = migration.version, name = migration.name, seconds = seconds, rows = migrator.rows_copied)
+        applied.append((migration, seconds, migrator.rows_copied))
+    return applied
+
+def copy_database(source: str, destination: str) -> None:
+    '''
+    Copies a database with SQLite's backup API, so that a copy taken while the bot runs is still consistent; a missing source gives an empty copy
+    '''
+
+    with sqlite3.connect(destination) as target:
+        if exists(source):
+            with sqlite3.connect(source) as origin:
+                origin.backup(target)
+
+def dry_run(source: str = "database/db.sqlite", batch_size: int = rebuild_batch_size, pause: float = rebuild_pause) -> List[Tuple[Migration, float, int]]:
+    '''
+    Applies every pending migration to a temporary copy of a database, to estimate how long the real run takes; the database itself is untouched
+
+    ### Returns
+    Each migration that would be applied, with the seconds it took on the copy and the rows it copied
+    '''
+
+    with TemporaryDirectory() as directory:
+        path = join(directory, "db.sqlite")
+        copy_database(source, path)
+        engine = create_database_engine(path, storage_profile)
+        try:
+            return migrate(engine, batch_size, pause)
+        finally:
+            engine.dispose()
+
+def reset(engine: Engine = database_engine) -> None:
+    '''
+    Deletes every table and recreates the current schema, marking every migration as applied. Loses all data!
+    '''
+
+    SQLBase.metadata.drop_all(engine)
+    SQLBase.metadata.create_all(engine)
+    with engine.begin() as connection:
+        now = datetime.utcnow()
+        connection.execute(insert(SchemaVersion), [{"version": migration.version, "name": migration.name, "applied": now} for migration in migrations])
@@ -0,0 +1,235 @@
+'''Contains the per-channel outbox that merges messages sent to the same channel close together, and Response for building a handler's reply'''
+
+from typing import Dict, List, Optional, Tuple
+from asyncio import Future, Task, ensure_future, gather, get_running_loop, sleep
+
+from discord import Message
+from discord.abc import Messageable
+
+from auxiliary import log_event, load_settings, ERROR
+from deletions import message_deletions
+
+outbox_settings = load_settings("outbox", {"merge_window": 0.25})
+
+merge_window: float = outbox_settings["merge_window"]
+'''Seconds that the first message to a channel waits for others to merge with'''
+message_limit = 2000
+'''Maximum characters of a Discord message'''
+
+
+class Part:
+    '''
+    A piece of text to send, as its own paragraph of a message
+
+    ### Attributes
+    content: str
+        Text to send
+
+    delete_after: float | None
+        Seconds after sending to remove this text; None to keep it
+
+    sent: Future
+        Completed once the message holding this text is sent; raises whatever sending raised
+    '''
+
+    def __init__(self, content: str, delete_after: Optional[float]) -> None:
+        self.content = content[:message_limit]
+        self.delete_after = delete_after
+        self.sent: Future = get_running_loop().create_future()
+
+class ChannelOutbox:
+    '''
+    Sends text to channels, merging everything sent to the same channel within merge_window into as few messages as fit
+
+    Each channel with waiting text has one task that sends it in order. A merged message keeps every part for as long as it asked for:
+    once a part expires, the message is edited to leave it out, and deleted once no part is left; both are left to the deletion scheduler,
+    so that they still happen after a restart.
+
+    ### Attributes
+    waiting: Dict[int, Tuple[Messageable, List[Part]]]
+        Channel and parts not yet sent, by channel ID
+
+    senders: Dict[int, Task]
+        Task sending the parts of each channel with any waiting
+
+    ### Methods
+    send(channel: Messageable, parts: List[Part]) -> None
+        Queues parts to be sent to a channel
+    '''
+
+    def __init__(self) -> None:
+        self.waiting: Dict[int, Tuple[Messageable, List[Part]]] = {}
+        self.senders: Dict[int, Task] = {}
+
+    def send(self, channel: Messageable, parts: List[Part]) -> None:
+        '''
+        Queues parts to be sent to a channel; await Part.sent to know when they are
+
+        ### Parameters
+        channel: Messageable
+            Channel to send to
+
+        parts: List[Part]
+            Parts to send, in order
+        '''
+
+        self.waiting.setdefault(channel.id, (channel, []))[1].extend(parts)
+        if channel.id not in self.senders:
+            sender = ensure_future(self.run(channel.id))
+            sender.add_done_callback(lambda sender: self.abandoned(channel.id, sender))
+            self.senders[channel.id] = sender
+
+    async def run(self, channel_id: int) -> None:
+        '''
+        Sends the parts of a channel until none are left waiting
+        '''
+
+        parts: List[Part] = []
+        try:
+            while channel_id in self.waiting:
+                await sleep(merge_window)
+                channel, parts = self.waiting.pop(channel_id)
+                for message_parts in self.pack(parts):
+                    await self.deliver(channel, message_parts)
+        except BaseException as error:
+            # i.e. cancelled at shutdown; whatever was not sent is failed, so that nobody waits on it forever
+            _, left = self.waiting.pop(channel_id, (None, []))
+            self.fail(parts + left, error)
+            raise
+        finally:
+            del self.senders[channel_id]
+
+    def abandoned(self, channel_id: int, sender: Task) -> None:
+        '''
+        Fails the waiting parts of a channel if its sender was cancelled before it ever ran; run() cleans up after itself otherwise
+        '''
+
+        if sender.cancelled() and self.senders.get(channel_id) is sender:
+            del self.senders[channel_id]
+            _, left = self.waiting.pop(channel_id, (None, []))
+            self.fail(left, None)
+
+    def fail(self, parts: List[Part], error: Optional[BaseException]) -> None:
+        '''
+        Completes every part not yet sent with an error, or cancels them if there is no error to give
+        '''
+
+        for part in parts:
+            if part.sent.done():
+                continue
+            if isinstance(error, Exception):
+                part.sent.set_exception(error)
+            else:
+                part.sent.cancel()
+
+    def pack(self, parts: List[Part]) -> List[List[Part]]:
+        '''
+        Splits parts, in order, into as few messages as fit within message_limit
+        '''
+
+        messages: List[List[Part]] = []
+        length = 0
+        for part in parts:
+            if messages and length + 1 + len(part.content) <= message_limit:
+                messages[-1].append(part)
+                length += 1 + len(part.content)
+            else:
+                messages.append([part])
+                length = len(part.content)
+        return messages
+
+    async def deliver(self, channel: Messageable, parts: List[Part]) -> None:
+        '''
+        Sends parts as a single message, and schedules the removal of any that expire
+        '''
+
+        try:
+            message = await channel.send("\n".join(part.content for part in parts))
+        except Exception as error:
+            for part in parts:
+                part.sent.set_exception(error)
+            return
+
+        for part in parts:
+            part.sent.set_result(message)
+
+        lifetimes = sorted({part.delete_after for part in parts if part.delete_after is not None})
+        if len(lifetimes) < len({part.delete_after for part in parts}):
+            # Some parts stay, so the message is only ever edited
+            edits = lifetimes
+        else:
+            edits = lifetimes[:-1]
+        try:
+            if edits:
+                await message_deletions.schedule_edits(message, [
+                    (lifetime, "\n".join(part.content for part in parts if part.delete_after is None or part.delete_after > lifetime))
+                    for lifetime in edits
+                    ])
+            if len(edits) < len(lifetimes):
+                await message_deletions.schedule(message, lifetimes[-1])
+        except Exception as error:
+            # The message is sent either way; only its expiry is lost
+            log_event(ERROR, "outbox.expire", "Failed to schedule the expiry of a message in CHANNEL[{channel}]! {error!r}", channel = channel, outcome = "failed", error = error, message_id = message.id)
+
+outbox = ChannelOutbox()
+'''Outbox of every channel'''
+
+
+class Response:
+    '''
+    Collects everything a handler says to a channel, to be sent together as one message through the outbox
+
+    ### Attributes
+    channel: Messageable
+        Channel to respond in
+
+    parts: List[Part]
+        Text added so far, in order
+
+    ### Methods
+    add(content: str, delete_after: float | None = None) -> None
+        Adds text to the response
+
+    async send() -> Message | None
+        Sends the response
+    '''
+
+    def __init__(self, channel: Messageable) -> None:
+        self.channel = channel
+        self.parts: List[Part] = []
+
+    def add(self, content: str, delete_after: Optional[float] = None) -> None:
+        '''
+        Adds text to the response, as its own paragraph
+
+        ### Parameters
+        content: str
+            Text to add
+
+        delete_after: float | None
+            Seconds after sending to remove this text; None to keep it
+        '''
+
+        self.parts.append(Part(content, delete_after))
+
+    async def send(self) -> Optional[Message]:
+        '''
+        Sends the response through the outbox, waiting until it is sent; does nothing if nothing was added
+
+        ### Returns
+        Message holding the start of the response, or None if nothing was added
+
+        ### Throws
+        discord.HTTPException
+            Sending failed
+        '''
+
+        if not self.parts:
+            return None
+        parts, self.parts = self.parts, []
+        outbox.send(self.channel, parts)
+        messages = await gather(*(part.sent for part in parts), return_exceptions = True)
+        for message in messages:
+            if isinstance(message, BaseException):
+                raise message
+        return messages[0]
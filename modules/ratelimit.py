@@ -0,0 +1,63 @@
+'''Contains token buckets for limiting how often something may happen per key, i.e. per user and channel'''
+
+from typing import Hashable, Tuple
+from collections import OrderedDict
+from time import monotonic
+
+
+class TokenBuckets:
+    '''
+    One token bucket per key, kept in memory. Each bucket holds up to burst tokens, refilling at rate tokens per second;
+    every admitted event takes one token.
+
+    Only the most recently used keys are kept; a key that was dropped starts again with a full bucket,
+    which is what it would have refilled to anyway unless the rate is very low.
+
+    ### Attributes
+    rate: float
+        Tokens added to each bucket per second
+
+    burst: float
+        Maximum tokens per bucket; the most events admitted at once
+
+    capacity: int
+        Maximum number of keys tracked
+
+    buckets: OrderedDict[Hashable, Tuple[float, float]]
+        (tokens, time last refilled) of each key, least recently used first
+
+    ### Methods
+    admit(key: Hashable) -> bool
+        Takes a token from the bucket of a key, if it has one
+    '''
+
+    def __init__(self, rate: float, burst: float, capacity: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        self.buckets: OrderedDict[Hashable, Tuple[float, float]] = OrderedDict()
+
+    def admit(self, key: Hashable) -> bool:
+        '''
+        Takes a token from the bucket of a key, if it has one
+
+        ### Parameters
+        key: Hashable
+            What is being limited, i.e. (user ID, channel ID)
+
+        ### Returns
+        Whether the event is admitted; if not, nothing is taken
+        '''
+
+        now = monotonic()
+        tokens, last = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        admitted = tokens >= 1
+        if admitted:
+            tokens -= 1
+
+        # Re-inserted at the end, as the most recently used
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.capacity:
+            self.buckets.popitem(last = False)
+        return admitted
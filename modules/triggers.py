@@ -0,0 +1,124 @@
+'''Contains the single on_message listener that matches every registered trigger word in one pass'''
+
+from typing import Callable, Coroutine, Dict, List, Optional, Pattern, Any
+from re import compile as compile_regex, escape
+from asyncio import gather
+
+from discord import Message
+
+from bot import bot_client
+from auxiliary import log_event, ERROR
+
+TriggerHandler = Callable[[Message], Coroutine[Any, Any, None]]
+
+
+class Trigger:
+    '''
+    A message handler, and the words that trigger it
+
+    ### Attributes
+    words: List[str]
+        Lowercase words or phrases; the handler runs if any of them is in a message, anywhere
+
+    handler: TriggerHandler
+        Coroutine function run with the message
+
+    voice_only: bool
+        Whether to only run when the author is in a voice channel
+    '''
+
+    def __init__(self, words: List[str], handler: TriggerHandler, voice_only: bool) -> None:
+        self.words = words
+        self.handler = handler
+        self.voice_only = voice_only
+
+triggers: List[Trigger] = []
+'''Every registered trigger, in order of registration'''
+
+trigger_pattern: Optional[Pattern] = None
+'''Alternation of every trigger word; compiled on first use after a registration'''
+triggers_by_word: Dict[str, List[Trigger]] = {}
+'''For each trigger word, every trigger with a word that is a prefix of it (including itself)'''
+
+def register_trigger(words: List[str], handler: TriggerHandler, voice_only: bool = False) -> None:
+    '''
+    Registers a handler to run whenever a message contains any of the given words; matching is case-insensitive.
+
+    ### Parameters
+    words: List[str]
+        Words or phrases that trigger the handler
+
+    handler: TriggerHandler
+        Coroutine function run with the message; runs at most once per message
+
+    voice_only: bool
+        Whether to only run when the author is in a voice channel
+    '''
+
+    global trigger_pattern
+
+    triggers.append(Trigger([word.lower() for word in words], handler, voice_only))
+    trigger_pattern = None
+
+def message_trigger(*words: str, voice_only: bool = False) -> Callable[[TriggerHandler], TriggerHandler]:
+    '''
+    Decorator version of register_trigger()
+
+    ### Parameters
+    *words: str
+        Words or phrases that trigger the handler
+
+    voice_only: bool
+        Whether to only run when the author is in a voice channel
+    '''
+
+    def decorator(handler: TriggerHandler) -> TriggerHandler:
+        register_trigger(list(words), handler, voice_only)
+        return handler
+
+    return decorator
+
+def compile_triggers() -> Pattern:
+    '''
+    Builds the single pattern that finds every trigger word in one scan
+
+    The alternation is wrapped in a lookahead so that a match is tried at every position, finding words that overlap;
+    at each position, the longest word wins, so every shorter word that also matched there is one of its prefixes.
+    '''
+
+    global trigger_pattern
+
+    all_words = {word for trigger in triggers for word in trigger.words}
+    triggers_by_word.clear()
+    for word in all_words:
+        triggers_by_word[word] = [trigger for trigger in triggers if any(word.startswith(other) for other in trigger.words)]
+
+    ordered = sorted(all_words, key = len, reverse = True)
+    trigger_pattern = compile_regex("(?=(" + "|".join(escape(word) for word in ordered) + "))")
+    return trigger_pattern
+
+@bot_client.listen("on_message")
+async def dispatch_triggers(message: Message):
+    '''
+    Runs the handler of every trigger in a message; lowercases and scans the message only once, no matter how many triggers there are
+    '''
+
+    if message.author.bot or not triggers:
+        return
+
+    pattern = trigger_pattern or compile_triggers()
+    found = pattern.findall(message.content.lower())
+    if not found:
+        return
+
+    # Collect each matching trigger once, in order of registration
+    matched = {id(trigger): trigger for word in set(found) for trigger in triggers_by_word[word]}
+    voice = getattr(message.author, "voice", None)
+    in_voice = voice is not None and voice.channel is not None
+    handlers = [trigger.handler for trigger in triggers if id(trigger) in matched and (in_voice or not trigger.voice_only)]
+
+    # Handlers run concurrently, as separate listeners would
+    results = await gather(*(handler(message) for handler in handlers), return_exceptions = True)
+    for handler, result in zip(handlers, results):
+        if isinstance(result, Exception):
+            log_event(ERROR, "trigger.error", "Trigger handler {handler} failed! {error!r}", user = message.author, guild = message.guild, channel = message.channel, outcome = "failed", handler = handler.__name__, error = result)
@@ -0,0 +1,529 @@
+'''Contains the write-behind cache that serves all reads and writes of User state from memory'''
+
+from typing import Dict, List, Optional, Tuple, Iterable, Callable, Any
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from asyncio import Task, ensure_future, wait
+
+from discord.ext import tasks
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from bot import bot_client, run_db, T
+from auxiliary import InvalidArgumentError, log_event, INFO, ERROR
+from dbmodels import User, LedgerEntry
+
+cache_size = 1024
+'''Maximum number of users kept in memory at once'''
+flush_interval = 30
+'''Seconds between each batched write of changed users to the database'''
+
+user_listeners: List[Callable[[Dict[str, Any]], None]] = []
+'''Functions called with the new state of a user, as given by CachedUser.row(), whenever it changes; used to keep derived state such as leaderboards up to date'''
+
+
+class CachedUser:
+    '''
+    In-memory copy of the state of a single User row; mirrors the methods of User, but without a session.
+
+    Changes only mark the copy as dirty; UserCache writes them to the database in batches later.
+
+    ### Attributes
+    id: int
+        Corresponds to Discord user ID
+
+    electrum: int
+        Currency for this bot, per user
+
+    beacon_touches: int
+        How many times this user has touched the beacon
+
+    dawnbreaker_progess: int
+        Current progress on the quest to find the Dawnbreaker; see beacon.py for more info
+
+    beacon_cd: datetime | None
+        The end time for a cooldown for various beacon-related things
+
+    dirty: bool
+        Whether this copy has changes not yet written to the database
+
+    ledger: List[Dict[str, Any]]
+        Electrum ledger entries not yet written to the database
+
+    ### Methods
+    add_electrum(electrum: int, reason: str) -> None
+        Adds a number of electrum pieces to user's currency, recording it in the ledger
+
+    touch_beacon() -> None
+        Increments beacons touched by 1 for this user
+
+    dawnbreaker(progress: int) -> None
+        Sets dawnbreaker progress for this user
+
+    set_cd(time: timedelta) -> None
+        Sets the cooldown timer for this user
+
+    reset_cd() -> None
+        Ends the cooldown timer for this user
+
+    changed() -> None
+        Marks this copy as dirty, and tells every user listener its new state
+    '''
+
+    def __init__(self, id: int, electrum: int = 0, beacon_touches: int = 0, dawnbreaker_progess: int = 0, beacon_cd: Optional[datetime] = None) -> None:
+        self.id = id
+        self.electrum = electrum
+        self.beacon_touches = beacon_touches
+        self.dawnbreaker_progess = dawnbreaker_progess
+        self.beacon_cd = beacon_cd
+        self.dirty = False
+        self.ledger: List[Dict[str, Any]] = []
+
+    def row(self) -> Dict[str, Any]:
+        '''
+        Returns the current state of this user as column values, for writing to the database
+        '''
+
+        return {
+            "id": self.id,
+            "electrum": self.electrum,
+            "beacon_touches": self.beacon_touches,
+            "dawnbreaker_progess": self.dawnbreaker_progess,
+            "beacon_cd": self.beacon_cd
+        }
+
+    def add_electrum(self, electrum: int, reason: str) -> None:
+        '''
+        Adds a number of electrum pieces to user's currency, recording it in the ledger
+
+        ### Parameters
+        electrum: int
+            Amount of electrum to add or remove (if negative) from account
+
+        reason: str
+            Why the balance changed; see dbmodels.LedgerEntry.reason
+
+        ### Throws
+        InvalidArgumentError
+            Electrum to remove is larger than amount of electrum available
+        '''
+
+        if -electrum > self.electrum:
+            raise InvalidArgumentError
+
+        self.electrum += electrum
+        self.ledger.append(LedgerEntry.entry(self.id, electrum, reason, self.electrum, datetime.utcnow()))
+        self.changed()
+
+    def touch_beacon(self) -> None:
+        '''
+        Increments beacons touched by 1 for this user
+        '''
+
+        self.beacon_touches += 1
+        self.changed()
+
+    def dawnbreaker(self, progress: int) -> None:
+        '''
+        Sets dawnbreaker progress for this user; -1 through 20
+
+        ### Parameters
+        progress: int
+            The number to set progress to
+
+        ### Throws
+        InvalidArgumentError
+            Provided number is not in range -1 to 20
+        '''
+
+        if progress < -1 or progress > 20:
+            raise InvalidArgumentError
+
+        self.dawnbreaker_progess = progress
+        self.changed()
+
+    def set_cd(self, time: timedelta) -> None:
+        '''
+        Sets the cooldown timer for this user
+
+        ### Parameters
+        time: timedelta
+            How long after current time until cooldown is over
+        '''
+
+        self.beacon_cd = datetime.utcnow() + time
+        self.changed()
+
+    def reset_cd(self) -> None:
+        '''
+        Ends the cooldown timer for this user
+        '''
+
+        self.beacon_cd = None
+        self.changed()
+
+    def changed(self) -> None:
+        '''
+        Marks this copy as dirty, and tells every user listener its new state
+        '''
+
+        self.dirty = True
+        if user_listeners:
+            row = self.row()
+            for listener in user_listeners:
+                listener(row)
+
+
+def read_user(session: Session, id: int) -> Optional[Tuple[int, int, int, Optional[datetime]]]:
+    '''
+    Reads the cached columns of a single user; runs on the database thread.
+
+    ### Parameters
+    session: Session
+        Database session scope
+
+    id: int
+        Discord user ID
+
+    ### Returns
+    (electrum, beacon_touches, dawnbreaker_progess, beacon_cd) of the user, or None if the user has no saved data yet
+    '''
+
+    found = session.execute(
+        select(User.electrum, User.beacon_touches, User.dawnbreaker_progess, User.beacon_cd)
+        .where(User.id == id)
+        ).first()
+
+    return None if found is None else tuple(found)
+
+def read_rows(session: Session, ids: List[int]) -> List[Dict[str, Any]]:
+    '''
+    Reads the cached columns of many users, for telling user listeners; runs on the database thread.
+
+    ### Parameters
+    session: Session
+        Database session scope
+
+    ids: List[int]
+        Discord user IDs; users with no saved data are left out
+
+    ### Returns
+    Column values of each user, as given by CachedUser.row()
+    '''
+
+    return [dict(row) for row in session.execute(
+        select(User.id, User.electrum, User.beacon_touches, User.dawnbreaker_progess, User.beacon_cd)
+        .where(User.id.in_(ids))
+        ).mappings().all()]
+
+def write_users(session: Session, rows: List[Dict[str, Any]], ledger: List[Dict[str, Any]]) -> None:
+    '''
+    Stages the state of many users as a single upsert, inserting any that do not exist yet, along with their ledger entries; runs on the database thread.
+
+    ### Parameters
+    session: Session
+        Database session scope
+
+    rows: List[Dict[str, Any]]
+        Column values of each user, as given by CachedUser.row()
+
+    ledger: List[Dict[str, Any]]
+        Electrum ledger entries of those users
+    '''
+
+    statement = sqlite_insert(User)
+    statement = statement.on_conflict_do_update(
+        index_elements = [User.id],
+        set_ = {
+            "electrum": statement.excluded.electrum,
+            "beacon_touches": statement.excluded.beacon_touches,
+            "dawnbreaker_progess": statement.excluded.dawnbreaker_progess,
+            "beacon_cd": statement.excluded.beacon_cd
+        }
+    )
+    session.execute(statement, rows)
+    LedgerEntry.record(session, ledger)
+
+
+class UserCache:
+    '''
+    Write-behind cache of User state, keyed by Discord ID, with least-recently-used eviction.
+
+    Every read and write of electrum, beacon_touches, dawnbreaker_progess, and beacon_cd must go through this cache (or run_sql), or the next flush will overwrite it.
+    Must only be used from the event loop, and a CachedUser should not be kept across an await.
+
+    ### Attributes
+    entries: OrderedDict[int, CachedUser]
+        Cached users, from least to most recently used
+
+    evicted: Dict[int, CachedUser]
+        Users evicted from entries with changes that have not been written yet
+
+    loading: Dict[int, Task]
+        Database reads in progress, so concurrent misses on the same user share one read
+
+    running: Dict[int, Task]
+        run_sql() job of each user it is still running for; get() waits for it rather than reading a state it is about to change
+
+    flushing: Dict[int, CachedUser]
+        Users being written by a flush, whose changes are put back if the flush fails
+
+    flushes: Dict[int, Task]
+        Flush writing each user in flushing; run_sql() waits for it, so that changes put back by a failed flush are written along with its work
+
+    ### Methods
+    [ASYNC] get(id: int) -> CachedUser
+        Returns the cached state of the user with the given Discord ID, reading it from the database if needed
+
+    [ASYNC] run_sql(ids: Iterable[int], work: Callable[..., T], *args: Any) -> T
+        Runs database work that reads or writes the given users directly in SQL, keeping the cache coherent
+
+    [ASYNC] flush() -> None
+        Writes every changed user to the database in a single transaction
+
+    changed_rows() -> List[Dict[str, Any]]
+        Returns the state of every user with changes not yet written to the database
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.entries: OrderedDict[int, CachedUser] = OrderedDict()
+        self.evicted: Dict[int, CachedUser] = {}
+        self.loading: Dict[int, Task] = {}
+        self.running: Dict[int, Task] = {}
+        self.flushing: Dict[int, CachedUser] = {}
+        self.flushes: Dict[int, Task] = {}
+
+    def lookup(self, id: int) -> Optional[CachedUser]:
+        '''
+        Returns the user from memory if present, marking it as most recently used
+        '''
+
+        entry = self.entries.get(id)
+        if entry is not None:
+            self.entries.move_to_end(id)
+            return entry
+
+        entry = self.evicted.pop(id, None)
+        if entry is not None:
+            self.store(entry)
+        return entry
+
+    def store(self, entry: CachedUser) -> None:
+        '''
+        Adds a user to the cache, evicting the least recently used users if over capacity
+        '''
+
+        self.entries[entry.id] = entry
+        while len(self.entries) > self.capacity:
+            _, old = self.entries.popitem(last = False)
+            if old.dirty or self.flushing.get(old.id) is old:
+                # Keep until a flush has written it
+                self.evicted[old.id] = old
+
+    async def get(self, id: int) -> CachedUser:
+        '''
+        Returns the cached state of the user with the given Discord ID, reading it from the database if needed
+
+        New users are only created in memory; they are inserted on the next flush.
+
+        ### Parameters
+        id: int
+            Discord user ID
+
+        ### Returns
+        CachedUser with matching id
+        '''
+
+        while True:
+            entry = self.lookup(id)
+            if entry is not None:
+                return entry
+
+            running = self.running.get(id)
+            if running is not None:
+                # Whether it succeeds or not, the user is back in a settled state afterwards
+                await wait([running])
+                continue
+
+            load = self.loading.get(id)
+            if load is None:
+                load = ensure_future(run_db(read_user, id))
+                self.loading[id] = load
+            found = await load
+
+            # Only the first coroutine to resume from a read stores it; the others find it stored.
+            # If run_sql dropped the read meanwhile, it may be stale, so read again.
+            if self.loading.get(id) is load:
+                del self.loading[id]
+                if found is None:
+                    entry = CachedUser(id)
+                    entry.dirty = True
+                else:
+                    entry = CachedUser(id, *found)
+                self.store(entry)
+                return entry
+
+    async def run_sql(self, ids: Iterable[int], work: Callable[..., T], *args: Any) -> T:
+        '''
+        Runs database work that reads or writes the given users directly in SQL, keeping the cache coherent.
+
+        Pending changes of those users are written in the same transaction just before the work, and the users are dropped from the cache;
+        since the database thread runs jobs in order, the next get() of any of them reads the state left by the work.
+        Flushes and other run_sql() calls still writing any of those users are waited for first, so that changes they put back on failure are not lost.
+        CachedUser objects of those users obtained before this call must not be used afterwards.
+        User listeners are told the state of every one of them afterwards.
+
+        ### Parameters
+        ids: Iterable[int]
+            Discord user IDs of every user the work touches
+
+        work: Callable[..., T]
+            Function to run on the database thread, as with bot.run_db
+
+        *args: Any
+            Extra arguments passed on to work
+
+        ### Returns
+        Whatever work returns
+        '''
+
+        ids = set(ids)
+        while True:
+            busy = {self.running[id] for id in ids if id in self.running} | {self.flushes[id] for id in ids if id in self.flushes}
+            if not busy:
+                break
+            # Either succeeds, or has put its changes back by the time it is done
+            await wait(busy)
+
+        taken: List[CachedUser] = []
+        rows: List[Dict[str, Any]] = []
+        ledger: List[Dict[str, Any]] = []
+        for id in ids:
+            entry = self.entries.pop(id, None) or self.evicted.pop(id, None)
+            if entry is not None and entry.dirty:
+                taken.append(entry)
+                rows.append(entry.row())
+                ledger.extend(entry.ledger)
+            self.loading.pop(id, None)
+
+        listening = bool(user_listeners)
+
+        def job(session: Session) -> Tuple[T, List[Dict[str, Any]]]:
+            if rows:
+                write_users(session, rows, ledger)
+            result = work(session, *args)
+            # Read back in the same job, so the state cannot have moved on since
+            return result, read_rows(session, list(ids)) if listening else []
+
+        async def run_job() -> Tuple[T, List[Dict[str, Any]]]:
+            try:
+                return await run_db(job)
+            except Exception:
+                # Rolled back, so the changes taken out are still unsaved; nothing else could read or take the users meanwhile
+                for entry in taken:
+                    self.evicted[entry.id] = entry
+                raise
+
+        # No awaits between dropping the users and submitting the job, so nothing can read them in between
+        running = ensure_future(run_job())
+        for id in ids:
+            self.running[id] = running
+        try:
+            result, changed = await running
+        finally:
+            for id in ids:
+                if self.running.get(id) is running:
+                    del self.running[id]
+
+        for row in changed:
+            for listener in user_listeners:
+                listener(row)
+        return result
+
+    def changed_rows(self) -> List[Dict[str, Any]]:
+        '''
+        Returns the state of every user with changes not yet written to the database, as given by CachedUser.row()
+        '''
+
+        rows = [entry.row() for entry in self.entries.values() if entry.dirty]
+        rows.extend(entry.row() for entry in self.evicted.values())
+        return rows
+
+    async def flush(self) -> None:
+        '''
+        Writes every changed user to the database in a single transaction
+
+        Since the database thread runs jobs in order, any read submitted after this sees the written state.
+        '''
+
+        changed = [entry for entry in self.entries.values() if entry.dirty]
+        changed.extend(entry for entry in self.evicted.values() if entry.dirty)
+        if not changed:
+            return
+
+        rows = [entry.row() for entry in changed]
+        ledgers = [entry.ledger for entry in changed]
+        for entry in changed:
+            entry.dirty = False
+            entry.ledger = []
+            # Kept in memory even if evicted meanwhile (see store()), so that nothing reads the user before this is written
+            self.flushing[entry.id] = entry
+
+        async def write() -> None:
+            try:
+                await run_db(write_users, rows, [item for ledger in ledgers for item in ledger])
+            except Exception:
+                # Put changes back so that the next flush, or a run_sql() waiting on this, writes them
+                for entry, ledger in zip(changed, ledgers):
+                    entry.dirty = True
+                    entry.ledger[:0] = ledger
+                raise
+
+        writing = ensure_future(write())
+        for entry in changed:
+            self.flushes[entry.id] = writing
+        try:
+            await writing
+        finally:
+            for entry in changed:
+                if self.flushes.get(entry.id) is writing:
+                    del self.flushes[entry.id]
+                    del self.flushing[entry.id]
+                # Evicted users only stay while they have changes to write
+                if not entry.dirty and self.evicted.get(entry.id) is entry:
+                    del self.evicted[entry.id]
+
+user_cache = UserCache(cache_size)
+'''Global cache of User state'''
+
+
+@tasks.loop(seconds = flush_interval)
+async def periodic_flush() -> None:
+    '''
+    Regularly writes changed users to the database
+    '''
+
+    try:
+        await user_cache.flush()
+    except Exception as error:
+        log_event(ERROR, "cache.flush", "Failed to save user data! {error!r}", outcome = "failed", error = error)
+
+@bot_client.listen("on_ready")
+async def start_flushing():
+    '''
+    Starts the periodic flush once connected
+    '''
+
+    if not periodic_flush.is_running():
+        periodic_flush.start()
+
+@bot_client.listen("on_disconnect")
+async def flush_on_disconnect():
+    '''
+    Saves all user data whenever the connection to Discord is lost
+    '''
+
+    log_event(INFO, "cache.flush", "Saving user data after disconnect")
+    await user_cache.flush()
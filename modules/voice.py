@@ -0,0 +1,570 @@
+'''Contains everything related to playing audio clips in voice channels'''
+
+from typing import Dict, List, Optional, Tuple, Any
+from collections import OrderedDict
+from asyncio import Task, Event, get_running_loop, gather, wait_for
+from threading import Lock
+from heapq import heappush, heappop, heapify
+from itertools import count
+from os import listdir
+
+from discord import Guild, VoiceChannel, VoiceClient, AudioSource, FFmpegOpusAudio
+from discord import ClientException
+from discord.oggparse import OggStream
+from discord.opus import Decoder
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bot import bot_client
+from auxiliary import log_event, load_settings, DEBUG, INFO, ERROR
+
+voice_settings = load_settings("voice", {"clip_cache_size": 16 * 1024 * 1024, "queue_size": 8, "coalesce_window": 2, "idle_timeout": 120, "mixing": False})
+
+clip_cache_size: int = voice_settings["clip_cache_size"]
+'''Maximum total bytes of Opus packets kept in memory'''
+queue_size: int = voice_settings["queue_size"]
+'''Maximum clips waiting to play per guild'''
+coalesce_window: float = voice_settings["coalesce_window"]
+'''Seconds after a clip starts during which the same clip in the same channel is ignored'''
+idle_timeout: float = voice_settings["idle_timeout"]
+'''Seconds to stay connected after the last clip, so that the next one does not have to reconnect'''
+mixing: bool = voice_settings["mixing"] and numpy is not None
+'''Whether clips requested in the channel already playing are mixed in to play at the same time, instead of queued; needs numpy'''
+
+
+class OpusClip:
+    '''
+    An audio clip from ./audio/, held in memory as Opus packets ready to send
+
+    ### Attributes
+    name: str
+        Name of the audio file (excluding .ogg)
+
+    packets: List[bytes]
+        Opus packets of the clip, 20ms each, excluding the Ogg Opus headers
+
+    size: int
+        Total bytes of all packets, and of the decoded PCM once decoded
+
+    pcm: numpy.ndarray | None
+        The clip decoded to 16-bit stereo PCM, one row per 20ms frame; only decoded when mixing
+    '''
+
+    def __init__(self, name: str, packets: List[bytes]) -> None:
+        self.name = name
+        self.packets = packets
+        self.size = sum(len(packet) for packet in packets)
+        self.pcm: Optional["numpy.ndarray"] = None
+
+def read_clip(name: str) -> OpusClip:
+    '''
+    Reads an audio clip into Opus packets; blocking, so run it in an executor.
+
+    Ogg Opus files are demuxed directly; anything else (i.e. Ogg Vorbis) is transcoded to Opus by ffmpeg, once.
+
+    ### Parameters
+    name: str
+        Name of audio file to read (excluding .ogg)
+
+    ### Returns
+    The clip
+
+    ### Throws
+    FileNotFoundError
+        No such audio file
+    '''
+
+    path = "audio/" + name + ".ogg"
+    with open(path, "rb") as file:
+        packets = list(OggStream(file).iter_packets())
+
+    if not packets or not packets[0].startswith(b"OpusHead"):
+        transcoder = FFmpegOpusAudio(path)
+        packets = []
+        try:
+            packet = transcoder.read()
+            while packet:
+                packets.append(packet)
+                packet = transcoder.read()
+        finally:
+            transcoder.cleanup()
+
+    # Headers are not audio
+    return OpusClip(name, [packet for packet in packets if not packet.startswith((b"OpusHead", b"OpusTags"))])
+
+def decode_clip(clip: OpusClip) -> "numpy.ndarray":
+    '''
+    Decodes a clip to PCM frames for mixing; blocking, so run it in an executor.
+
+    ### Parameters
+    clip: OpusClip
+        Clip to decode
+
+    ### Returns
+    16-bit stereo PCM, one row of Decoder.SAMPLES_PER_FRAME * Decoder.CHANNELS samples per 20ms frame; the last frame is padded with silence
+    '''
+
+    decoder = Decoder()
+    samples = numpy.frombuffer(b"".join(decoder.decode(packet, fec = False) for packet in clip.packets), dtype = numpy.int16)
+
+    frame_samples = Decoder.SAMPLES_PER_FRAME * Decoder.CHANNELS
+    padding = -len(samples) % frame_samples
+    if padding:
+        samples = numpy.concatenate((samples, numpy.zeros(padding, dtype = numpy.int16)))
+    return samples.reshape(-1, frame_samples)
+
+class ClipCache:
+    '''
+    Size-bounded cache of audio clips as Opus packets, evicting the least recently played clips first
+
+    ### Methods
+    [ASYNC] get(name: str) -> OpusClip
+        Returns a clip, reading it on first use
+
+    [ASYNC] decoded(clip: OpusClip) -> numpy.ndarray
+        Returns the PCM frames of a clip, decoding them on first use
+
+    [ASYNC] preload() -> None
+        Reads every clip in ./audio/ ahead of time, as far as the size limit allows
+    '''
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.clips: OrderedDict[str, OpusClip] = OrderedDict()
+
+    async def get(self, name: str) -> OpusClip:
+        '''
+        Returns a clip, reading it on first use
+
+        ### Parameters
+        name: str
+            Name of audio file (excluding .ogg)
+
+        ### Throws
+        FileNotFoundError
+            No such audio file
+        '''
+
+        clip = self.clips.get(name)
+        if clip is not None:
+            self.clips.move_to_end(name)
+            return clip
+
+        clip = await get_running_loop().run_in_executor(None, read_clip, name)
+        if name not in self.clips:
+            self.clips[name] = clip
+            self.size += clip.size
+            self.evict()
+        return clip
+
+    async def decoded(self, clip: OpusClip) -> "numpy.ndarray":
+        '''
+        Returns the PCM frames of a clip, decoding them on first use; decoded PCM counts towards the size limit
+
+        ### Parameters
+        clip: OpusClip
+            Clip to decode
+        '''
+
+        if clip.pcm is None:
+            pcm = await get_running_loop().run_in_executor(None, decode_clip, clip)
+            if clip.pcm is None:
+                clip.pcm = pcm
+                clip.size += pcm.nbytes
+                if self.clips.get(clip.name) is clip:
+                    self.size += pcm.nbytes
+                    self.evict()
+        return clip.pcm
+
+    def evict(self) -> None:
+        '''
+        Evicts the least recently played clips until under the size limit, always keeping the latest one
+        '''
+
+        while self.size > self.max_size and len(self.clips) > 1:
+            _, old = self.clips.popitem(last = False)
+            self.size -= old.size
+
+    async def preload(self) -> None:
+        '''
+        Reads every clip in ./audio/ ahead of time, as far as the size limit allows
+        '''
+
+        names = [file[:-4] for file in listdir("audio") if file.endswith(".ogg")]
+        results = await gather(*(self.get(name) for name in names), return_exceptions = True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                log_event(ERROR, "voice.preload", "Could not load {file}.ogg! {error!r}", outcome = "failed", file = name, error = result)
+
+clip_cache = ClipCache(clip_cache_size)
+'''Global cache of audio clips'''
+
+
+class CachedOpusAudio(AudioSource):
+    '''
+    Audio source that plays a cached clip straight from memory, without ffmpeg or disk access
+    '''
+
+    def __init__(self, clip: OpusClip) -> None:
+        self.packets = clip.packets
+        self.position = 0
+
+    def read(self) -> bytes:
+        if self.position >= len(self.packets):
+            return b""
+        packet = self.packets[self.position]
+        self.position += 1
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+class MixingAudio(AudioSource):
+    '''
+    Audio source that plays any number of clips at the same time, by mixing their PCM frame by frame; the voice client encodes the result to a single Opus stream.
+
+    Clips can be added while it plays; it ends once every clip has finished.
+
+    ### Methods
+    add(pcm: numpy.ndarray) -> bool
+        Starts playing another clip on top of the current ones
+    '''
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.streams: List[List[Any]] = []
+        self.finished = False
+
+    def add(self, pcm: "numpy.ndarray") -> bool:
+        '''
+        Starts playing another clip on top of the current ones
+
+        ### Parameters
+        pcm: numpy.ndarray
+            PCM frames of the clip, as given by decode_clip()
+
+        ### Returns
+        Whether it was added; False if this source has already ended
+        '''
+
+        with self.lock:
+            if self.finished:
+                return False
+            self.streams.append([pcm, 0])
+            return True
+
+    def read(self) -> bytes:
+        # Called by the voice client's player thread every 20ms
+        with self.lock:
+            if not self.streams:
+                self.finished = True
+                return b""
+
+            frames = [pcm[position] for pcm, position in self.streams]
+            for stream in self.streams:
+                stream[1] += 1
+            self.streams = [stream for stream in self.streams if stream[1] < len(stream[0])]
+
+        if len(frames) == 1:
+            return frames[0].tobytes()
+
+        # Sum in 32 bits so loud overlaps clip instead of wrapping around
+        mixed = numpy.sum(frames, axis = 0, dtype = numpy.int32)
+        numpy.clip(mixed, -32768, 32767, out = mixed)
+        return mixed.astype(numpy.int16).tobytes()
+
+    def is_opus(self) -> bool:
+        return False
+
+
+@bot_client.listen("on_ready")
+async def preload_clips():
+    '''
+    Loads all audio clips once connected, so that the first play of each does not wait on disk or ffmpeg
+    '''
+
+    await clip_cache.preload()
+
+class PlayRequest:
+    '''
+    A single queued clip play
+
+    ### Attributes
+    channel: VoiceChannel
+        Voice channel to play in
+
+    file: str
+        Name of audio file to play (excluding .ogg)
+
+    priority: int
+        Higher priority requests play first; equal priorities play in order of request
+    '''
+
+    def __init__(self, channel: VoiceChannel, file: str, priority: int) -> None:
+        self.channel = channel
+        self.file = file
+        self.priority = priority
+
+class GuildPlayer:
+    '''
+    Plays the clips requested in a single guild one at a time, from a bounded priority queue.
+
+    Only this player's own task connects, moves, and disconnects the guild's voice client, so requests can never race each other.
+    The connection is kept warm for idle_timeout seconds after the last clip, so repeat triggers skip the voice handshake.
+
+    ### Attributes
+    guild: Guild
+        Guild this player plays in
+
+    queue: List[Tuple[int, int, PlayRequest]]
+        Heap of (-priority, order, request) waiting to play
+
+    recent: Dict[Tuple[int, str], float]
+        Event loop time that each (channel ID, file) last started playing, for coalescing
+
+    task: Task | None
+        Task running the queue, if any
+
+    wakeup: Event
+        Set whenever a request is queued, to wake the task while it idles
+
+    mixer: MixingAudio | None
+        Source currently playing, if mixing; more clips for the same channel are added to it instead of queued
+
+    mixer_channel: int | None
+        ID of the channel the mixer is playing in
+
+    ### Methods
+    submit(request: PlayRequest) -> bool
+        Queues a clip to play, unless it is coalesced with an identical one or the queue is full
+
+    [ASYNC] mix(request: PlayRequest) -> bool
+        Plays a clip immediately over whatever is playing, if mixing in the same channel
+
+    depth() -> int
+        Number of clips waiting to play
+    '''
+
+    def __init__(self, guild: Guild) -> None:
+        self.guild = guild
+        self.queue: List[Tuple[int, int, PlayRequest]] = []
+        self.recent: Dict[Tuple[int, str], float] = {}
+        self.task: Optional[Task] = None
+        self.wakeup = Event()
+        self.mixer: Optional[MixingAudio] = None
+        self.mixer_channel: Optional[int] = None
+
+    def depth(self) -> int:
+        '''
+        Number of clips waiting to play
+        '''
+
+        return len(self.queue)
+
+    def submit(self, request: PlayRequest) -> bool:
+        '''
+        Queues a clip to play, unless it is coalesced with an identical one or the queue is full
+
+        An identical clip in the same channel is coalesced if it is still waiting, or started less than coalesce_window seconds ago.
+        If the queue is full, the new request replaces the lowest priority waiting request if it has a higher priority.
+
+        ### Parameters
+        request: PlayRequest
+            Clip to play
+
+        ### Returns
+        Whether the request was queued
+        '''
+
+        if self.coalesced(request):
+            return False
+
+        if len(self.queue) >= queue_size:
+            lowest = max(self.queue)
+            if -lowest[0] >= request.priority:
+                return False
+            self.queue.remove(lowest)
+            heapify(self.queue)
+
+        heappush(self.queue, (-request.priority, next(request_order), request))
+        self.wakeup.set()
+        if self.task is None:
+            self.task = get_running_loop().create_task(self.run())
+        return True
+
+    def coalesced(self, request: PlayRequest) -> bool:
+        '''
+        Whether an identical clip in the same channel is still waiting, or started less than coalesce_window seconds ago
+        '''
+
+        key = (request.channel.id, request.file)
+        started = self.recent.get(key)
+        if started is not None and get_running_loop().time() - started < coalesce_window:
+            return True
+        return any((queued.channel.id, queued.file) == key for _, _, queued in self.queue)
+
+    async def mix(self, request: PlayRequest) -> bool:
+        '''
+        Plays a clip immediately over whatever is playing, if mixing in the same channel
+
+        ### Parameters
+        request: PlayRequest
+            Clip to play
+
+        ### Returns
+        Whether it is playing (or was coalesced); if False, it should be queued with submit() instead
+        '''
+
+        if self.mixer is None or self.mixer_channel != request.channel.id:
+            return False
+        if self.coalesced(request):
+            return True
+
+        try:
+            pcm = await clip_cache.decoded(await clip_cache.get(request.file))
+        except (OSError, ClientException):
+            return False
+
+        # The mixer may have ended while decoding
+        mixer = self.mixer
+        if mixer is None or self.mixer_channel != request.channel.id or not mixer.add(pcm):
+            return False
+
+        log_event(INFO, "voice.play", "Mixing {file}.ogg in GUILD[{guild}], CHANNEL[{channel}]", guild = self.guild, channel = request.channel, file = request.file, queued = len(self.queue))
+        self.recent[(request.channel.id, request.file)] = get_running_loop().time()
+        return True
+
+    async def run(self) -> None:
+        '''
+        Plays queued clips until the queue is empty, then leaves voice once nothing more is queued for idle_timeout seconds
+
+        Once done, the player is removed from players, unless more clips were queued meanwhile.
+        '''
+
+        try:
+            while True:
+                self.wakeup.clear()
+                while self.queue:
+                    _, _, request = heappop(self.queue)
+                    try:
+                        await self.play(request)
+                    except Exception as error:
+                        log_event(ERROR, "voice.play", "Could not play {file}.ogg in GUILD[{guild}], CHANNEL[{channel}]! {error!r}", guild = self.guild, channel = request.channel, outcome = "failed", file = request.file, error = error)
+
+                # Stay connected for a while in case more clips follow
+                try:
+                    await wait_for(self.wakeup.wait(), idle_timeout)
+                    continue
+                except TimeoutError:
+                    pass
+
+                voice_client = self.guild.voice_client
+                if voice_client is not None:
+                    log_event(INFO, "voice.disconnect", "Disconnecting idle voice client in GUILD[{guild}]", guild = self.guild)
+                    try:
+                        await voice_client.disconnect()
+                    except Exception as error:
+                        log_event(ERROR, "voice.disconnect", "Could not disconnect idle voice client in GUILD[{guild}]! {error!r}", guild = self.guild, outcome = "failed", error = error)
+
+                # Anything queued while disconnecting still needs to play
+                if not self.queue:
+                    break
+        finally:
+            self.task = None
+            if not self.queue and players.get(self.guild.id) is self:
+                del players[self.guild.id]
+
+    async def play(self, request: PlayRequest) -> None:
+        '''
+        Joins the request's channel (or moves there) and plays its clip to the end
+        '''
+
+        try:
+            clip = await clip_cache.get(request.file)
+        except (OSError, ClientException):
+            log_event(ERROR, "voice.play", "Audio file not found!", guild = self.guild, channel = request.channel, outcome = "not found", file = request.file)
+            return
+
+        voice_client: Optional[VoiceClient] = self.guild.voice_client
+        if voice_client is not None and not voice_client.is_connected():
+            # A dropped connection still counts as the guild's voice client, which would make connect() refuse
+            await voice_client.disconnect(force = True)
+            voice_client = None
+        if voice_client is None:
+            voice_client = await request.channel.connect()
+        elif voice_client.channel != request.channel:
+            await voice_client.move_to(request.channel)
+
+        source: AudioSource = CachedOpusAudio(clip)
+        if mixing:
+            try:
+                source = MixingAudio()
+                source.add(await clip_cache.decoded(clip))
+            except Exception as error:
+                # i.e. Opus library not loaded; still play, just without mixing
+                log_event(ERROR, "voice.play", "Could not decode {file}.ogg for mixing! {error!r}", guild = self.guild, channel = request.channel, outcome = "unmixed", file = request.file, error = error)
+                source = CachedOpusAudio(clip)
+
+        log_event(INFO, "voice.play", "Playing {file}.ogg in GUILD[{guild}], CHANNEL[{channel}]", guild = self.guild, channel = request.channel, file = request.file, queued = len(self.queue))
+        self.recent[(request.channel.id, request.file)] = get_running_loop().time()
+        if isinstance(source, MixingAudio):
+            self.mixer = source
+            self.mixer_channel = request.channel.id
+        try:
+            await voice_client.play(source, wait_finish = True)
+        finally:
+            self.mixer = None
+            self.mixer_channel = None
+
+players: Dict[int, GuildPlayer] = {}
+'''Playback scheduler of each guild that is playing or still connected to voice, by guild ID'''
+request_order = count()
+'''Tie-breaker so that requests of equal priority play in order'''
+
+def queue_depth(guild: Guild) -> int:
+    '''
+    Returns the number of clips waiting to play in a guild
+    '''
+
+    player = players.get(guild.id)
+    return 0 if player is None else player.depth()
+
+async def play_audio(vc: VoiceChannel, file: str, priority: int = 0) -> None:
+    '''
+    Queues an audio clip from ./audio/<file>.ogg to play in a voice channel, without waiting for it to play.
+
+    Clips in the same guild play one after another, over one reused connection; bot automatically leaves once idle for a while.
+    If mixing is enabled, clips for the channel already playing are mixed in to play right away instead.
+
+    ### Parameters
+    vc: VoiceChannel
+        Voice channel to play in
+
+    file: str
+        Name of audio file to play (excluding .ogg)
+
+    priority: int
+        Higher priority clips play first
+    '''
+
+    if vc is None:
+        return
+
+    player = players.get(vc.guild.id)
+    if player is None:
+        player = GuildPlayer(vc.guild)
+        players[vc.guild.id] = player
+
+    request = PlayRequest(vc, file, priority)
+    if mixing and await player.mix(request):
+        return
+
+    # The player may have finished and been removed while mixing was tried
+    player = players.setdefault(vc.guild.id, player)
+
+    if not player.submit(request):
+        log_event(DEBUG, "voice.play", "Dropped {file}.ogg in GUILD[{guild}], CHANNEL[{channel}]; coalesced or queue full", guild = vc.guild, channel = vc, outcome = "dropped", file = file, queued = player.depth())
@@ -0,0 +1,130 @@
+'''Offline Monte Carlo simulator of the beacon economy; run directly with Python, i.e. python simulate.py --users 1000000 --hours 720'''
+
+# Allows for other .py files to be found in /modules folder
+from sys import path as syspath
+syspath.append(syspath[0] + "\\modules")
+
+from typing import Dict
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy
+
+from beaconrules import touch_dice, touch_sides, search_sides, search_succeeds, progress_after, outcome_table, outcome_electrum, found_progress, lost_progress, dawnbreaker_progress, touch_cooldown, search_cooldown, COOLDOWN, DAWNBREAKER
+
+def simulate(users: int, hours: float, interval: float, chance: float, seed: int | None) -> Dict[str, numpy.ndarray]:
+    '''
+    Replays the rules in beaconrules for many virtual users at once, each trying to touch the beacon at regular intervals
+
+    Every rule comes from beaconrules: touches are decided by indexing outcome_table() with all rolls of a step at once,
+    and progress by a table of progress_after().
+
+    ### Parameters
+    users: int
+        Number of virtual users
+
+    hours: float
+        Simulated time
+
+    interval: float
+        Minutes between each attempt of a user to touch the beacon
+
+    chance: float
+        Chance that a user actually tries at each interval
+
+    seed: int | None
+        Seed of the random generator, for repeatable runs
+
+    ### Returns
+    Per-user arrays: "touches", "electrum", "dawnbreaker_touches" (touch that obtained the Dawnbreaker, or -1), "blocked" (attempts refused by a cooldown), "cooldown_minutes", and "lost_minutes"
+    '''
+
+    rng = numpy.random.default_rng(seed)
+
+    outcomes_by_rolls = numpy.array(outcome_table(), dtype = numpy.int8)
+    place_values = touch_sides ** numpy.arange(touch_dice)
+    electrum_by_outcome = numpy.array([outcome_electrum[outcome] for outcome in range(len(outcome_electrum))], dtype = numpy.int64)
+    # Indexed by progress - lost_progress, then outcome
+    progress_by_outcome = numpy.array([[progress_after(progress, outcome) for outcome in range(len(outcome_electrum))] for progress in range(lost_progress, dawnbreaker_progress + 1)], dtype = numpy.int8)
+    touch_cd = touch_cooldown.total_seconds() / 60
+    search_cd = search_cooldown.total_seconds() / 60
+
+    progress = numpy.full(users, found_progress, dtype = numpy.int8)
+    cooldown_end = numpy.full(users, -numpy.inf)
+    touches = numpy.zeros(users, dtype = numpy.int64)
+    electrum = numpy.zeros(users, dtype = numpy.int64)
+    dawnbreaker_touches = numpy.full(users, -1, dtype = numpy.int64)
+    blocked = numpy.zeros(users, dtype = numpy.int64)
+    cooldown_steps = numpy.zeros(users, dtype = numpy.int64)
+    lost_steps = numpy.zeros(users, dtype = numpy.int64)
+
+    for step in range(int(hours * 60 // interval)):
+        now = step * interval
+
+        # As in beacon_update, a cooldown only ends once its time has passed
+        questing = progress != dawnbreaker_progress
+        cooling = questing & (cooldown_end >= now)
+        lost = progress == lost_progress
+        cooldown_steps += cooling
+        lost_steps += lost
+
+        trying = questing if chance >= 1 else questing & (rng.random(users) < chance)
+        blocked += trying & cooling
+        trying &= ~cooling
+
+        searching = numpy.flatnonzero(trying & lost)
+        if searching.size:
+            found = search_succeeds(rng.integers(1, search_sides + 1, searching.size))
+            progress[searching[found]] = found_progress
+            cooldown_end[searching[~found]] = now + search_cd
+
+        touching = numpy.flatnonzero(trying & ~lost)
+        if touching.size:
+            outcomes = outcomes_by_rolls[rng.integers(0, touch_sides, (touching.size, touch_dice)) @ place_values]
+            touches[touching] += 1
+            electrum[touching] += electrum_by_outcome[outcomes]
+            progress[touching] = progress_by_outcome[progress[touching] - lost_progress, outcomes]
+            cooldown_end[touching[outcomes == COOLDOWN]] = now + touch_cd
+            obtained = touching[outcomes == DAWNBREAKER]
+            dawnbreaker_touches[obtained] = touches[obtained]
+
+    return {
+        "touches": touches,
+        "electrum": electrum,
+        "dawnbreaker_touches": dawnbreaker_touches,
+        "blocked": blocked,
+        "cooldown_minutes": cooldown_steps * interval,
+        "lost_minutes": lost_steps * interval
+    }
+
+def describe(name: str, values: numpy.ndarray) -> str:
+    '''
+    Summarizes a distribution as one line: mean and percentiles
+    '''
+
+    if values.size == 0:
+        return name + ": no samples"
+    p10, p50, p90, p99 = numpy.percentile(values, [10, 50, 90, 99])
+    return f"{name}: mean {values.mean():.3f} | p10 {p10:.3f} | p50 {p50:.3f} | p90 {p90:.3f} | p99 {p99:.3f}"
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Simulates the beacon economy for many virtual users")
+    parser.add_argument("--users", type = int, default = 100000, help = "number of virtual users")
+    parser.add_argument("--hours", type = float, default = 24 * 7, help = "simulated time")
+    parser.add_argument("--interval", type = float, default = 10, help = "minutes between each attempt of a user to touch the beacon")
+    parser.add_argument("--chance", type = float, default = 1, help = "chance that a user actually tries at each interval")
+    parser.add_argument("--seed", type = int, default = None, help = "seed of the random generator, for repeatable runs")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    results = simulate(args.users, args.hours, args.interval, args.chance, args.seed)
+    print(f"Simulated {args.users} users for {args.hours} hours in {perf_counter() - start:.1f}s\n")
+
+    obtained = results["dawnbreaker_touches"][results["dawnbreaker_touches"] >= 0]
+    print(f"Obtained the Dawnbreaker: {obtained.size} ({100 * obtained.size / args.users:.2f}%)")
+    print(describe("Touches to Dawnbreaker", obtained))
+    print(describe("Touches", results["touches"]))
+    print(describe("Electrum per hour", results["electrum"] / args.hours))
+    print(describe("Attempts refused by a cooldown", results["blocked"]))
+    print(describe("% of time on cooldown", 100 * results["cooldown_minutes"] / (args.hours * 60)))
+    print(describe("% of time without the beacon", 100 * results["lost_minutes"] / (args.hours * 60)))